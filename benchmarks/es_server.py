@@ -0,0 +1,158 @@
+'''
+    Local HTTP front of the elastic search stand-in, so the real client,
+    ElasticSearchEngine and the views can run against it without a
+    cluster or network access. It answers the endpoints the search
+    module calls:
+
+        GET|HEAD /                          cluster info
+        GET|POST /<index>/_search           search, suggest, aggs
+        PUT|POST /<index>/_doc/<id>         index one document
+        DELETE   /<index>/_doc/<id>         delete one document
+        POST     /_bulk, /<index>/_bulk     bulk index and delete
+
+    Query string parameters of _search (size, request_cache, ...) are
+    passed on to the stand-in, filter_path is ignored.
+'''
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from .es_standin import StandInElasticsearch, NotFoundError
+
+VERSION = "7.13.3"
+
+
+def parse_params(query):
+    '''
+        Search keyword arguments of a query string
+    '''
+    params = {}
+    for name, value in parse_qsl(query):
+        if name == "size":
+            params["size"] = int(value)
+        elif name == "request_cache":
+            params["request_cache"] = value == "true"
+        else:
+            params[name] = value
+    return params
+
+
+def parse_bulk(payload):
+    '''
+        (action, metadata, source) triples of a bulk body
+    '''
+    lines = [json.loads(line) for line in payload.decode("utf-8").splitlines() if line.strip()]
+    actions = []
+    position = 0
+    while position < len(lines):
+        action, metadata = next(iter(lines[position].items()))
+        position += 1
+        source = None
+        if action != "delete":
+            source = lines[position]
+            position += 1
+        actions.append((action, metadata, source))
+    return actions
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+        Route requests to the stand-in of the server, one at a time
+    '''
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in two writes, without this the second
+    # waits for the delayed ack of the first on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def reply(self, status, data):
+        '''
+            Send a json response
+        '''
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def read_body(self):
+        '''
+            Raw request body
+        '''
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def handle_request(self):
+        '''
+            Answer the request with the stand-in
+        '''
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        payload = self.read_body()
+        client = self.server.client
+        with self.server.lock:
+            if not parts:
+                return self.reply(200, {
+                    "name": "stand-in", "cluster_name": "benchmarks",
+                    "version": {"number": VERSION}, "tagline": "You Know, for Search"
+                })
+            if parts[-1] == "_bulk":
+                items = client.bulk(parse_bulk(payload))
+                return self.reply(200, {"took": 0, "errors": False, "items": items})
+            if len(parts) == 2 and parts[1] == "_search":
+                body = json.loads(payload) if payload else {}
+                return self.reply(200, client.search(index=parts[0], body=body, **parse_params(url.query)))
+            if len(parts) == 3 and parts[1] == "_doc":
+                if self.command == "DELETE":
+                    try:
+                        client.remove(parts[0], parts[2])
+                    except NotFoundError:
+                        return self.reply(404, {"_index": parts[0], "_id": parts[2], "result": "not_found"})
+                    client.clear_cache()
+                    return self.reply(200, {"_index": parts[0], "_id": parts[2], "result": "deleted"})
+                return self.reply(201, client.index(index=parts[0], id=parts[2], body=json.loads(payload)))
+        return self.reply(404, {"error": f"no stand-in for {self.command} {url.path}", "status": 404})
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+        HTTP server of a StandInElasticsearch on a local port, port 0
+        picks a free one
+    '''
+    daemon_threads = True
+
+    def __init__(self, client: StandInElasticsearch, host="127.0.0.1", port=0):
+        super().__init__((host, port), StandInHandler)
+        self.client = client
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        '''
+            Base url to give to the client
+        '''
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        '''
+            Serve from a daemon thread
+        '''
+        self.thread = threading.Thread(target=self.serve_forever, name="es-standin", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+            Stop serving and close the socket
+        '''
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,449 @@
+'''
+    In-memory stand-in for the elastic search client, for benchmarks.
+    It evaluates the subset of the query DSL and the endpoints the
+    search module uses: bool queries with term, match, range and
+    terms_set clauses, should clauses with boosts, from/size and
+    search_after, completion and phrase suggesters, terms aggregations
+    and single and bulk writes.
+
+    It keeps the cost structure that matters for the search modes:
+    clauses in must are scored doc by doc (terms_set runs its script
+    per candidate), clauses in filter are cached bitsets, and with
+    request_cache=True a repeated body is served from a response
+    cache. Writes drop both caches, as a refresh does.
+
+    See es_server.py to reach it over HTTP with the real client.
+'''
+import json
+import math
+import random
+import difflib
+from collections import Counter, OrderedDict
+
+WORDS = [
+    "cat", "dog", "funny", "still", "happy", "dance", "cute", "food", "game", "meme",
+    "party", "baby", "run", "jump", "sleep", "car", "ball", "win", "fail", "love",
+]
+CATEGORIES = ["animal", "food", "sports", "meme", "game", "emoji", "tech", "social"]
+TAGS = [f"tag{index}" for index in range(30)]
+
+GIF_INDEX = "gif"
+
+MAX_CACHED_FILTERS = 1000
+MAX_CACHED_RESPONSES = 1000
+
+# options of a suggester when the request does not say
+DEFAULT_SUGGEST_SIZE = 5
+
+# text fields also reachable through their .keyword sub-field
+TEXT_FIELDS = ("title", "uploader")
+
+
+def generate_corpus(count, seed=0):
+    '''
+        Gif documents with random titles, categories, tags and sizes,
+        ids from 1 like the database
+    '''
+    rng = random.Random(seed)
+    return [{
+        "id": gif_id,
+        "title": " ".join(rng.choices(WORDS, k=rng.randint(1, 4))),
+        "uploader": f"user{rng.randint(0, 500)}",
+        "category": rng.choice(CATEGORIES),
+        "tags": rng.sample(TAGS, rng.randint(1, 4)),
+        "width": rng.randint(100, 1000),
+        "height": rng.randint(100, 1000),
+        "duration": round(rng.uniform(0.5, 10.0), 1),
+    } for gif_id in range(1, count + 1)]
+
+
+def fuzzy_distance(term):
+    '''
+        Edit distance allowed by fuzziness AUTO for a term
+    '''
+    if len(term) <= 2:
+        return 0
+    return 1 if len(term) <= 5 else 2
+
+
+def edit_distance(first, second):
+    '''
+        Edit distance of two words counting a transposition of
+        adjacent letters as one edit, as fuzzy queries do
+    '''
+    rows = [list(range(len(second) + 1))]
+    for row, first_char in enumerate(first, 1):
+        current = [row]
+        for column, second_char in enumerate(second, 1):
+            distance = min(
+                rows[-1][column] + 1,
+                current[column - 1] + 1,
+                rows[-1][column - 1] + (first_char != second_char)
+            )
+            if row > 1 and column > 1 and first_char == second[column - 2] and first[row - 2] == second_char:
+                distance = min(distance, rows[-2][column - 2] + 1)
+            current.append(distance)
+        rows.append(current)
+    return rows[-1][-1]
+
+
+class NotFoundError(Exception):
+    '''
+        The document to delete does not exist
+    '''
+
+
+class StandInElasticsearch:
+    '''
+        Client stand-in answering search(), index(), delete() and bulk
+        actions over in-memory documents. The gif index is given at
+        construction, other indexes (message_index) are created by
+        their first write.
+    '''
+    def __init__(self, documents):
+        self.documents = []
+        self.positions = {}
+        self.postings = {}
+        self.indexes = {}
+        self.filter_cache = OrderedDict()
+        self.response_cache = OrderedDict()
+        for document in documents:
+            self.add_document(document)
+
+    def clear_cache(self):
+        '''
+            Drop cached filters and responses
+        '''
+        self.filter_cache.clear()
+        self.response_cache.clear()
+
+    def postings_of(self, document):
+        '''
+            Posting keys of a gif document
+        '''
+        keys = set()
+        for field in TEXT_FIELDS:
+            value = str(document.get(field) or "")
+            for token in value.lower().split():
+                keys.add((field, token))
+            keys.add((f"{field}.keyword", value))
+        keys.add(("category.keyword", document.get("category")))
+        for tag in document.get("tags") or []:
+            keys.add(("tags.keyword", tag))
+            keys.add(("tags", tag))
+        return keys
+
+    def add_document(self, document):
+        '''
+            Index a gif document, replacing the one with the same id
+        '''
+        gif_id = int(document["id"])
+        if gif_id in self.positions:
+            self.remove_document(gif_id)
+        doc = len(self.documents)
+        self.documents.append(document)
+        self.positions[gif_id] = doc
+        for key in self.postings_of(document):
+            self.postings.setdefault(key, set()).add(doc)
+
+    def remove_document(self, gif_id):
+        '''
+            Remove a gif document, its slot stays empty
+        '''
+        doc = self.positions.pop(int(gif_id), None)
+        if doc is None:
+            raise NotFoundError(gif_id)
+        for key in self.postings_of(self.documents[doc]):
+            self.postings[key].discard(doc)
+        self.documents[doc] = None
+
+    def index(self, index, body, id=None, **kwargs):  # pylint: disable=redefined-builtin
+        '''
+            Index one document
+        '''
+        source = json.loads(body) if isinstance(body, (str, bytes)) else body
+        self.write(index, id, source)
+        self.clear_cache()
+        return {"_index": index, "_id": str(id), "result": "created"}
+
+    def delete(self, index, id, **kwargs):  # pylint: disable=redefined-builtin
+        '''
+            Delete one document, status 404 when it does not exist
+        '''
+        try:
+            self.remove(index, id)
+        except NotFoundError:
+            return {"_index": index, "_id": str(id), "result": "not_found", "status": 404}
+        self.clear_cache()
+        return {"_index": index, "_id": str(id), "result": "deleted"}
+
+    def write(self, index, doc_id, source):
+        '''
+            Store a document without dropping the caches
+        '''
+        if index == GIF_INDEX:
+            self.add_document(dict(source, id=int(doc_id if doc_id is not None else source["id"])))
+        else:
+            self.indexes.setdefault(index, []).append(source)
+
+    def remove(self, index, doc_id):
+        '''
+            Remove a gif document without dropping the caches
+        '''
+        if index != GIF_INDEX:
+            raise NotFoundError(doc_id)
+        self.remove_document(doc_id)
+
+    def bulk(self, actions):
+        '''
+            Apply (action, metadata, source) triples of a bulk request,
+            return the items of its response
+        '''
+        items = []
+        for action, metadata, source in actions:
+            index = metadata.get("_index", GIF_INDEX)
+            doc_id = metadata.get("_id")
+            if action == "delete":
+                try:
+                    self.remove(index, doc_id)
+                    items.append({"delete": {"_index": index, "_id": doc_id, "status": 200}})
+                except NotFoundError:
+                    items.append({"delete": {"_index": index, "_id": doc_id, "status": 404, "result": "not_found"}})
+            else:
+                self.write(index, doc_id, source)
+                items.append({action: {"_index": index, "_id": doc_id, "status": 201}})
+        self.clear_cache()
+        return items
+
+    def idf(self, docs):
+        '''
+            Inverse document frequency of a posting list
+        '''
+        return math.log(1 + (len(self.positions) - len(docs) + 0.5) / (len(docs) + 0.5))
+
+    def expand(self, field, token, fuzziness):
+        '''
+            Posting lists of the terms of field matching a token
+        '''
+        if not fuzziness:
+            return [self.postings.get((field, token), set())]
+        distance = fuzzy_distance(token)
+        return [
+            docs for (posting_field, term), docs in self.postings.items()
+            if posting_field == field and abs(len(term) - len(token)) <= distance
+            and edit_distance(term, token) <= distance
+        ] or [set()]
+
+    def score(self, clause):
+        '''
+            Scores of the documents matching a clause in query context
+        '''
+        kind, spec = next(iter(clause.items()))
+        field, value = next(iter(spec.items()))
+        if kind == "term":
+            boost = 1.0
+            if isinstance(value, dict):
+                boost = float(value.get("boost", 1.0))
+                value = value["value"]
+            docs = self.postings.get((field, value), set())
+            weight = self.idf(docs) * boost
+            return {doc: weight for doc in docs}
+        if kind == "match":
+            tokens = value["query"].lower().split()
+            postings = []
+            for token in tokens:
+                expanded = self.expand(field, token, value.get("fuzziness"))
+                postings.append(set().union(*expanded))
+            if not postings:
+                return {}
+            docs = set.intersection(*postings) if value.get("operator") == "and" else set.union(*postings)
+            return {doc: sum(self.idf(posting) for posting in postings if doc in posting) for doc in docs}
+        if kind == "range":
+            # a range in query context is a constant score per matching doc
+            return {doc: 1.0 for doc in self.range_docs(field, value)}
+        if kind == "terms_set":
+            candidates = set().union(*(self.postings.get((field, term), set()) for term in value["terms"]))
+            scores = {}
+            for doc in candidates:
+                # the minimum_should_match script runs for every candidate
+                required = int(value["minimum_should_match_script"]["source"])
+                matched = [term for term in value["terms"] if doc in self.postings.get((field, term), ())]
+                if len(matched) >= required:
+                    scores[doc] = sum(self.idf(self.postings[(field, term)]) for term in matched)
+            return scores
+        raise ValueError(f"unsupported clause {kind}")
+
+    def range_docs(self, field, bounds):
+        '''
+            Documents with field inside bounds
+        '''
+        low = bounds.get("gte", -math.inf)
+        high = bounds.get("lte", math.inf)
+        return {
+            doc for doc, document in enumerate(self.documents)
+            if document is not None and low <= document[field] <= high
+        }
+
+    def filter(self, clause):
+        '''
+            Documents matching a clause in filter context, cached
+        '''
+        key = json.dumps(clause, sort_keys=True)
+        if key in self.filter_cache:
+            self.filter_cache.move_to_end(key)
+            return self.filter_cache[key]
+        kind, spec = next(iter(clause.items()))
+        field, value = next(iter(spec.items()))
+        if kind == "term":
+            docs = frozenset(self.postings.get((field, value), ()))
+        elif kind == "range":
+            docs = frozenset(self.range_docs(field, value))
+        else:
+            docs = frozenset(self.score(clause))
+        self.filter_cache[key] = docs
+        if len(self.filter_cache) > MAX_CACHED_FILTERS:
+            self.filter_cache.popitem(last=False)
+        return docs
+
+    def run_query(self, query):
+        '''
+            Scores of the documents matching a bool query
+        '''
+        query = query["bool"]
+        scores = None
+        for clause in query.get("must", []):
+            clause_scores = self.score(clause)
+            if scores is None:
+                scores = clause_scores
+            else:
+                scores = {doc: score + clause_scores[doc] for doc, score in scores.items() if doc in clause_scores}
+        if query.get("should"):
+            # without must or filter at least one should clause matches
+            should_scores = {}
+            for clause in query["should"]:
+                for doc, score in self.score(clause).items():
+                    should_scores[doc] = should_scores.get(doc, 0.0) + score
+            if scores is None and not query.get("filter"):
+                scores = should_scores
+            elif scores is not None:
+                scores = {doc: score + should_scores.get(doc, 0.0) for doc, score in scores.items()}
+        for clause in sorted(query.get("filter", []), key=lambda clause: len(self.filter(clause))):
+            docs = self.filter(clause)
+            if scores is None:
+                scores = dict.fromkeys(docs, 0.0)
+            else:
+                scores = {doc: score for doc, score in scores.items() if doc in docs}
+        if scores is None:
+            scores = dict.fromkeys(self.positions.values(), 1.0)
+        return scores
+
+    def suggest(self, suggesters):
+        '''
+            Options of completion and phrase suggesters. The completion
+            field is fed from the title, as the suggest field of the
+            gif mapping is.
+        '''
+        response = {}
+        for name, spec in suggesters.items():
+            if "completion" in spec:
+                prefix = spec.get("prefix", "").lower()
+                size = spec["completion"].get("size", DEFAULT_SUGGEST_SIZE)
+                options = []
+                seen = set()
+                for document in self.documents:
+                    if document is None or not document["title"].lower().startswith(prefix):
+                        continue
+                    if spec["completion"].get("skip_duplicates") and document["title"] in seen:
+                        continue
+                    seen.add(document["title"])
+                    options.append({
+                        "text": document["title"],
+                        "_id": str(document["id"]),
+                        "_source": dict(document, suggest=document["title"]),
+                    })
+                    if len(options) == size:
+                        break
+                response[name] = [{"text": spec.get("prefix", ""), "options": options}]
+            elif "phrase" in spec:
+                response[name] = [{"text": spec.get("text", ""), "options": self.correct(spec)}]
+            else:
+                raise ValueError(f"unsupported suggester {name}")
+        return response
+
+    def correct(self, spec):
+        '''
+            Phrase suggester options: unknown tokens replaced by their
+            closest terms of the field
+        '''
+        field = spec["phrase"]["field"]
+        vocabulary = {term for posting_field, term in self.postings if posting_field == field}
+        tokens = spec.get("text", "").lower().split()
+        corrected = []
+        for token in tokens:
+            if token in vocabulary:
+                corrected.append(token)
+                continue
+            close = difflib.get_close_matches(token, vocabulary, n=1, cutoff=0.6)
+            corrected.append(close[0] if close else token)
+        if corrected == tokens:
+            return []
+        return [{"text": " ".join(corrected), "score": 1.0}]
+
+    def aggregate(self, index, aggs):
+        '''
+            Buckets of terms aggregations over an index
+        '''
+        documents = self.indexes.get(index, []) if index != GIF_INDEX else [
+            document for document in self.documents if document is not None
+        ]
+        response = {}
+        for name, spec in aggs.items():
+            terms = spec["terms"]
+            counts = Counter(
+                document[terms["field"]] for document in documents if terms["field"] in document
+            )
+            response[name] = {"buckets": [
+                {"key": key, "doc_count": count}
+                for key, count in counts.most_common(terms.get("size", 10))
+            ]}
+        return response
+
+    def search(self, index, body, size=None, request_cache=None, **kwargs):
+        '''
+            Sorted hits of a search body, see run_search
+        '''
+        key = None
+        if request_cache:
+            key = json.dumps([index, body, size], sort_keys=True)
+            if key in self.response_cache:
+                self.response_cache.move_to_end(key)
+                return self.response_cache[key]
+        response = {}
+        count = body.get("size", size if size is not None else 10)
+        if "query" in body or ("suggest" not in body and "aggs" not in body):
+            scores = self.run_query(body["query"]) if "query" in body else dict.fromkeys(self.positions.values(), 1.0)
+            # sorted by _score desc then id asc, as run_search asks
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], self.documents[item[0]]["id"]))
+            if "search_after" in body:
+                after = (-body["search_after"][0], body["search_after"][1])
+                ranked = [item for item in ranked if (-item[1], self.documents[item[0]]["id"]) > after]
+            start = body.get("from", 0)
+            hits = []
+            for doc, score in ranked[start:start + count]:
+                document = self.documents[doc]
+                hit = {"_id": str(document["id"]), "_score": score, "sort": [score, document["id"]]}
+                if body.get("_source", True) is not False:
+                    hit["_source"] = document
+                hits.append(hit)
+            response["hits"] = {"total": {"value": len(ranked)}, "hits": hits}
+        else:
+            response["hits"] = {"total": {"value": 0}, "hits": []}
+        if "suggest" in body:
+            response["suggest"] = self.suggest(body["suggest"])
+        if "aggs" in body:
+            response["aggregations"] = self.aggregate(index, body["aggs"])
+        if key is not None:
+            self.response_cache[key] = response
+            if len(self.response_cache) > MAX_CACHED_RESPONSES:
+                self.response_cache.popitem(last=False)
+        return response
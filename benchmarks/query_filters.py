@@ -0,0 +1,120 @@
+'''
+    Micro-benchmark of the search bodies before and after compile_query:
+    every clause in bool.must with a terms_set for tags, against filters
+    in bool.filter with one term per tag and the request cache.
+
+    Run from the repository root, no elastic search needed:
+
+        python -m benchmarks.query_filters --documents 50000 --requests 2000
+'''
+import time
+import random
+import argparse
+import statistics
+from main.search import compile_query
+from .es_standin import StandInElasticsearch, generate_corpus, WORDS, CATEGORIES, TAGS
+
+
+def legacy_query(request, match=None):
+    '''
+        Search body as the search modes built it before compile_query
+    '''
+    must_array = [match] if match is not None else []
+    must_array += request["filter"]
+    if request["category"] != "":
+        must_array.append({"term": {"category.keyword": request["category"]}})
+    tags = request["tags"]
+    if tags:
+        must_array.append({"terms_set": {
+            "tags.keyword": {
+                "terms": tags,
+                "minimum_should_match_script": {
+                    "source": str(len(tags))
+                }
+            }
+        }})
+    return {"query": {"bool": {"must": must_array}}}
+
+
+def generate_requests(count, combinations, seed=0):
+    '''
+        Partial title searches drawn from a fixed number of keyword
+        and filter combinations, repeated like real traffic
+    '''
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(combinations):
+        request = {
+            "target": "title",
+            "keyword": rng.choice(WORDS),
+            "category": rng.choice(CATEGORIES + [""]),
+            "filter": [],
+            "tags": rng.sample(TAGS, rng.randint(0, 2)),
+        }
+        if rng.random() < 0.5:
+            low = rng.randint(100, 500)
+            request["filter"].append({"range": {"width": {"gte": low, "lte": low + 400}}})
+        if rng.random() < 0.3:
+            request["filter"].append({"range": {"duration": {"gte": 0, "lte": rng.randint(2, 10)}}})
+        pool.append(request)
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def run(client, requests, build, request_cache):
+    '''
+        Milliseconds per first-page search and the hit totals
+    '''
+    latencies = []
+    totals = []
+    for request in requests:
+        match = {"match": {"title": {"query": request["keyword"], "operator": "and"}}}
+        body = build(request, match)
+        started = time.perf_counter()
+        response = client.search(index="gif", body=body, size=20, request_cache=request_cache)
+        latencies.append((time.perf_counter() - started) * 1000)
+        totals.append(response["hits"]["total"]["value"])
+    return latencies, totals
+
+
+def percentile(values, fraction):
+    '''
+        Nearest-rank percentile
+    '''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    '''
+        Run both bodies over the same requests and print the latencies
+    '''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--combinations", type=int, default=200,
+                        help="distinct keyword and filter combinations")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    client = StandInElasticsearch(generate_corpus(options.documents, options.seed))
+    requests = generate_requests(options.requests, options.combinations, options.seed)
+
+    legacy_latencies, legacy_totals = run(client, requests, legacy_query, None)
+    client.clear_cache()
+    compiled_latencies, compiled_totals = run(client, requests, compile_query, True)
+    mismatches = sum(1 for legacy, compiled in zip(legacy_totals, compiled_totals) if legacy != compiled)
+
+    print(f"{options.documents} documents, {options.requests} requests, {options.combinations} combinations")
+    for name, latencies in (("must + terms_set", legacy_latencies), ("filter + request cache", compiled_latencies)):
+        print(
+            f"{name:>24}: mean {statistics.mean(latencies):8.3f} ms"
+            f"  p50 {percentile(latencies, 0.5):8.3f} ms"
+            f"  p99 {percentile(latencies, 0.99):8.3f} ms"
+        )
+    print(f"speedup (mean): {statistics.mean(legacy_latencies) / statistics.mean(compiled_latencies):.1f}x")
+    if mismatches:
+        print(f"warning: {mismatches} searches matched a different number of gifs")
+
+
+if __name__ == "__main__":
+    main()
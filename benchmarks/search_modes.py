@@ -0,0 +1,186 @@
+'''
+    Latency and throughput of every search mode of ElasticSearchEngine
+    and of the image_search view, against the HTTP stand-in of elastic
+    search: the real client and engine code run, no cluster or network
+    access needed.
+
+    Run from the repository root:
+
+        python -m benchmarks.search_modes --documents 100000 --requests 500 --concurrency 4
+
+    The corpus (10k to 1M gifs) is loaded through the bulk endpoint,
+    which is timed too, and written to a throwaway test database for
+    the view to hydrate. Requests are drawn from a fixed number of
+    keyword and filter combinations, so the view sees search cache hits
+    as it would in production.
+'''
+import os
+import time
+import random
+import argparse
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .es_standin import StandInElasticsearch, generate_corpus, TAGS
+from .es_server import StandInServer
+from .query_filters import generate_requests, percentile
+
+# documents per bulk request and rows per database insert
+BULK_CHUNK = 5000
+DB_CHUNK = 5000
+
+
+def misspell(word):
+    '''
+        Word with its first two letters swapped
+    '''
+    return word[1] + word[0] + word[2:] if len(word) > 1 else word
+
+
+MODES = {
+    "perfect": lambda engine, request: engine.search_perfect(request),
+    "partial": lambda engine, request: engine.search_partial(request),
+    "related": lambda engine, request: engine.search_related(request),
+    "fuzzy": lambda engine, request: engine.search_fuzzy(dict(request, keyword=misspell(request["keyword"]))),
+    "partial page 3": lambda engine, request: engine.search_partial(request, page=2, size=20),
+    "suggest": lambda engine, request: engine.suggest_search(request["keyword"][:2]),
+    "correct": lambda engine, request: engine.correct_search(misspell(request["keyword"]), "title"),
+    "suggest + correct": lambda engine, request: engine.suggest_and_correct(misspell(request["keyword"]), "title"),
+    "personalization": lambda engine, request: engine.personalization_search(request["tag_fre"]),
+    "hotwords": lambda engine, request: engine.hotwords_search(),
+}
+
+
+def setup_django(url):
+    '''
+        Point the settings at the stand-in and create the test database
+    '''
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "GifExplorer.settings")
+    os.environ["ELASTICSEARCH_HOSTS"] = url
+    os.environ["SEARCH_BACKEND"] = "main.search.ElasticSearchEngine"
+    import django  # pylint: disable=import-outside-toplevel
+    django.setup()
+    from django.db import connection  # pylint: disable=import-outside-toplevel
+    connection.creation.create_test_db(verbosity=0)
+
+
+def load_corpus(engine, corpus):
+    '''
+        Write the gifs to the database and index them in bulk,
+        return the documents indexed per second
+    '''
+    from main.models import UserInfo, GifMetadata  # pylint: disable=import-outside-toplevel
+    uploaders = sorted({document["uploader"] for document in corpus})
+    UserInfo.objects.bulk_create([UserInfo(user_name=name, password="", salt="") for name in uploaders])
+    user_ids = dict(UserInfo.objects.values_list("user_name", "id"))
+    for start in range(0, len(corpus), DB_CHUNK):
+        GifMetadata.objects.bulk_create([
+            GifMetadata(
+                id=document["id"], title=document["title"], uploader=user_ids[document["uploader"]],
+                category=document["category"], tags=document["tags"], width=document["width"],
+                height=document["height"], duration=document["duration"]
+            )
+            for document in corpus[start:start + DB_CHUNK]
+        ])
+    started = time.perf_counter()
+    for start in range(0, len(corpus), BULK_CHUNK):
+        engine.bulk_post_metadata([dict(document) for document in corpus[start:start + BULK_CHUNK]])
+    return len(corpus) / (time.perf_counter() - started)
+
+
+def measure(func, items, concurrency):
+    '''
+        Milliseconds of func on each item and the items served per
+        second, from concurrency threads
+    '''
+    def call(item):
+        started = time.perf_counter()
+        func(item)
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(call, items))
+    else:
+        latencies = [call(item) for item in items]
+    return latencies, len(items) / (time.perf_counter() - started)
+
+
+def view_search(local):
+    '''
+        POST /image/search with a client per thread
+    '''
+    from django.test import Client  # pylint: disable=import-outside-toplevel
+
+    def search(request):
+        if not hasattr(local, "client"):
+            local.client = Client()
+        body = {key: request[key] for key in ("target", "keyword", "category", "filter", "tags")}
+        response = local.client.post(
+            "/image/search", dict(body, type="partial", page=1), content_type="application/json"
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"image_search answered {response.status_code}: {response.content[:200]}")
+    return search
+
+
+def report(name, latencies, throughput):
+    '''
+        Print one line of results
+    '''
+    print(
+        f"{name:>20}: p50 {percentile(latencies, 0.5):8.3f} ms"
+        f"  p99 {percentile(latencies, 0.99):8.3f} ms"
+        f"  mean {statistics.mean(latencies):8.3f} ms"
+        f"  {throughput:9.1f} req/s"
+    )
+
+
+def main():
+    '''
+        Load the corpus, then run every mode and the view
+    '''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=500, help="requests per mode")
+    parser.add_argument("--combinations", type=int, default=200,
+                        help="distinct keyword and filter combinations")
+    parser.add_argument("--concurrency", type=int, default=1, help="threads sending requests")
+    parser.add_argument("--modes", nargs="*", default=list(MODES) + ["image_search"],
+                        choices=list(MODES) + ["image_search"])
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    server = StandInServer(StandInElasticsearch([])).start()
+    setup_django(server.url)
+    from main import config  # pylint: disable=import-outside-toplevel
+    engine = config.SEARCH_ENGINE
+
+    corpus = generate_corpus(options.documents, options.seed)
+    indexed = load_corpus(engine, corpus)
+    rng = random.Random(options.seed)
+    requests = generate_requests(options.requests, options.combinations, options.seed)
+    for request in requests:
+        request["tag_fre"] = {tag: rng.randint(1, 10) for tag in rng.sample(TAGS, 3)}
+
+    print(f"{options.documents} documents, {options.requests} requests per mode, "
+          f"{options.combinations} combinations, {options.concurrency} thread(s)")
+    print(f"{'bulk index':>20}: {indexed:9.1f} docs/s")
+    for name in options.modes:
+        if name == "hotwords":
+            # searched keywords reach message_index through the search log
+            engine.search_log.flush()
+        if name == "image_search":
+            config.SEARCH_CACHE.clear()
+            latencies, throughput = measure(view_search(threading.local()), requests, options.concurrency)
+        else:
+            latencies, throughput = measure(
+                lambda request, mode=MODES[name]: mode(engine, request), requests, options.concurrency
+            )
+        report(name, latencies, throughput)
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete, post_migrate
 
 
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel
+        from . import trigram
+        from .models import GifMetadata, UserInfo
+        post_save.connect(trigram.gif_saved, sender=GifMetadata, dispatch_uid="trigram_gif_saved")
+        post_delete.connect(trigram.gif_deleted, sender=GifMetadata, dispatch_uid="trigram_gif_deleted")
+        post_save.connect(trigram.user_saved, sender=UserInfo, dispatch_uid="trigram_user_saved")
+        post_migrate.connect(trigram.create_trigram_indexes, sender=self, dispatch_uid="trigram_indexes")
@@ -0,0 +1,77 @@
+'''
+    In-process indexes built from the database in a background thread
+'''
+import time
+import threading
+from abc import ABC, abstractmethod
+from django.db import connection
+
+# seconds before a failed build is tried again
+RETRY_DELAY = 30
+
+
+class BackgroundIndex(ABC):
+    '''
+        Base of indexes kept in each worker. The first query starts a
+        build in a daemon thread and gets None until it is done, later
+        queries start a rebuild every rebuild_interval seconds.
+
+        Subclasses implement load(), which reads the database and swaps
+        the new index in under self.lock, then calls mark_built().
+    '''
+    def __init__(self, rebuild_interval):
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock()
+        self.ready = False
+        self.built_at = None
+        self.retry_at = 0
+        self.building = False
+
+    @abstractmethod
+    def load(self):
+        '''
+            Build the index from the database
+        '''
+
+    def mark_built(self):
+        '''
+            Record a finished build, call it holding self.lock
+        '''
+        self.ready = True
+        self.built_at = time.monotonic()
+
+    def expire(self):
+        '''
+            Make the next query start a rebuild
+        '''
+        with self.lock:
+            self.built_at = None
+
+    def rebuild_from_database(self):
+        '''
+            Run load(), in the background thread
+        '''
+        try:
+            self.load()
+        except Exception as error:  # pylint: disable=broad-except
+            print(error)
+            self.retry_at = time.monotonic() + RETRY_DELAY
+        finally:
+            self.building = False
+            connection.close()
+
+    def ensure_fresh(self):
+        '''
+            Start a background rebuild when there is no build yet
+            or the last one is older than rebuild_interval
+        '''
+        with self.lock:
+            stale = self.built_at is None or time.monotonic() - self.built_at > self.rebuild_interval
+            if not stale or self.building or time.monotonic() < self.retry_at:
+                return
+            self.building = True
+        threading.Thread(
+            target=self.rebuild_from_database,
+            name=f"{type(self).__name__}-rebuild",
+            daemon=True
+        ).start()
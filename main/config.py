@@ -1,8 +1,14 @@
 '''
     configure for the app
 '''
-from GifExplorer.settings import DEBUG
-from .search import ElasticSearchEngine
+from django.utils.module_loading import import_string
+from GifExplorer.settings import DEBUG, SEARCH_BACKEND, SEARCH_CACHE_BACKEND, SEARCH_CACHE_ALIAS, HOTWORDS_SNAPSHOT, RELATED_GIFS_PATH, SINGLE_FLIGHT_CACHE_ALIAS
+from .search_cache import create_search_cache
+from .hotwords import HotWords
+from .suggest import PrefixSuggester
+from .spelling import SpellingCorrector
+from .related import RelatedGifs
+from .singleflight import SingleFlight
 
 if not DEBUG:
     USER_VERIFICATION_MAX_TIME = 300
@@ -24,19 +30,44 @@ if not DEBUG:
 else:
     CACHE_MAX_TIME = 10
 
+if not DEBUG:
+    CACHE_PIN_TIME = 600
+else:
+    CACHE_PIN_TIME = 30
+
 MAX_GIFS_PER_PAGE = 20
 
 MAX_USERS_PER_PAGE = 10
 
 MAX_MESSAGES_PER_PAGE = 50
 
+# largest page of a cursor paginated listing, see main/pagination.py
+MAX_LISTING_SIZE = 200
+
 MAX_SEARCH_HISTORY = 200
 
 MAX_CACHE_HISTORY = 500
 
-CACHE_HISTORY = {}
+MAX_PINNED_SEARCHES = 100
+
+SEARCH_CACHE = create_search_cache(
+    SEARCH_CACHE_BACKEND, SEARCH_CACHE_ALIAS, MAX_CACHE_HISTORY, CACHE_MAX_TIME,
+    MAX_PINNED_SEARCHES, CACHE_PIN_TIME
+)
+
+SEARCH_ENGINE = import_string(SEARCH_BACKEND)()
+
+HOT_WORDS = HotWords(HOTWORDS_SNAPSHOT)
+
+TITLE_SUGGESTER = PrefixSuggester()
+
+SPELLING_CORRECTOR = SpellingCorrector()
+
+RELATED_GIFS = RelatedGifs(RELATED_GIFS_PATH)
+
+MAX_RELATED_GIFS = 20
 
-SEARCH_ENGINE = ElasticSearchEngine()
+SINGLE_FLIGHT = SingleFlight(SINGLE_FLIGHT_CACHE_ALIAS)
 
 SECRET_KEY = "Welcome to the god damned SE world!"
 
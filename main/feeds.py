@@ -0,0 +1,180 @@
+'''
+    Precomputed personalization feeds - a ranked gif id list per user
+    kept in the feeds cache and refreshed by manage.py refresh_feeds
+'''
+import datetime
+import logging
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, Q
+from django.utils import timezone
+from . import config
+from . import search_outbox
+from .helpers import get_user_tags
+from .models import UserInfo, GifMetadata, GifLike, UserFeed
+from .metrics import timed
+from .serializers import load_gifs, serialize_gifs, FEED_CARD
+
+# ranked gif ids kept per user
+FEED_SIZE = 100
+
+# gifs returned by the personalize endpoint
+FEED_PAGE_SIZE = 10
+
+# users who did not open their feed for this long are not refreshed
+ACTIVE_WINDOW = datetime.timedelta(days=7)
+
+# seconds between two writes of the last time a user opened the feed
+SEEN_INTERVAL = 3600
+
+REFRESH_BATCH_SIZE = 200
+
+# seconds before a feed whose refresh failed is tried again, doubled
+# after every failure in a row up to REFRESH_MAX_BACKOFF
+REFRESH_BACKOFF = 60
+
+REFRESH_MAX_BACKOFF = 3600
+
+# seconds an empty feed is kept, it is computed again after that
+# instead of waiting for the next refresh_feeds run
+EMPTY_FEED_TIMEOUT = 60
+
+# latest favorites and reads whose related gifs join the feed
+MAX_SEEDS = 20
+
+# rank offset of reciprocal rank fusion
+FUSION_OFFSET = 60
+
+logger = logging.getLogger(__name__)
+
+
+def feed_cache():
+    '''
+        Cache holding the feeds
+    '''
+    return caches[settings.FEED_CACHE_ALIAS]
+
+
+def feed_key(user_id):
+    '''
+        Cache key of the feed of a user
+    '''
+    return f"feed:{user_id}"
+
+
+def store_feed(user_id, entry):
+    '''
+        Cache the feed entry of a user, for good unless it is empty
+    '''
+    feed_cache().set(feed_key(user_id), entry, None if entry["ids"] else EMPTY_FEED_TIMEOUT)
+
+
+def seed_gifs(user: UserInfo):
+    '''
+        Ids of the latest gifs a user liked or read
+    '''
+    liked = GifLike.objects.filter(user=user).order_by("-created", "-id").values_list("gif_id", "created")
+    # read times are stored as local time strings
+    touched = {
+        **(user.read_history or {}),
+        **{str(gif_id): str(timezone.localtime(created).replace(tzinfo=None)) for gif_id, created in liked[:MAX_SEEDS]}
+    }
+    latest = sorted(touched.items(), key=lambda item: item[1], reverse=True)
+    return [int(gif_id) for gif_id, _ in latest if str(gif_id).isdecimal()][:MAX_SEEDS]
+
+
+def compute_feed(user: UserInfo):
+    '''
+        Ranked gif ids for a user, the tag ranking fused with the gifs
+        related to the ones they liked or read (reciprocal rank fusion)
+    '''
+    search_outbox.start()
+    hits = config.SEARCH_ENGINE.personalization_search(get_user_tags(user))
+    rankings = [
+        [int(gif_id) for gif_id in hits[:FEED_SIZE]],
+        config.RELATED_GIFS.blend(seed_gifs(user), FEED_SIZE),
+    ]
+    scores = {}
+    for ranking in rankings:
+        for rank, gif_id in enumerate(ranking):
+            scores[gif_id] = scores.get(gif_id, 0.0) + 1.0 / (FUSION_OFFSET + rank)
+    return sorted(scores, key=lambda gif_id: (-scores[gif_id], gif_id))[:FEED_SIZE]
+
+
+def refresh_feed(user: UserInfo, seen=False):
+    '''
+        Compute and store the feed of a user, seen marks that the
+        user is opening it right now
+    '''
+    ids = compute_feed(user)
+    now = timezone.now()
+    defaults = {"stale": False, "refreshed_at": now, "failures": 0, "retry_at": None}
+    if seen:
+        defaults["last_seen"] = now
+    UserFeed.objects.update_or_create(user_id=user.id, defaults=defaults)
+    seen_at = now if seen else feed_cache().get(feed_key(user.id), {}).get("seen_at", now)
+    store_feed(user.id, {"ids": ids, "seen_at": seen_at})
+    return ids
+
+
+@timed("feed")
+def get_feed(user: UserInfo):
+    '''
+        Ranked gif ids of a user, computed on the spot for users who
+        have none yet. The stored list is served even when stale,
+        the next refresh_feeds run replaces it.
+    '''
+    entry = feed_cache().get(feed_key(user.id))
+    if entry is None:
+        return refresh_feed(user, seen=True)
+    now = timezone.now()
+    if (now - entry["seen_at"]).total_seconds() > SEEN_INTERVAL:
+        UserFeed.objects.filter(user_id=user.id).update(last_seen=now)
+        entry["seen_at"] = now
+        store_feed(user.id, entry)
+    return entry["ids"]
+
+
+def refresh_stale_feeds(batch_size=REFRESH_BATCH_SIZE):
+    '''
+        Refresh up to batch_size stale feeds of active users, most
+        recently seen first; returns how many were tried. A failed
+        refresh is logged and its feed stays stale, it is not tried
+        again before a backoff doubled after each failure.
+    '''
+    now = timezone.now()
+    user_ids = list(
+        UserFeed.objects
+        .filter(stale=True, last_seen__gte=now - ACTIVE_WINDOW)
+        .filter(Q(retry_at__isnull=True) | Q(retry_at__lte=now))
+        .order_by("-last_seen")
+        .values_list("user_id", flat=True)[:batch_size]
+    )
+    users = UserInfo.objects.only("id", "tags", "read_history").in_bulk(user_ids)
+    for user_id in user_ids:
+        if user_id not in users:
+            UserFeed.objects.filter(user_id=user_id).delete()
+            continue
+        try:
+            refresh_feed(users[user_id])
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Refreshing the feed of user %s failed", user_id)
+            feed = UserFeed.objects.filter(user_id=user_id)
+            failures = feed.values_list("failures", flat=True).first() or 0
+            backoff = min(REFRESH_BACKOFF * 2 ** failures, REFRESH_MAX_BACKOFF)
+            feed.update(failures=F("failures") + 1,
+                        retry_at=timezone.now() + datetime.timedelta(seconds=backoff))
+    return len(user_ids)
+
+
+@timed("hydrate")
+def hydrate_feed(ids, count=FEED_PAGE_SIZE, viewer=None):
+    '''
+        Cards of the first count existing gifs of ids, in feed order;
+        one query, a second one when most of the first ids are gone.
+        With a viewer the cards say which gifs the viewer liked.
+    '''
+    found = load_gifs(ids[:count * 2])
+    if len(found) < count and len(ids) > count * 2:
+        found += load_gifs(ids[count * 2:])
+    return serialize_gifs(found[:count], FEED_CARD, viewer=viewer)
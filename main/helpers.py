@@ -3,6 +3,7 @@
 '''
 import hashlib
 import io
+import json
 import re
 import base64
 import datetime
@@ -11,11 +12,18 @@ from functools import wraps
 import magic
 from PIL import Image
 import jwt
-from django.db.models import Q
+from django.db import transaction, IntegrityError
+from django.db.models import Q, F
 from django.utils.crypto import get_random_string
 from utils.utils_request import internal_error
-from .config import MAX_GIFS_PER_PAGE, MAX_USERS_PER_PAGE, MAX_MESSAGES_PER_PAGE, MAX_SEARCH_HISTORY, SECRET_KEY, SEARCH_ENGINE
-from .models import UserInfo, UserToken, GifMetadata, GifFingerprint, Message
+from .config import MAX_GIFS_PER_PAGE, MAX_USERS_PER_PAGE, MAX_MESSAGES_PER_PAGE, MAX_LISTING_SIZE, MAX_SEARCH_HISTORY, SECRET_KEY, SEARCH_ENGINE, SEARCH_CACHE
+from .models import UserInfo, UserToken, GifMetadata, GifComment, GifFingerprint, Message, UserFeed, Follow, GifLike, CommentLike
+from .search import SearchHits, MAX_HITS
+from .resilience import ServiceUnavailable
+from .search_outbox import enqueue_index, enqueue_delete
+from .metrics import timed
+from .serializers import serialize_gifs, serialize_users, SEARCH_CARD, USER_CARD_COLUMNS
+from .pagination import cursor_params, paginate_pairs, paginate_queryset
 
 def handle_errors(view_func):
     '''
@@ -114,6 +122,7 @@ def add_token_to_white_list(token):
         user_token = UserToken(user_id=user_id, token=token)
         user_token.save()
 
+@timed("auth")
 def is_token_valid(token):
     '''
         Check user's token in white list
@@ -161,12 +170,14 @@ def get_user_read_history(user: UserInfo):
     """
     if not user.read_history:
         user.read_history = {}
-    read_history_dict = {}
-    for key in user.read_history:
-        gif = GifMetadata.objects.filter(id=int(key)).first()
-        if gif:
-            read_history_dict[key] = user.read_history[key]
-    read_history_list = list(read_history_dict.items())
+    existing = set(
+        GifMetadata.objects
+        .filter(id__in=[int(key) for key in user.read_history])
+        .values_list("id", flat=True)
+    ) if user.read_history else set()
+    read_history_list = [
+        (key, read_time) for key, read_time in user.read_history.items() if int(key) in existing
+    ]
 
     read_history_list = sorted(read_history_list, key=lambda x: x[1], reverse=True)
     return read_history_list
@@ -182,103 +193,175 @@ def show_user_read_history_pages(user: UserInfo, page: int):
     read_history_list = get_user_read_history(user)
     read_history_page = read_history_list[begin:end]
 
+    cards = serialize_gifs([gif_id for gif_id, _ in read_history_page], viewer=user)
+    cards = {card["id"]: card for card in cards}
     gif_list = []
     for gif_id, read_time in read_history_page:
-        gif = GifMetadata.objects.filter(id=int(gif_id)).first()
-        user = UserInfo.objects.filter(id=gif.uploader).first()
-        if gif:
+        if int(gif_id) in cards:
             gif_list.append({
-                "data": {
-                    "id": gif.id,
-                    "name": gif.name,
-                    "title": gif.title,
-                    "width": gif.width,
-                    "height": gif.height,
-                    "duration": gif.duration,
-                    "uploader": user.user_name,
-                    "uploader_id": user.id,
-                    "category": gif.category,
-                    "tags": gif.tags,
-                    "like": gif.likes,
-                    "pub_time": gif.pub_time
-                },
+                "data": cards[int(gif_id)],
                 "visit_time": read_time
             })
     return gif_list, math.ceil(len(read_history_list) / MAX_GIFS_PER_PAGE)
 
 def get_user_followers(user: UserInfo):
-    """
-        get followers list from a user
-    """
-    if not user.followers:
-        user.followers = {}
-    read_followers_list = list(user.followers.items())
-    read_followers_list = sorted(read_followers_list, key=lambda x: x[1], reverse=True)
-    return read_followers_list
+    '''
+        Follow edges to a user, newest first, each with its follower
+        joined in; one indexed query
+    '''
+    return Follow.objects.filter(followee=user).select_related("follower").only(
+        "created", *(f"follower__{column}" for column in USER_CARD_COLUMNS)
+    ).order_by("-created", "-id")
 
 def show_user_followers(user: UserInfo, page: int):
     '''
         Show user followers pages
     '''
-    if not user.followers:
+    if not user.follower_count:
         return [], 0
     begin = page * MAX_USERS_PER_PAGE
     end = (page + 1) * MAX_USERS_PER_PAGE
-    followers_list = get_user_followers(user)
-    followers_page = followers_list[begin:end]
-
-    user_followers_list = []
-    for user_id, _ in followers_page:
-        user = UserInfo.objects.filter(id=int(user_id)).first()
-        if user:
-            user_followers_list.append({
-                "id": user.id,
-                "user_name": user.user_name,
-                "signature": user.signature,
-                "mail": user.mail,
-                "avatar": user.avatar,
-                "followers": len(user.followers),
-                "following": len(user.followings),
-                "register_time": user.register_time
-            })
-    return user_followers_list, math.ceil(len(followers_list) / MAX_USERS_PER_PAGE)
+    followers_page = get_user_followers(user)[begin:end]
+
+    user_followers_list = serialize_users([edge.follower for edge in followers_page])
+    return user_followers_list, math.ceil(user.follower_count / MAX_USERS_PER_PAGE)
 
 def get_user_followings(user: UserInfo):
-    """
-        get followings list from a user
-    """
-    if not user.followings:
-        user.followings = {}
-    read_followings_list = list(user.followings.items())
-    read_followings_list = sorted(read_followings_list, key=lambda x: x[1], reverse=True)
-    return read_followings_list
+    '''
+        Follow edges from a user, newest first, each with the followed
+        user joined in; one indexed query
+    '''
+    return Follow.objects.filter(follower=user).select_related("followee").only(
+        "created", *(f"followee__{column}" for column in USER_CARD_COLUMNS)
+    ).order_by("-created", "-id")
 
 def show_user_followings(user: UserInfo, page: int):
     '''
         Show user followings pages
     '''
-    if not user.followings:
+    if not user.following_count:
         return [], 0
     begin = page * MAX_USERS_PER_PAGE
     end = (page + 1) * MAX_USERS_PER_PAGE
-    followings_list = get_user_followings(user)
-    followings_page = followings_list[begin:end]
-
-    user_followings_list = []
-    for user_id, _ in followings_page:
-        user = UserInfo.objects.filter(id=int(user_id)).first()
-        if user:
-            user_followings_list.append({
-                "id": user.id,
-                "user_name": user.user_name,
-                "signature": user.signature,
-                "mail": user.mail,
-                "avatar": user.avatar,
-                "followers": len(user.followers),
-                "following": len(user.followings),
-                "register_time": user.register_time
-            })
-    return user_followings_list, math.ceil(len(followings_list) / MAX_USERS_PER_PAGE)
+    followings_page = get_user_followings(user)[begin:end]
+
+    user_followings_list = serialize_users([edge.followee for edge in followings_page])
+    return user_followings_list, math.ceil(user.following_count / MAX_USERS_PER_PAGE)
+
+def show_followers_cursor_page(user: UserInfo, params):
+    '''
+        Cursor page of the followers of a user, raise InvalidCursor
+    '''
+    cursor, size, count = cursor_params(params, MAX_USERS_PER_PAGE, MAX_LISTING_SIZE)
+    page = paginate_queryset(get_user_followers(user), cursor, size, time_field="created", count=count)
+    return page.response(serialize_users([edge.follower for edge in page.items]))
+
+def show_followings_cursor_page(user: UserInfo, params):
+    '''
+        Cursor page of the users a user follows, raise InvalidCursor
+    '''
+    cursor, size, count = cursor_params(params, MAX_USERS_PER_PAGE, MAX_LISTING_SIZE)
+    page = paginate_queryset(get_user_followings(user), cursor, size, time_field="created", count=count)
+    return page.response(serialize_users([edge.followee for edge in page.items]))
+
+def insert_unique(model, **fields):
+    '''
+        Insert a row guarded by a unique constraint, False when it
+        exists. The insert runs in a savepoint, so losing a race with a
+        concurrent insert of the same row leaves the caller's
+        transaction usable instead of raising IntegrityError.
+    '''
+    try:
+        with transaction.atomic():
+            model.objects.create(**fields)
+    except IntegrityError:
+        return False
+    return True
+
+def follow_user(user: UserInfo, followee: UserInfo):
+    '''
+        Make user follow followee, False when it already did. The edge
+        and both counters change in one transaction, the counters with
+        F() so concurrent follows do not lose updates.
+    '''
+    with transaction.atomic():
+        created = insert_unique(Follow, follower=user, followee=followee)
+        if created:
+            UserInfo.objects.filter(id=user.id).update(following_count=F("following_count") + 1)
+            UserInfo.objects.filter(id=followee.id).update(follower_count=F("follower_count") + 1)
+    return created
+
+def unfollow_user(user: UserInfo, followee: UserInfo):
+    '''
+        Make user stop following followee, False when it did not
+    '''
+    with transaction.atomic():
+        deleted, _ = Follow.objects.filter(follower=user, followee=followee).delete()
+        if deleted:
+            UserInfo.objects.filter(id=user.id).update(following_count=F("following_count") - 1)
+            UserInfo.objects.filter(id=followee.id).update(follower_count=F("follower_count") - 1)
+    return bool(deleted)
+
+def is_following(user: UserInfo, followee_id: int):
+    '''
+        Whether user follows the user of followee_id
+    '''
+    return Follow.objects.filter(follower=user, followee_id=followee_id).exists()
+
+def like_gif(user: UserInfo, gif: GifMetadata):
+    '''
+        Record that user likes gif, False when it already did; the
+        like and the counter change in one transaction
+    '''
+    with transaction.atomic():
+        created = insert_unique(GifLike, user=user, gif=gif)
+        if created:
+            GifMetadata.objects.filter(id=gif.id).update(likes=F("likes") + 1)
+    return created
+
+def unlike_gif(user: UserInfo, gif: GifMetadata):
+    '''
+        Remove the like of user on gif, False when there was none
+    '''
+    with transaction.atomic():
+        deleted, _ = GifLike.objects.filter(user=user, gif=gif).delete()
+        if deleted:
+            GifMetadata.objects.filter(id=gif.id).update(likes=F("likes") - 1)
+    return bool(deleted)
+
+def like_comment(user: UserInfo, comment: GifComment):
+    '''
+        Record that user likes comment, False when it already did
+    '''
+    with transaction.atomic():
+        created = insert_unique(CommentLike, user=user, comment=comment)
+        if created:
+            GifComment.objects.filter(id=comment.id).update(likes=F("likes") + 1)
+    return created
+
+def unlike_comment(user: UserInfo, comment: GifComment):
+    '''
+        Remove the like of user on comment, False when there was none
+    '''
+    with transaction.atomic():
+        deleted, _ = CommentLike.objects.filter(user=user, comment=comment).delete()
+        if deleted:
+            GifComment.objects.filter(id=comment.id).update(likes=F("likes") - 1)
+    return bool(deleted)
+
+def show_read_history_cursor_page(user: UserInfo, params):
+    '''
+        Cursor page of the read history of a user, gifs deleted since
+        are left out of their page; raise InvalidCursor
+    '''
+    cursor, size, count = cursor_params(params, MAX_GIFS_PER_PAGE, MAX_LISTING_SIZE)
+    page = paginate_pairs(list((user.read_history or {}).items()), cursor, size, count)
+    cards = serialize_gifs([gif_id for gif_id, _ in page.items], viewer=user)
+    cards = {card["id"]: card for card in cards}
+    return page.response([
+        {"data": cards[int(gif_id)], "visit_time": read_time}
+        for gif_id, read_time in page.items if int(gif_id) in cards
+    ])
 
 def image_resize(image, size=(512, 512)):
     '''
@@ -304,6 +387,15 @@ def is_valid_video(file):
     mime = magic.from_buffer(file.read(1024), mime=True)
     return mime in ['video/x-matroska', 'video/mp4']
 
+@timed("hydrate")
+def hydrate_gifs(gif_ids):
+    '''
+        Search cards of ranked gif ids, in the same order, gifs gone
+        from the database are skipped; one query whatever the length,
+        see serialize_gifs
+    '''
+    return serialize_gifs(gif_ids, SEARCH_CARD)
+
 def show_search_page(gif_id_list, page: int):
     '''
         Show search page
@@ -312,47 +404,172 @@ def show_search_page(gif_id_list, page: int):
         return [], 0
     begin = page * MAX_GIFS_PER_PAGE
     end = (page + 1) * MAX_GIFS_PER_PAGE
-
-    gif_list = []
-    for gif_id in gif_id_list[begin:end]:
-        gif = GifMetadata.objects.filter(id=int(gif_id)).first()
-        if gif:
-            user = UserInfo.objects.filter(id=gif.uploader).first()
-            gif_list.append({
-                "id": gif.id,
-                "name": gif.name,
-                "title": gif.title,
-                "width": gif.width,
-                "height": gif.height,
-                "duration": gif.duration,
-                "uploader": user.user_name,
-                "uploader_id": user.id,
-                "category": gif.category,
-                "tags": gif.tags,
-                "like": gif.likes,
-                "pub_time": gif.pub_time
-            })
+    gif_list = hydrate_gifs(gif_id_list[begin:end])
     return gif_list, math.ceil(len(gif_id_list) / MAX_GIFS_PER_PAGE)
 
-def post_search_metadata(user: UserInfo, gif: GifMetadata):
-    '''
-        Post search metadata to elasticsearch engine
-    '''
-    data = {
-        "id": gif.id,
-        "title": gif.title,
-        "uploader": user.user_name,
-        "width": gif.width,
-        "height": gif.height,
-        "category": gif.category,
-        "tags": gif.tags,
-        "duration": gif.duration,
-        "pub_time": "2023-04-23T15:32:59.514Z",
-        "like": 0,
-        "is_liked": False
-    }
+def filter_query(body):
+    '''
+        Q of the category, tags and range filters of a search request
+    '''
+    query = Q()
+    if body["filter"]:
+        ranges = [filter["range"] for filter in body["filter"]]
+        # ranges = [
+        #     {"width": {"gte": 0, "lte": 100}},
+        #     {"height": {"gte": 0, "lte": 100}},
+        #     {"duration": {"gte": 0, "lte": 100}}
+        # ]
+        for each_range in ranges:
+            if "width" in each_range:
+                query &= Q(width__gte=each_range["width"]["gte"])
+                query &= Q(width__lte=each_range["width"]["lte"])
+            elif "height" in each_range:
+                query &= Q(height__gte=each_range["height"]["gte"])
+                query &= Q(height__lte=each_range["height"]["lte"])
+            elif "duration" in each_range:
+                query &= Q(duration__gte=each_range["duration"]["gte"])
+                query &= Q(duration__lte=each_range["duration"]["lte"])
+    if body["category"]:
+        query &= Q(category=body["category"])
+    if body["tags"]:
+        # query &= Q(tags__in=(body["tags"]))
+        for tag in body["tags"]:
+            query &= Q(tags__contains=tag)  # sqlite 不支持 contains
+    return query
+
+def fallback_search(body, page=None, size=MAX_GIFS_PER_PAGE):
+    '''
+        Database search used while the search engine is unavailable:
+        keyword contained in the title or uploader name, newest first.
+        The hits are marked degraded so they are not cached.
+    '''
+    query = filter_query(body)
+    keyword = body["keyword"]
+    if keyword and body["target"] == "uploader":
+        query &= Q(uploader__in=UserInfo.objects.filter(user_name__icontains=keyword).values("id"))
+    elif keyword and body["target"] == "title":
+        query &= Q(title__icontains=keyword)
+    gifs = GifMetadata.objects.filter(query).order_by("-id").values_list("id", flat=True)
+    start, stop = (0, MAX_HITS) if page is None else (page * size, (page + 1) * size)
+    hits = SearchHits([str(gif_id) for gif_id in gifs[start:stop]], gifs.count())
+    hits.degraded = True
+    return hits
+
+@timed("search")
+def run_search(body, page=None, size=MAX_GIFS_PER_PAGE):
+    '''
+        Run a search request on the search engine by its type, return
+        SearchHits of one page or of the leading hits if page is None.
+        Falls back to the database while the engine is unavailable.
+    '''
     search_engine = SEARCH_ENGINE
-    search_engine.post_metadata(data)
+    search = {
+        "perfect": search_engine.search_perfect,
+        "partial": search_engine.search_partial,
+        "fuzzy": search_engine.search_fuzzy,
+        "related": search_engine.search_related
+    }[body["type"]]
+    try:
+        return search(request=body, page=page, size=size)
+    except ServiceUnavailable as error:
+        print(error)
+        return fallback_search(body, page, size)
+
+def prefetch_search(body, cache_body, pin=False):
+    '''
+        Run a search for its leading hits and cache them, results of
+        the database fallback are not cached
+    '''
+    hits = run_search(body)
+    if not hits.degraded:
+        SEARCH_CACHE.set(cache_body, body["category"], hits, pin=pin)
+    return hits
+
+def show_search_hits(hits: SearchHits):
+    '''
+        Show a search page already cut by the search engine
+    '''
+    return hydrate_gifs(hits), hits.page_count(MAX_GIFS_PER_PAGE)
+
+def gif_detail(gif_id: int):
+    '''
+        Gif and uploader data shared by every viewer of a gif, None
+        when the gif does not exist
+    '''
+    gif = GifMetadata.objects.filter(id=gif_id).select_related("uploader_user").first()
+    if not gif:
+        return None
+    if gif.uploader_user_id == gif.uploader:
+        user = gif.uploader_user
+    else:
+        # not backfilled yet, see manage.py backfill_uploaders
+        user = UserInfo.objects.filter(id=gif.uploader).first()
+    return {
+        "gif_data": {
+            "id": gif.id,
+            "title": gif.title,
+            "uploader": user.user_name,
+            "width": gif.width,
+            "height": gif.height,
+            "category": gif.category,
+            "tags": gif.tags,
+            "duration": gif.duration,
+            "pub_time": gif.pub_time,
+            "like": gif.likes,
+        },
+        "user_data": {
+            "id": user.id,
+            "user_name": user.user_name,
+            "signature": user.signature,
+            "mail": user.mail,
+            "avatar": user.avatar,
+            "followers": user.follower_count,
+            "following": user.following_count,
+            "register_time": user.register_time,
+        }
+    }
+
+def comment_tree(gif: GifMetadata):
+    '''
+        Comments of a gif newest first with their replies, without
+        the per-viewer is_liked flags
+    '''
+    comments_data = []
+    for comment in gif.comments.all().filter(parent__isnull=True).order_by('-pub_time'):
+        replies_data = []
+        for reply in comment.replies.all().order_by('-pub_time'):
+            replies_data.append({
+                "id": reply.id,
+                "user": reply.user.user_name,
+                "avatar": reply.user.avatar,
+                "content": reply.content,
+                "pub_time": reply.pub_time,
+                "like": reply.likes,
+            })
+        comments_data.append({
+            "id": comment.id,
+            "user": comment.user.user_name,
+            "avatar": comment.user.avatar,
+            "content": comment.content,
+            "pub_time": comment.pub_time,
+            "like": comment.likes,
+            "replies": replies_data
+        })
+    return comments_data
+
+def post_search_metadata(gif: GifMetadata, old_category=None):
+    '''
+        Queue a created or updated gif for the search engine,
+        call it in the transaction saving the gif
+    '''
+    enqueue_index(gif, old_category)
+
+def delete_search_metadata(gif: GifMetadata):
+    '''
+        Queue a deleted gif for the search engine,
+        call it in the transaction deleting the gif
+    '''
+    enqueue_delete(gif)
 
 def generate_token():
     '''
@@ -371,7 +588,14 @@ def update_user_tags(user: UserInfo, tags: list):
             user.tags[tag] += 1
         else:
             user.tags[tag] = 1
-    user.save()
+    user.save(update_fields=["tags"])
+    mark_feed_stale(user)
+
+def mark_feed_stale(user: UserInfo):
+    '''
+        Queue the precomputed feed of a user for refresh_feeds
+    '''
+    UserFeed.objects.filter(user_id=user.id, stale=False).update(stale=True)
 
 def get_user_tags(user: UserInfo):
     '''
@@ -459,20 +683,41 @@ def show_user_message_page(user: UserInfo, other_user: UserInfo, page: int):
     '''
         Show user message page
     '''
-    user_messages = Message.objects.filter(Q(receiver=user, sender=other_user)|Q(sender=user, receiver=other_user)).order_by("-pub_time")
-    if not user_messages:
+    user_messages = conversation(user, other_user).order_by("-pub_time")
+    total = user_messages.count()
+    if not total:
         return [], 0
     begin = page * MAX_MESSAGES_PER_PAGE
     end = (page + 1) * MAX_MESSAGES_PER_PAGE
-    messages_list = []
-    for single_message in user_messages[begin:end]:
-        messages_list.append({
-            "sender": single_message.sender.id,
-            "receiver": single_message.receiver.id,
-            "message": single_message.message,
-            "pub_time": single_message.pub_time
-        })
-    return messages_list, math.ceil(len(user_messages) / MAX_MESSAGES_PER_PAGE)
+    messages_list = [serialize_message(single_message) for single_message in user_messages[begin:end]]
+    return messages_list, math.ceil(total / MAX_MESSAGES_PER_PAGE)
+
+def conversation(user: UserInfo, other_user: UserInfo):
+    '''
+        Messages between two users
+    '''
+    return Message.objects.filter(Q(receiver=user, sender=other_user)|Q(sender=user, receiver=other_user))
+
+def serialize_message(message: Message):
+    '''
+        Message of a conversation page
+    '''
+    return {
+        "id": message.id,
+        "sender": message.sender_id,
+        "receiver": message.receiver_id,
+        "message": message.message,
+        "pub_time": message.pub_time
+    }
+
+def show_message_cursor_page(user: UserInfo, other_user: UserInfo, params):
+    '''
+        Cursor page of the messages between two users, newest first;
+        raise InvalidCursor
+    '''
+    cursor, size, count = cursor_params(params, MAX_MESSAGES_PER_PAGE, MAX_LISTING_SIZE)
+    page = paginate_queryset(conversation(user, other_user), cursor, size, count=count)
+    return page.response([serialize_message(single_message) for single_message in page.items])
 
 def deduplicate(list_to_deduplicate):
     '''
@@ -484,24 +729,34 @@ def post_message_to_fans(user: UserInfo, gif_id: int):
     '''
         Post message to fans
     '''
-    fans = user.followers
-    for fan_id, _ in fans.items():
-        fan = UserInfo.objects.filter(id=int(fan_id)).first()
-        if fan:
-            message = Message(sender=user, receiver=fan, message=f"我发布了新的作品，快去 https://gifexplorer-frontend-nullptr.app.secoder.net/image/{gif_id} 看看吧~")
-            message.save()
+    fan_ids = Follow.objects.filter(followee=user).values_list("follower_id", flat=True)
+    Message.objects.bulk_create([
+        Message(sender=user, receiver_id=fan_id, message=f"我发布了新的作品，快去 https://gifexplorer-frontend-nullptr.app.secoder.net/image/{gif_id} 看看吧~")
+        for fan_id in fan_ids
+    ])
 
 def generate_cache_body(body):
     '''
-        Generate cache body
+        Generate cache body - canonical key of a search request,
+        the page is left out since pages are sliced from one id list
     '''
-    width_param, height_param, duration_param = '0_0', '0_0', '0_0'
+    ranges = {"width": None, "height": None, "duration": None}
     for item in body["filter"]:
-        if "range" in item and "width" in item["range"]:
-            width_param = str(item["range"]["width"]["gte"]) + '_' + str(item["range"]["width"]["lte"])
-        if "range" in item and "height" in item["range"]:
-            height_param = str(item["range"]["height"]["gte"]) + '_' + str(item["range"]["height"]["lte"])
-        if "range" in item and "duration" in item["range"]:
-            duration_param = str(item["range"]["duration"]["gte"]) + '_' + str(item["range"]["duration"]["lte"])
-    cache_body = body["type"] + '_' + body["target"] + '_' + body["keyword"] + '_' + body["category"] + '_' + width_param + '_' + height_param + '_' + duration_param + '_' + str(body["page"])
-    return cache_body
+        for field, bound in item.get("range", {}).items():
+            if field in ranges:
+                ranges[field] = [bound.get("gte"), bound.get("lte")]
+    keyword = body["keyword"]
+    if body["type"] != "perfect":
+        # analyzed fields ignore case and extra spaces
+        keyword = " ".join(keyword.lower().split())
+    cache_body = [
+        body["type"],
+        body["target"],
+        keyword,
+        body["category"],
+        ranges["width"],
+        ranges["height"],
+        ranges["duration"],
+        sorted(body["tags"])
+    ]
+    return json.dumps(cache_body, ensure_ascii=False)
@@ -0,0 +1,316 @@
+'''
+    Hot words - decayed Space-Saving top-k over searched keywords
+'''
+import os
+import glob
+import json
+import time
+import heapq
+import threading
+
+# keywords tracked per window, the top MAX_HOTWORDS of them are served
+HOTWORDS_CAPACITY = 1000
+
+MAX_HOTWORDS = 10
+
+MAX_HOTWORD_LENGTH = 64
+
+# half life in seconds of a search in each window
+HOTWORDS_WINDOWS = {
+    "hour": 3600,
+    "day": 86400,
+    "week": 604800,
+}
+
+DEFAULT_WINDOW = "day"
+
+# seconds between two snapshots written to disk
+SNAPSHOT_INTERVAL = 60
+
+# snapshots written this many seconds before the newest one are left
+# by workers of an older run, they are dropped on load
+SNAPSHOT_MAX_AGE = 10 * SNAPSHOT_INTERVAL
+
+# seconds a computed top list is served before being computed again
+TOP_REFRESH_INTERVAL = 1
+
+# rescale counts once the newest weight reaches 2 ** RESCALE_EXPONENT
+RESCALE_EXPONENT = 32
+
+
+def normalize_keyword(keyword):
+    '''
+        Case and space insensitive form of a keyword, "" to skip it
+    '''
+    keyword = " ".join(str(keyword or "").lower().split())
+    return keyword[:MAX_HOTWORD_LENGTH]
+
+
+class SpaceSaving:
+    '''
+        Space-Saving heavy hitters with forward exponential decay.
+
+        At most capacity keywords are counted. A new keyword replaces
+        the least counted one and inherits its count as error, so every
+        keyword above total / capacity is guaranteed to be kept.
+        A search at time t weighs 2 ** ((t - landmark) / half_life),
+        which decays every count at the same rate without touching them.
+    '''
+    def __init__(self, capacity, half_life, now=None):
+        self.capacity = capacity
+        self.half_life = half_life
+        # set by the first search when not given
+        self.landmark = now
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def weight(self, now):
+        '''
+            Weight of a search made now
+        '''
+        if self.landmark is None:
+            self.landmark = now
+        return 2 ** ((now - self.landmark) / self.half_life)
+
+    def rescale(self, now):
+        '''
+            Move the landmark to now so weights stay in float range
+        '''
+        factor = 2 ** ((self.landmark - now) / self.half_life)
+        self.counts = {key: count * factor for key, count in self.counts.items()}
+        self.errors = {key: error * factor for key, error in self.errors.items()}
+        self.landmark = now
+        self.rebuild_heap()
+
+    def rebuild_heap(self):
+        '''
+            Drop stale heap entries
+        '''
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def pop_min(self):
+        '''
+            Remove and return the least counted keyword and its count
+        '''
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                self.errors.pop(key, None)
+                return key, count
+
+    def offer(self, key, now=None):
+        '''
+            Count one search of key
+        '''
+        now = time.time() if now is None else now
+        if self.landmark is not None and (now - self.landmark) / self.half_life > RESCALE_EXPONENT:
+            self.rescale(now)
+        weight = self.weight(now)
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+        else:
+            _, minimum = self.pop_min()
+            self.counts[key] = minimum + weight
+            self.errors[key] = minimum
+        heapq.heappush(self.heap, (self.counts[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
+
+    def top(self, count):
+        '''
+            Most searched keywords, best first
+        '''
+        best = heapq.nlargest(count, self.counts.items(), key=lambda item: (item[1], item[0]))
+        return [key for key, _ in best]
+
+    def dump(self):
+        '''
+            JSON friendly state
+        '''
+        return {
+            "landmark": self.landmark,
+            "counts": [[key, count, self.errors.get(key, 0)] for key, count in self.counts.items()],
+        }
+
+    def load(self, state):
+        '''
+            Restore a state written by dump
+        '''
+        self.landmark = state["landmark"]
+        entries = sorted(state["counts"], key=lambda entry: entry[1], reverse=True)[:self.capacity]
+        self.counts = {key: count for key, count, _ in entries}
+        self.errors = {key: error for key, _, error in entries if error}
+        self.rebuild_heap()
+
+
+def merge_states(states, half_life):
+    '''
+        Average of SpaceSaving dumps of several workers, counts decayed
+        to the latest landmark. Each worker counts its share of the
+        searches, so the average keeps a restored worker at the scale
+        of one worker while ranking keywords over all of them.
+    '''
+    states = [state for state in states if state["landmark"] is not None]
+    if not states:
+        return {"landmark": None, "counts": []}
+    landmark = max(state["landmark"] for state in states)
+    counts = {}
+    errors = {}
+    for state in states:
+        factor = 2 ** ((state["landmark"] - landmark) / half_life) / len(states)
+        for key, count, error in state["counts"]:
+            counts[key] = counts.get(key, 0) + count * factor
+            errors[key] = errors.get(key, 0) + error * factor
+    return {
+        "landmark": landmark,
+        "counts": [[key, count, errors[key]] for key, count in counts.items()],
+    }
+
+
+class HotWords:
+    '''
+        Hot words of several windows fed by image_search.
+
+        Each worker counts its own searches and answers from memory.
+        Every SNAPSHOT_INTERVAL seconds a worker writes its state to
+        snapshot_path suffixed with its pid, so workers never overwrite
+        each other. On first use the snapshots of the last run are
+        merged, so a restart keeps the hot words of every worker.
+    '''
+    def __init__(self, snapshot_path=None, capacity=HOTWORDS_CAPACITY, windows=None):
+        self.snapshot_path = snapshot_path
+        self.capacity = capacity
+        self.windows = {
+            name: SpaceSaving(capacity, half_life)
+            for name, half_life in (windows or HOTWORDS_WINDOWS).items()
+        }
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.saved_at = time.monotonic()
+        self.top_cache = {}
+
+    def ensure_loaded(self):
+        '''
+            Read the snapshot lazily on first use
+        '''
+        if self.loaded:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+
+    def record(self, keyword, now=None):
+        '''
+            Count one search of keyword in every window
+        '''
+        keyword = normalize_keyword(keyword)
+        if not keyword:
+            return
+        self.ensure_loaded()
+        with self.lock:
+            for counter in self.windows.values():
+                counter.offer(keyword, now)
+            save = time.monotonic() - self.saved_at > SNAPSHOT_INTERVAL
+            if save:
+                self.saved_at = time.monotonic()
+        if save:
+            self.save()
+
+    def top(self, count=MAX_HOTWORDS, window=DEFAULT_WINDOW):
+        '''
+            Hot words of a window, best first
+        '''
+        self.ensure_loaded()
+        cached = self.top_cache.get((count, window))
+        if cached is not None and time.monotonic() - cached[0] < TOP_REFRESH_INTERVAL:
+            return list(cached[1])
+        with self.lock:
+            words = self.windows[window].top(count)
+        self.top_cache[(count, window)] = (time.monotonic(), words)
+        return list(words)
+
+    def snapshot_file(self):
+        '''
+            Snapshot path of this worker
+        '''
+        return f"{self.snapshot_path}.{os.getpid()}"
+
+    def snapshot_files(self):
+        '''
+            Snapshots of the workers of the last run, older ones are removed
+        '''
+        ages = {}
+        for path in glob.glob(f"{glob.escape(self.snapshot_path)}.*"):
+            if not path.rsplit(".", 1)[-1].isdigit():
+                continue
+            try:
+                ages[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        if not ages:
+            return []
+        newest = max(ages.values())
+        for path, modified in ages.items():
+            if modified < newest - SNAPSHOT_MAX_AGE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return sorted(path for path, modified in ages.items() if modified >= newest - SNAPSHOT_MAX_AGE)
+
+    def save(self):
+        '''
+            Write the snapshot of this worker, replacing its old one atomically
+        '''
+        if not self.snapshot_path:
+            return
+        with self.lock:
+            state = {name: counter.dump() for name, counter in self.windows.items()}
+        snapshot_file = self.snapshot_file()
+        temp_path = f"{snapshot_file}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as snapshot:
+                json.dump(state, snapshot, ensure_ascii=False)
+            os.replace(temp_path, snapshot_file)
+        except OSError as error:
+            print(error)
+
+    def load(self):
+        '''
+            Merge the readable snapshots of the last run
+        '''
+        if not self.snapshot_path:
+            return
+        states = []
+        for path in self.snapshot_files():
+            try:
+                with open(path, "r", encoding="utf-8") as snapshot:
+                    states.append(json.load(snapshot))
+            except (OSError, ValueError) as error:
+                print(error)
+        if not states:
+            return
+        try:
+            for name, counter in self.windows.items():
+                counter.load(merge_states(
+                    [state[name] for state in states if name in state], counter.half_life
+                ))
+        except (ValueError, KeyError, TypeError) as error:
+            print(error)
+
+    def clear(self):
+        '''
+            Forget every counted search
+        '''
+        with self.lock:
+            for counter in self.windows.values():
+                counter.counts, counter.errors, counter.heap = {}, {}, []
+                counter.landmark = None
+            self.top_cache = {}
+            self.loaded = True
@@ -0,0 +1,389 @@
+"""
+Filename: local_search.py
+
+In-process search backend. An inverted index over GifMetadata title,
+uploader, category and tags answers every SearchEngine query without a
+network hop, which is handy on small nodes and offline environments.
+"""
+import re
+import math
+import threading
+from collections import Counter
+from .search import SearchEngine, SearchHits, MAX_PAGE_SIZE
+
+CHINESE_CHARS = "\u3400-\u4DB5\u4E00-\u9FCB\uF900-\uFA6A"
+
+TOKEN_PATTERN = re.compile(f"[{CHINESE_CHARS}]|[^\\W_{CHINESE_CHARS}]+")
+
+TEXT_FIELDS = ("title", "uploader")
+
+RANGE_FIELDS = ("width", "height", "duration")
+
+MAX_SUGGESTIONS = 5
+
+MAX_CORRECTIONS = 5
+
+MAX_HOTWORDS = 10
+
+
+def tokenize(text):
+    '''
+        Split text into lower-case tokens, one token per chinese char
+    '''
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def fuzziness(token):
+    '''
+        Maximum edit distance allowed for a token, same as ES "AUTO"
+    '''
+    if len(token) <= 2:
+        return 0
+    if len(token) <= 5:
+        return 1
+    return 2
+
+
+def edit_distance(source, target, max_distance):
+    '''
+        Edit distance between source and target, counting an adjacent
+        transposition as one edit like ES does. Returns max_distance + 1
+        as soon as the distance exceeds max_distance
+    '''
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    before = None
+    previous = list(range(len(target) + 1))
+    for i, source_char in enumerate(source, 1):
+        current = [i]
+        for j, target_char in enumerate(target, 1):
+            distance = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (source_char != target_char)
+            )
+            if i > 1 and j > 1 and source_char == target[j - 2] and source[i - 2] == target_char:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > max_distance and min(previous) > max_distance:
+            return max_distance + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+class InvertedIndexSearchEngine(SearchEngine):
+
+    """
+    [InvertedIndexEngine]
+        Same interface as ElasticSearchEngine, served from memory.
+        The index is loaded from the database on first use and kept
+        up to date through post_metadata.
+
+        postings: field -> token -> set of gif ids
+        keywords: field -> lower-case full text -> set of gif ids
+    """
+
+    in_process = True
+
+    def __init__(self, documents=None):
+        self.lock = threading.RLock()
+        self.documents = {}
+        self.postings = {field: {} for field in TEXT_FIELDS}
+        self.keywords = {field: {} for field in TEXT_FIELDS}
+        self.messages = Counter()
+        self.loaded = False
+        if documents is not None:
+            self.rebuild(documents)
+
+    def load_documents(self):
+        '''
+            Read search metadata of every gif from the database
+        '''
+        # pylint: disable=import-outside-toplevel
+        from .models import GifMetadata, UserInfo
+        user_names = dict(UserInfo.objects.values_list("id", "user_name"))
+        documents = []
+        for gif in GifMetadata.objects.all().values(
+                "id", "title", "uploader", "width", "height", "duration",
+                "category", "tags", "likes", "pub_time"):
+            gif["uploader"] = user_names.get(gif["uploader"], "")
+            gif["like"] = gif.pop("likes")
+            documents.append(gif)
+        return documents
+
+    def rebuild(self, documents=None):
+        '''
+            Drop the index and build it again from documents
+            (or from the database if documents is None)
+        '''
+        if documents is None:
+            documents = self.load_documents()
+        with self.lock:
+            self.documents = {}
+            self.postings = {field: {} for field in TEXT_FIELDS}
+            self.keywords = {field: {} for field in TEXT_FIELDS}
+            for data in documents:
+                self.add_document(data)
+            self.loaded = True
+
+    def ensure_loaded(self):
+        '''
+            Build the index lazily on first query
+        '''
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.rebuild()
+
+    def expire(self):
+        '''
+            Drop the index, the next query loads it again from the
+            database
+        '''
+        with self.lock:
+            self.loaded = False
+
+    def add_document(self, data):
+        '''
+            Insert or replace one gif in the index
+        '''
+        gif_id = int(data["id"])
+        self.remove_document(gif_id)
+        document = {
+            "id": gif_id,
+            "title": data.get("title") or "",
+            "uploader": data.get("uploader") or "",
+            "width": data.get("width") or 0,
+            "height": data.get("height") or 0,
+            "duration": data.get("duration") or 0,
+            "category": data.get("category") or "",
+            "tags": list(data.get("tags") or []),
+            "like": data.get("like") or 0,
+        }
+        self.documents[gif_id] = document
+        for field in TEXT_FIELDS:
+            for token in set(tokenize(document[field])):
+                self.postings[field].setdefault(token, set()).add(gif_id)
+            self.keywords[field].setdefault(document[field].lower(), set()).add(gif_id)
+
+    def remove_document(self, gif_id):
+        '''
+            Remove one gif from the index if it is there
+        '''
+        document = self.documents.pop(gif_id, None)
+        if document is None:
+            return
+        for field in TEXT_FIELDS:
+            for token in set(tokenize(document[field])):
+                ids = self.postings[field].get(token)
+                if ids is not None:
+                    ids.discard(gif_id)
+                    if not ids:
+                        self.postings[field].pop(token)
+            ids = self.keywords[field].get(document[field].lower())
+            if ids is not None:
+                ids.discard(gif_id)
+                if not ids:
+                    self.keywords[field].pop(document[field].lower())
+
+    def match_filters(self, document, request):
+        '''
+            Test a document against category, tags and range filters
+        '''
+        if request.get("category") and document["category"] != request["category"]:
+            return False
+        tags = request.get("tags") or []
+        if tags and not set(tags).issubset(document["tags"]):
+            return False
+        for each_filter in request.get("filter") or []:
+            for field, bound in each_filter.get("range", {}).items():
+                if field not in RANGE_FIELDS:
+                    continue
+                value = document[field]
+                if "gte" in bound and value < bound["gte"]:
+                    return False
+                if "lte" in bound and value > bound["lte"]:
+                    return False
+                if "gt" in bound and value <= bound["gt"]:
+                    return False
+                if "lt" in bound and value >= bound["lt"]:
+                    return False
+        return True
+
+    def idf(self, field, token):
+        '''
+            Inverse document frequency of a token in a field
+        '''
+        frequency = len(self.postings[field].get(token, ()))
+        return math.log(1 + len(self.documents) / (1 + frequency))
+
+    def fuzzy_expand(self, field, token):
+        '''
+            Indexed tokens within AUTO edit distance of token
+        '''
+        max_distance = fuzziness(token)
+        if max_distance == 0:
+            return [token] if token in self.postings[field] else []
+        return [
+            candidate for candidate in self.postings[field]
+            if edit_distance(token, candidate, max_distance) <= max_distance
+        ]
+
+    def score_text(self, request, mode):
+        '''
+            Score gifs against the keyword of a request.
+            Return None when the request has no text constraint.
+        '''
+        field = request.get("target")
+        keyword = request.get("keyword") or ""
+        if field not in TEXT_FIELDS or keyword == "":
+            return None
+
+        if mode == "perfect":
+            return {gif_id: 1.0 for gif_id in self.keywords[field].get(keyword.lower(), ())}
+
+        tokens = tokenize(keyword)
+        if not tokens:
+            return {}
+        scores = None
+        for token in tokens:
+            if mode == "fuzzy":
+                expanded = self.fuzzy_expand(field, token)
+            else:
+                expanded = [token] if token in self.postings[field] else []
+            token_scores = {}
+            for candidate in expanded:
+                weight = self.idf(field, candidate) / (1 + edit_distance(token, candidate, 2))
+                for gif_id in self.postings[field][candidate]:
+                    token_scores[gif_id] = max(token_scores.get(gif_id, 0.0), weight)
+            if mode == "related":
+                # any token may match, the more the better
+                scores = scores or {}
+                for gif_id, weight in token_scores.items():
+                    scores[gif_id] = scores.get(gif_id, 0.0) + weight
+            elif scores is None:
+                scores = token_scores
+            else:
+                # every token must match
+                scores = {
+                    gif_id: weight + token_scores[gif_id]
+                    for gif_id, weight in scores.items() if gif_id in token_scores
+                }
+        return scores or {}
+
+    def search(self, request, mode, page=None, size=MAX_PAGE_SIZE):
+        '''
+            Run a search request in the given mode, return SearchHits
+            of one page (0-based) or of every hit if page is None
+        '''
+        self.ensure_loaded()
+        with self.lock:
+            if request.get("keyword"):
+                self.messages[request["keyword"]] += 1
+            scores = self.score_text(request, mode)
+            if scores is None:
+                candidates = {gif_id: 1.0 for gif_id in self.documents}
+            else:
+                candidates = scores
+            hits = [
+                (score, gif_id) for gif_id, score in candidates.items()
+                if self.match_filters(self.documents[gif_id], request)
+            ]
+        hits.sort(key=lambda hit: (-hit[0], -hit[1]))
+        if page is not None:
+            hits_page = hits[page * size:(page + 1) * size]
+        else:
+            hits_page = hits
+        return SearchHits([str(gif_id) for _, gif_id in hits_page], len(hits))
+
+    def search_perfect(self, request, page=None, size=MAX_PAGE_SIZE):
+        return self.search(request, "perfect", page, size)
+
+    def search_partial(self, request, page=None, size=MAX_PAGE_SIZE):
+        return self.search(request, "partial", page, size)
+
+    def search_related(self, request, page=None, size=MAX_PAGE_SIZE):
+        return self.search(request, "related", page, size)
+
+    def search_fuzzy(self, request, page=None, size=MAX_PAGE_SIZE):
+        return self.search(request, "fuzzy", page, size)
+
+    def hotwords_search(self):
+        with self.lock:
+            return [message for message, _ in self.messages.most_common(MAX_HOTWORDS)]
+
+    def personalization_search(self, tag_fre):
+        self.ensure_loaded()
+        with self.lock:
+            hits = []
+            for gif_id, document in self.documents.items():
+                score = sum(float(tag_fre[tag]) for tag in set(document["tags"]) if tag in tag_fre)
+                if score > 0:
+                    hits.append((score, gif_id))
+        hits.sort(key=lambda hit: (-hit[0], -hit[1]))
+        return [str(gif_id) for _, gif_id in hits]
+
+    def suggest_search(self, user_input):
+        self.ensure_loaded()
+        prefix = (user_input or "").lower()
+        with self.lock:
+            titles = sorted({
+                document["title"] for document in self.documents.values()
+                if document["title"].lower().startswith(prefix)
+            }, key=lambda title: (len(title), title))
+        return titles[:MAX_SUGGESTIONS]
+
+    def post_metadata(self, data):
+        self.ensure_loaded()
+        with self.lock:
+            self.add_document(data)
+        return {"_id": str(data["id"]), "result": "updated"}
+
+    def delete_metadata(self, gif_id):
+        self.ensure_loaded()
+        with self.lock:
+            self.remove_document(int(gif_id))
+        return {"_id": str(gif_id), "result": "deleted"}
+
+    def bulk_post_metadata(self, documents):
+        self.ensure_loaded()
+        with self.lock:
+            for data in documents:
+                self.add_document(data)
+        return len(documents)
+
+    def correct_search(self, input, target):
+        self.ensure_loaded()
+        field = target if target in TEXT_FIELDS else "title"
+        tokens = tokenize(input)
+        if not tokens:
+            return []
+        with self.lock:
+            vocabulary = self.postings[field]
+            corrected = []
+            changed = False
+            for token in tokens:
+                if token in vocabulary:
+                    corrected.append(token)
+                    continue
+                max_distance = max(fuzziness(token), 1)
+                best = None
+                for candidate, ids in vocabulary.items():
+                    distance = edit_distance(token, candidate, max_distance)
+                    if distance <= max_distance:
+                        rank = (distance, -len(ids), candidate)
+                        if best is None or rank < best[0]:
+                            best = (rank, candidate)
+                if best is None:
+                    corrected.append(token)
+                else:
+                    corrected.append(best[1])
+                    changed = True
+        if not changed:
+            return []
+        return [" ".join(corrected)][:MAX_CORRECTIONS]
+
+
+# end InvertedIndexSearchEngine
@@ -0,0 +1,69 @@
+'''
+    manage.py backfill_uploaders - fill the uploader foreign key and
+    name of gifs saved before those columns existed
+'''
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from main.models import GifMetadata, UserInfo
+
+
+class Command(BaseCommand):
+    '''
+        Walk the gifs in id chunks and point uploader_user and
+        uploader_name at the uploader where they differ. Every chunk is
+        updated in its own short transaction, so the table is never
+        locked for long and the site keeps serving; running it again
+        only fixes what changed since.
+    '''
+    help = "Backfill GifMetadata.uploader_user and uploader_name in id chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="gifs read per chunk")
+        parser.add_argument("--sleep", type=float, default=0.0,
+                            help="seconds to pause after a chunk with updates")
+        parser.add_argument("--start-id", type=int, default=0,
+                            help="resume after this gif id")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size <= 0:
+            raise CommandError("batch-size must be positive")
+        last_id = options["start_id"]
+        scanned = 0
+        updated = 0
+        while True:
+            rows = list(
+                GifMetadata.objects
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "uploader", "uploader_user_id", "uploader_name")[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            scanned += len(rows)
+            names = dict(
+                UserInfo.objects
+                .filter(id__in={uploader for _, uploader, _, _ in rows})
+                .values_list("id", "user_name")
+            )
+            stale = {}
+            for gif_id, uploader, user_id, user_name in rows:
+                expected = (uploader, names[uploader]) if uploader in names else (None, "")
+                if (user_id, user_name) != expected:
+                    stale.setdefault(uploader, []).append(gif_id)
+            if not stale:
+                continue
+            with transaction.atomic():
+                for uploader, gif_ids in stale.items():
+                    # a gif whose uploader changed meanwhile was filled by its save
+                    updated += GifMetadata.objects.filter(id__in=gif_ids, uploader=uploader).update(
+                        uploader_user_id=uploader if uploader in names else None,
+                        uploader_name=names.get(uploader, "")
+                    )
+            self.stdout.write(f"Backfilled up to gif {last_id}")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Scanned {scanned} gifs, updated {updated}"))
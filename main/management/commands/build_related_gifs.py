@@ -0,0 +1,47 @@
+'''
+    manage.py build_related_gifs - rebuild the item-to-item neighbours
+'''
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.models import UserInfo, GifLike
+from main.related import interaction_matrix, top_neighbours, save_neighbours, MAX_NEIGHBOURS, BLOCK_SIZE
+
+
+class Command(BaseCommand):
+    '''
+        Read the liked gifs and read history of every user, compute the
+        nearest gifs of every gif in a process pool and write them
+        to RELATED_GIFS_PATH, where the workers pick them up
+    '''
+    help = "Rebuild the related gifs of every gif from likes and read history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--neighbours", type=int, default=MAX_NEIGHBOURS,
+                            help="neighbours kept per gif")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="processes computing the neighbours")
+        parser.add_argument("--block-size", type=int, default=BLOCK_SIZE,
+                            help="gifs per task")
+        parser.add_argument("--output", default=settings.RELATED_GIFS_PATH,
+                            help="neighbour file")
+
+    def handle(self, *args, **options):
+        if options["neighbours"] <= 0 or options["block_size"] <= 0:
+            raise CommandError("neighbours and block-size must be positive")
+        started = time.monotonic()
+        likes = {}
+        for user_id, gif_id in GifLike.objects.values_list("user_id", "gif_id").iterator(chunk_size=2000):
+            likes.setdefault(user_id, []).append(gif_id)
+        items, matrix = interaction_matrix(
+            (likes.pop(user_id, ()), read_history)
+            for user_id, read_history in UserInfo.objects.values_list("id", "read_history").iterator(chunk_size=2000)
+        )
+        neighbours, scores = top_neighbours(
+            matrix, options["neighbours"], options["workers"], options["block_size"]
+        )
+        save_neighbours(options["output"], items, neighbours, scores)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote neighbours of {len(items)} gifs from {matrix.nnz} interactions in {elapsed:.1f}s"
+        ))
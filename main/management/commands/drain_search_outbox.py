@@ -0,0 +1,39 @@
+'''
+    manage.py drain_search_outbox - push queued gif changes to the search engine
+'''
+import time
+from django.core.management.base import BaseCommand, CommandError
+from main.search_outbox import drain, DRAIN_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    '''
+        Drain the search outbox once, or keep draining with --forever.
+        Failed rows are retried with backoff by later drains.
+    '''
+    help = "Bulk index and delete gifs queued in the search outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=DRAIN_BATCH_SIZE,
+                            help="outbox rows per bulk request")
+        parser.add_argument("--forever", action="store_true",
+                            help="keep polling the outbox")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="seconds to sleep when the outbox is empty")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size <= 0:
+            raise CommandError("batch-size must be positive")
+        total = 0
+        try:
+            while True:
+                done = drain(batch_size)
+                total += done
+                if done < batch_size:
+                    if not options["forever"]:
+                        break
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f"Drained {total} outbox rows"))
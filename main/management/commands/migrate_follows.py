@@ -0,0 +1,132 @@
+'''
+    manage.py migrate_follows - unpack the followers and followings
+    json dicts of users into Follow edges and recount the counters
+'''
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from main.models import UserInfo, Follow
+
+
+def stored_time(value):
+    '''
+        Aware datetime of a time stored by the json histories, now
+        when it cannot be parsed
+    '''
+    created = parse_datetime(str(value)) if value else None
+    if created is None:
+        return timezone.now()
+    if timezone.is_naive(created):
+        created = timezone.make_aware(created)
+    return created
+
+
+def packed_users():
+    '''
+        Users whose followers or followings dict still holds edges
+    '''
+    return UserInfo.objects.filter(
+        (Q(followers__isnull=False) & ~Q(followers={})) | (Q(followings__isnull=False) & ~Q(followings={}))
+    )
+
+
+class Command(BaseCommand):
+    '''
+        First walk the users in id chunks: every edge found in either
+        side's dict is inserted, ignoring the ones that exist, and the
+        dicts of the chunk are emptied in the same transaction, so
+        running it again only moves what old code wrote meanwhile.
+        Once every dict is empty a run costs one query, so it may stay
+        in the start script.
+        When edges were moved, or with --recount, follower_count and
+        following_count are then recounted from the edges chunk by
+        chunk; otherwise the live F() updates already keep them exact.
+    '''
+    help = "Move UserInfo.followers and followings into Follow edges in id chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="users read per chunk")
+        parser.add_argument("--sleep", type=float, default=0.0,
+                            help="seconds to pause after a chunk")
+        parser.add_argument("--recount", action="store_true",
+                            help="recount the counters even if no edge was moved")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size <= 0:
+            raise CommandError("batch-size must be positive")
+        if not options["recount"] and not packed_users().exists():
+            self.stdout.write(self.style.SUCCESS("Nothing to unpack"))
+            return
+        unpacked = 0
+        last_id = 0
+        while True:
+            rows = list(
+                packed_users()
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "followers", "followings")[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            edges = {}
+            for user_id, followers, followings in rows:
+                for follower_id, value in (followers or {}).items():
+                    edges.setdefault((int(follower_id), user_id), value)
+                for followee_id, value in (followings or {}).items():
+                    edges.setdefault((user_id, int(followee_id)), value)
+            if not edges:
+                continue
+            unpacked += len(edges)
+            # edges to users deleted since are dropped
+            existing = set(UserInfo.objects.filter(
+                id__in={user_id for edge in edges for user_id in edge}
+            ).values_list("id", flat=True))
+            with transaction.atomic():
+                Follow.objects.bulk_create([
+                    Follow(follower_id=follower_id, followee_id=followee_id, created=stored_time(value))
+                    for (follower_id, followee_id), value in edges.items()
+                    if follower_id in existing and followee_id in existing and follower_id != followee_id
+                ], ignore_conflicts=True)
+                UserInfo.objects.filter(id__in=[row[0] for row in rows]).update(followers={}, followings={})
+            self.stdout.write(f"Unpacked follows up to user {last_id}")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        recounted = 0
+        last_id = 0
+        while unpacked or options["recount"]:
+            user_ids = list(
+                UserInfo.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size]
+            )
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            with transaction.atomic():
+                # lock before counting, a follow committing meanwhile then
+                # applies its F() update on top of the recount
+                users = list(UserInfo.objects.select_for_update().filter(id__in=user_ids).only(*UserInfo.COUNTER_FIELDS))
+                followers = dict(
+                    Follow.objects.filter(followee_id__in=user_ids)
+                    .values_list("followee_id").annotate(count=Count("id"))
+                )
+                followings = dict(
+                    Follow.objects.filter(follower_id__in=user_ids)
+                    .values_list("follower_id").annotate(count=Count("id"))
+                )
+                stale = []
+                for user in users:
+                    counts = (followers.get(user.id, 0), followings.get(user.id, 0))
+                    if (user.follower_count, user.following_count) != counts:
+                        user.follower_count, user.following_count = counts
+                        stale.append(user)
+                UserInfo.objects.bulk_update(stale, UserInfo.COUNTER_FIELDS)
+            recounted += len(stale)
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Unpacked {unpacked} follows, recounted {recounted} users"))
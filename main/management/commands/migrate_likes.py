@@ -0,0 +1,134 @@
+'''
+    manage.py migrate_likes - unpack the favorites and
+    comment_favorites of users into GifLike and CommentLike rows and
+    recount the likes counters
+'''
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Q
+from main.models import UserInfo, GifMetadata, GifComment, GifLike, CommentLike
+from .migrate_follows import stored_time
+
+
+def recount(model, like_model, field, batch_size, sleep):
+    '''
+        Set the likes counter of every row of model to its number of
+        like rows, in id chunks; returns how many rows changed
+    '''
+    recounted = 0
+    last_id = 0
+    while True:
+        ids = list(model.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        with transaction.atomic():
+            # lock before counting, a like committing meanwhile then
+            # applies its F() update on top of the recount
+            rows = list(model.objects.select_for_update().filter(id__in=ids).only("likes"))
+            counts = dict(
+                like_model.objects.filter(**{f"{field}__in": ids})
+                .values_list(field).annotate(count=Count("id"))
+            )
+            stale = [row for row in rows if row.likes != counts.get(row.id, 0)]
+            for row in stale:
+                row.likes = counts.get(row.id, 0)
+            model.objects.bulk_update(stale, ["likes"])
+        recounted += len(stale)
+        if sleep:
+            time.sleep(sleep)
+    return recounted
+
+
+def packed_users():
+    '''
+        Users whose favorites or comment_favorites still hold likes
+    '''
+    return UserInfo.objects.filter(
+        (Q(favorites__isnull=False) & ~Q(favorites={}) & ~Q(favorites=[]))
+        | (Q(comment_favorites__isnull=False) & ~Q(comment_favorites=[]))
+    )
+
+
+class Command(BaseCommand):
+    '''
+        First walk the users in id chunks: their liked gifs and
+        comments are inserted, ignoring the ones that exist, and the
+        json columns of the chunk are emptied in the same transaction,
+        so running it again only moves what old code wrote meanwhile.
+        Once every column is empty a run costs one query, so it may stay
+        in the start script.
+        When likes were moved, or with --recount, the likes of gifs and
+        comments are then recounted from the rows.
+    '''
+    help = "Move UserInfo.favorites and comment_favorites into GifLike and CommentLike in id chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="users, gifs or comments read per chunk")
+        parser.add_argument("--sleep", type=float, default=0.0,
+                            help="seconds to pause after a chunk")
+        parser.add_argument("--recount", action="store_true",
+                            help="recount the counters even if no like was moved")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size <= 0:
+            raise CommandError("batch-size must be positive")
+        if not options["recount"] and not packed_users().exists():
+            self.stdout.write(self.style.SUCCESS("Nothing to unpack"))
+            return
+        unpacked = 0
+        last_id = 0
+        while True:
+            rows = list(
+                packed_users()
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "favorites", "comment_favorites")[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            gif_likes = {}
+            comment_likes = set()
+            for user_id, favorites, comment_favorites in rows:
+                # favorites was a dict of like times, some rows hold a list of ids
+                if not isinstance(favorites, dict):
+                    favorites = dict.fromkeys(favorites or ())
+                for gif_id, value in favorites.items():
+                    if str(gif_id).isdecimal():
+                        gif_likes[(user_id, int(gif_id))] = value
+                for comment_id in comment_favorites or ():
+                    if str(comment_id).isdecimal():
+                        comment_likes.add((user_id, int(comment_id)))
+            if not gif_likes and not comment_likes:
+                continue
+            unpacked += len(gif_likes) + len(comment_likes)
+            # likes of gifs and comments deleted since are dropped
+            gifs = set(GifMetadata.objects.filter(
+                id__in={gif_id for _, gif_id in gif_likes}
+            ).values_list("id", flat=True))
+            comments = set(GifComment.objects.filter(
+                id__in={comment_id for _, comment_id in comment_likes}
+            ).values_list("id", flat=True))
+            with transaction.atomic():
+                GifLike.objects.bulk_create([
+                    GifLike(user_id=user_id, gif_id=gif_id, created=stored_time(value))
+                    for (user_id, gif_id), value in gif_likes.items() if gif_id in gifs
+                ], ignore_conflicts=True)
+                CommentLike.objects.bulk_create([
+                    CommentLike(user_id=user_id, comment_id=comment_id)
+                    for user_id, comment_id in comment_likes if comment_id in comments
+                ], ignore_conflicts=True)
+                UserInfo.objects.filter(id__in=[row[0] for row in rows]).update(favorites={}, comment_favorites=[])
+            self.stdout.write(f"Unpacked likes up to user {last_id}")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        recounted = 0
+        if unpacked or options["recount"]:
+            recounted += recount(GifMetadata, GifLike, "gif_id", batch_size, options["sleep"])
+            recounted += recount(GifComment, CommentLike, "comment_id", batch_size, options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Unpacked {unpacked} likes, recounted {recounted} gifs and comments"))
@@ -0,0 +1,21 @@
+'''
+    manage.py rebuild_trigram_index - rebuild the trigram index used by regex search
+'''
+from django.core.management.base import BaseCommand
+from main import trigram
+
+
+class Command(BaseCommand):
+    '''
+        Create the pg_trgm indexes on PostgreSQL,
+        rewrite the trigram postings on other databases
+    '''
+    help = "Rebuild the trigram index of gif titles and user names"
+
+    def handle(self, *args, **options):
+        if trigram.uses_pg_trgm():
+            trigram.create_trigram_indexes(sender=None)
+            self.stdout.write(self.style.SUCCESS("pg_trgm indexes are in place"))
+            return
+        count = trigram.rebuild_postings()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} trigram postings"))
@@ -0,0 +1,53 @@
+'''
+    manage.py refresh_feeds - recompute stale personalization feeds
+'''
+import time
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from main.feeds import refresh_stale_feeds, REFRESH_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    '''
+        Refresh the feeds of active users whose tags changed, once,
+        or keep refreshing with --forever. Feeds failing to refresh are
+        retried later (see refresh_stale_feeds); with --forever an
+        error of a whole round, such as a lost database, is logged and
+        the next round starts after --interval.
+    '''
+    help = "Recompute the precomputed feeds marked stale"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=REFRESH_BATCH_SIZE,
+                            help="feeds refreshed per round")
+        parser.add_argument("--forever", action="store_true",
+                            help="keep polling for stale feeds")
+        parser.add_argument("--interval", type=float, default=5.0,
+                            help="seconds to sleep when no feed is stale")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size <= 0:
+            raise CommandError("batch-size must be positive")
+        total = 0
+        try:
+            while True:
+                try:
+                    done = refresh_stale_feeds(batch_size)
+                except Exception:  # pylint: disable=broad-except
+                    if not options["forever"]:
+                        raise
+                    logger.exception("Refreshing feeds failed")
+                    close_old_connections()
+                    done = 0
+                total += done
+                if done < batch_size:
+                    if not options["forever"]:
+                        break
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f"Refreshed {total} feeds"))
@@ -0,0 +1,175 @@
+'''
+    manage.py reindex_gifs - rebuild the search index from the database
+'''
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from main import config
+from main.search_outbox import generate_search_document
+from main.models import GifMetadata, UserInfo
+
+DEFAULT_CHECKPOINT = "/tmp/gifexplorer_reindex.checkpoint"
+
+# uploader names kept between chunks, most gifs come from few users
+MAX_CACHED_UPLOADERS = 100000
+
+SEARCH_FIELDS = ("id", "title", "uploader", "width", "height", "duration",
+                 "category", "tags", "likes", "pub_time")
+
+
+class Command(BaseCommand):
+    '''
+        Stream gifs in id order and bulk index them from a thread pool.
+
+        The last id of every chunk indexed together with all chunks
+        before it is written to the checkpoint file, so a run which is
+        interrupted resumes after that id. A complete run removes the
+        checkpoint, so the next run indexes every gif again.
+    '''
+    help = "Bulk index every gif into the search engine, resuming from a checkpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="gifs per bulk request")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="bulk requests sent in parallel")
+        parser.add_argument("--max-in-flight", type=int, default=None,
+                            help="chunks read ahead of the index, default 2 * workers")
+        parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT,
+                            help="file keeping the last indexed id")
+        parser.add_argument("--restart", action="store_true",
+                            help="ignore the checkpoint and index every gif")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        workers = options["workers"]
+        max_in_flight = options["max_in_flight"] or 2 * workers
+        if chunk_size <= 0 or workers <= 0 or max_in_flight <= 0:
+            raise CommandError("chunk-size, workers and max-in-flight must be positive")
+        self.checkpoint_path = options["checkpoint"]
+        self.uploader_names = {}
+
+        start_id = 0 if options["restart"] else self.read_checkpoint()
+        if start_id:
+            self.stdout.write(f"Resuming after gif {start_id}")
+        total = GifMetadata.objects.filter(id__gt=start_id).count()
+
+        search_engine = config.SEARCH_ENGINE
+        slots = threading.BoundedSemaphore(max_in_flight)
+        pending = []
+        indexed = 0
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for chunk in self.read_chunks(start_id, chunk_size):
+                    slots.acquire()
+                    future = executor.submit(search_engine.bulk_post_metadata, chunk)
+                    future.add_done_callback(lambda _: slots.release())
+                    pending.append((chunk[-1]["id"], len(chunk), future))
+                    indexed += self.commit_done(pending)
+                    self.report(indexed, total, start_time)
+                while pending:
+                    pending[0][2].result()
+                    indexed += self.commit_done(pending)
+                    self.report(indexed, total, start_time)
+            except Exception as error:
+                for _, _, future in pending:
+                    future.cancel()
+                raise CommandError(
+                    f"Reindex stopped: {error}. Run again to resume from {self.checkpoint_path}"
+                ) from error
+
+        self.stdout.write("")
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} gifs in {elapsed:.1f}s ({indexed / elapsed:.0f} docs/s)"
+        ))
+        self.remove_checkpoint()
+        config.SEARCH_CACHE.clear()
+
+    def read_checkpoint(self):
+        '''
+            Last indexed id, 0 if there is no checkpoint
+        '''
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as checkpoint:
+                return int(checkpoint.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError as error:
+            raise CommandError(f"Bad checkpoint {self.checkpoint_path}: {error}") from error
+
+    def write_checkpoint(self, last_id):
+        '''
+            Save the last indexed id atomically
+        '''
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as checkpoint:
+            checkpoint.write(str(last_id))
+        os.replace(temp_path, self.checkpoint_path)
+
+    def remove_checkpoint(self):
+        '''
+            Forget the checkpoint once every gif is indexed
+        '''
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def read_chunks(self, start_id, chunk_size):
+        '''
+            Yield search documents of gifs after start_id, chunk_size at a time
+        '''
+        gifs = GifMetadata.objects.filter(id__gt=start_id).order_by("id").only(*SEARCH_FIELDS)
+        chunk = []
+        for gif in gifs.iterator(chunk_size=chunk_size):
+            chunk.append(gif)
+            if len(chunk) == chunk_size:
+                yield self.generate_documents(chunk)
+                chunk = []
+        if chunk:
+            yield self.generate_documents(chunk)
+
+    def generate_documents(self, gifs):
+        '''
+            Search documents of a chunk, uploader names fetched in one query
+        '''
+        missing = {gif.uploader for gif in gifs} - self.uploader_names.keys()
+        if missing:
+            if len(self.uploader_names) > MAX_CACHED_UPLOADERS:
+                self.uploader_names = {}
+            self.uploader_names.update(
+                UserInfo.objects.filter(id__in=missing).values_list("id", "user_name")
+            )
+        return [
+            generate_search_document(gif, self.uploader_names.get(gif.uploader, ""))
+            for gif in gifs
+        ]
+
+    def commit_done(self, pending):
+        '''
+            Pop the leading finished chunks and checkpoint the last of them,
+            return the number of gifs they held
+        '''
+        done = 0
+        last_id = None
+        try:
+            while pending and pending[0][2].done():
+                # a failed chunk raises here and stays pending
+                pending[0][2].result()
+                last_id, count, _ = pending.pop(0)
+                done += count
+        finally:
+            if last_id is not None:
+                self.write_checkpoint(last_id)
+        return done
+
+    def report(self, indexed, total, start_time):
+        '''
+            Print progress and throughput
+        '''
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        self.stdout.write(f"\r{indexed}/{total} gifs, {indexed / elapsed:.0f} docs/s", ending="")
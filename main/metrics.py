@@ -0,0 +1,138 @@
+'''
+    Request metrics - Server-Timing headers and per-route latency and
+    query count histograms, the phase timers are in utils/utils_timing.py
+'''
+import time
+import threading
+from django.db import connection
+from utils.utils_timing import TIMINGS, RequestTimings, phase, timed  # pylint: disable=unused-import
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of the database query count histogram buckets
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    '''
+        Cumulative histogram over fixed bucket bounds
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        '''
+            Count one value
+        '''
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.total += value
+
+
+class MetricsRegistry:
+    '''
+        Metrics of the requests served by this worker process
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, route, status, seconds, timings):
+        '''
+            Record one finished request
+        '''
+        with self.lock:
+            metrics = self.routes.get(route)
+            if metrics is None:
+                metrics = self.routes[route] = {
+                    "latency": Histogram(LATENCY_BUCKETS),
+                    "queries": Histogram(QUERY_BUCKETS),
+                    "phases": {},
+                    "status": {},
+                }
+            metrics["latency"].observe(seconds)
+            metrics["queries"].observe(timings.queries)
+            for name, phase_seconds in timings.phases.items():
+                metrics["phases"][name] = metrics["phases"].get(name, 0.0) + phase_seconds
+            metrics["status"][status] = metrics["status"].get(status, 0) + 1
+
+    def clear(self):
+        '''
+            Forget every recorded request
+        '''
+        with self.lock:
+            self.routes = {}
+
+    def render(self):
+        '''
+            Metrics in the Prometheus text format
+        '''
+        lines = [
+            "# TYPE gifexplorer_request_duration_seconds histogram",
+            "# TYPE gifexplorer_request_db_queries histogram",
+            "# TYPE gifexplorer_request_phase_seconds_total counter",
+            "# TYPE gifexplorer_requests_total counter",
+        ]
+        with self.lock:
+            for route, metrics in sorted(self.routes.items()):
+                label = f'route="{route}"'
+                for name, histogram in (("duration_seconds", metrics["latency"]), ("db_queries", metrics["queries"])):
+                    for bound, count in zip(histogram.bounds, histogram.counts):
+                        lines.append(f'gifexplorer_request_{name}_bucket{{{label},le="{bound}"}} {count}')
+                    lines.append(f'gifexplorer_request_{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f"gifexplorer_request_{name}_sum{{{label}}} {histogram.total:g}")
+                    lines.append(f"gifexplorer_request_{name}_count{{{label}}} {histogram.count}")
+                for name, seconds in sorted(metrics["phases"].items()):
+                    lines.append(f'gifexplorer_request_phase_seconds_total{{{label},phase="{name}"}} {seconds:g}')
+                for status, count in sorted(metrics["status"].items()):
+                    lines.append(f'gifexplorer_requests_total{{{label},status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def count_query(execute, sql, params, many, context):
+    '''
+        Database execute wrapper counting the queries of a request
+    '''
+    timings = TIMINGS.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.add("db", time.perf_counter() - started)
+
+
+class TimingMiddleware:
+    '''
+        Time every request, add its phases as a Server-Timing header
+        and record it under its url route
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = TIMINGS.set(timings)
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                response = self.get_response(request)
+        finally:
+            TIMINGS.reset(token)
+        total = time.perf_counter() - started
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match is not None else "unmatched"
+        REGISTRY.observe(route, response.status_code, total, timings)
+        response["Server-Timing"] = timings.header(total)
+        return response
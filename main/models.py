@@ -4,6 +4,20 @@
 
 from django.db import models
 from django.db.models import DateTimeField
+from django.utils import timezone
+
+def skip_counters(instance, kwargs):
+    '''
+        Save kwargs that leave the counter columns of a loaded instance
+        out of a full save: they are only changed with F() updates, so
+        a stale copy must not write them back
+    '''
+    if not instance._state.adding and kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+        kwargs["update_fields"] = [
+            field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.name not in instance.COUNTER_FIELDS
+        ]
+    return kwargs
 
 class UserInfo(models.Model):
     '''
@@ -18,8 +32,14 @@ class UserInfo(models.Model):
     mail = models.CharField(max_length=100, blank=True)
     register_time = DateTimeField(auto_now_add=True)
     avatar = models.TextField(blank=True)
+    # legacy follow dicts, unpacked into Follow by manage.py migrate_follows
     followings = models.JSONField(null=True, blank=True, default=dict)
     followers = models.JSONField(null=True, blank=True, default=dict)
+    # counts of the Follow edges, only ever changed with F() updates
+    follower_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    # legacy like history, unpacked into GifLike and CommentLike by
+    # manage.py migrate_likes
     favorites = models.JSONField(null=True, blank=True, default=dict)
     comment_favorites = models.JSONField(null=True, blank=True, default=list)
     read_history = models.JSONField(null=True, blank=True, default=dict)
@@ -30,6 +50,26 @@ class UserInfo(models.Model):
     def __str__(self) -> str:
         return str(self.user_name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored name to notice renames on save
+        instance._loaded_user_name = instance.__dict__.get("user_name")
+        return instance
+
+    COUNTER_FIELDS = ("follower_count", "following_count")
+
+    def save(self, *args, **kwargs):
+        '''
+            Save the user, a rename is copied to the uploader_name of
+            the user's gifs
+        '''
+        loaded_user_name = getattr(self, "_loaded_user_name", None)
+        super().save(*args, **skip_counters(self, kwargs))
+        if loaded_user_name is not None and loaded_user_name != self.user_name:
+            GifMetadata.objects.filter(uploader_user_id=self.id).update(uploader_name=self.user_name)
+        self._loaded_user_name = self.user_name
+
     class Meta:
         '''
             set table name in db
@@ -81,17 +121,53 @@ class GifMetadata(models.Model):
     height = models.PositiveIntegerField(default=0)
     duration = models.FloatField(default=0.0)
     uploader = models.PositiveIntegerField(default=1)
+    # uploader as a foreign key and its name, filled on save and by
+    # manage.py backfill_uploaders for older rows; uploader stays the
+    # source of truth until every row is backfilled
+    uploader_user = models.ForeignKey(
+        UserInfo, null=True, blank=True, on_delete=models.SET_NULL, related_name="uploaded_gifs"
+    )
+    uploader_name = models.CharField(max_length=12, blank=True, default="")
     category = models.CharField(null=True, blank=True, max_length=20)
     tags = models.JSONField(null=True, blank=True, default=list)
+    # count of the GifLike rows, only ever changed with F() updates
     likes = models.PositiveIntegerField(default=0)
     pub_time = models.DateTimeField(auto_now_add=True)
     objects = models.Manager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored title to notice renames on save
+        instance._loaded_title = instance.__dict__.get("title")
+        return instance
+
+    COUNTER_FIELDS = ("likes",)
+
+    def save(self, *args, **kwargs):
+        '''
+            Save the gif, pointing uploader_user and uploader_name at
+            the uploader when it changed
+        '''
+        skip_counters(self, kwargs)
+        if self.uploader_user_id != self.uploader:
+            user_name = UserInfo.objects.filter(id=self.uploader).values_list("user_name", flat=True).first()
+            self.uploader_user_id = self.uploader if user_name is not None else None
+            self.uploader_name = user_name or ""
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = set(kwargs["update_fields"]) | {"uploader_user", "uploader_name"}
+        super().save(*args, **kwargs)
+        self._loaded_title = self.title
+
     class Meta:
         '''
-            set table name in db
+            set table name and indexes in db
         '''
         db_table = "gifmetadata"
+        indexes = [
+            models.Index(fields=["category", "-pub_time", "-id"], name="gif_category_time"),
+            models.Index(fields=["uploader", "-pub_time", "-id"], name="gif_uploader_time"),
+        ]
 
 class GifFile(models.Model):
     '''
@@ -116,10 +192,19 @@ class GifComment(models.Model):
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='replies')
     user = models.ForeignKey(UserInfo, on_delete=models.CASCADE)
     content = models.TextField(max_length=200)
+    # count of the CommentLike rows, only ever changed with F() updates
     likes = models.PositiveIntegerField(default=0)
     pub_time = models.DateTimeField(auto_now_add=True)
     objects = models.Manager()
 
+    COUNTER_FIELDS = ("likes",)
+
+    def save(self, *args, **kwargs):
+        '''
+            Save the comment, its likes counter left alone
+        '''
+        super().save(*args, **skip_counters(self, kwargs))
+
 class GifFingerprint(models.Model):
     '''
         model for gif fingerprint
@@ -147,9 +232,12 @@ class Message(models.Model):
 
     class Meta:
         '''
-            set table name in db
+            set table name and indexes in db
         '''
         db_table = "message"
+        indexes = [
+            models.Index(fields=["sender", "receiver", "-pub_time", "-id"], name="message_pair_time"),
+        ]
 
 class GifShare(models.Model):
     '''
@@ -183,3 +271,151 @@ class TaskInfo(models.Model):
             set table name in db
         '''
         db_table = "taskinfo"
+
+class SearchOutbox(models.Model):
+    '''
+        model for gif changes waiting to reach the search engine
+    '''
+    id = models.BigAutoField(primary_key=True)
+    gif_id = models.PositiveIntegerField(db_index=True)
+    action = models.CharField(max_length=10)
+    categories = models.JSONField(default=list)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    # sent to an external search engine; rows are kept until every
+    # process has applied them to its in-process indexes too
+    pushed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name in db
+        '''
+        db_table = "searchoutbox"
+
+class SearchOutboxConsumer(models.Model):
+    '''
+        model for a process applying the search outbox to its
+        in-process indexes, up to the watermark row id
+    '''
+    name = models.CharField(primary_key=True, max_length=200)
+    watermark = models.BigIntegerField(default=0)
+    seen_at = models.DateTimeField(default=timezone.now)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name in db
+        '''
+        db_table = "searchoutboxconsumer"
+
+class TrigramPosting(models.Model):
+    '''
+        model for trigram postings of gif titles and user names,
+        used by regex search where pg_trgm is not available
+    '''
+    id = models.BigAutoField(primary_key=True)
+    field = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    trigram = models.CharField(max_length=3)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name and indexes in db
+        '''
+        db_table = "trigramposting"
+        indexes = [
+            models.Index(fields=["field", "trigram", "object_id"], name="trigram_lookup"),
+            models.Index(fields=["field", "object_id"], name="trigram_object"),
+        ]
+
+class UserFeed(models.Model):
+    '''
+        model for the refresh state of a precomputed personalization
+        feed, the ranked gif ids themselves live in the feeds cache
+    '''
+    user_id = models.BigIntegerField(primary_key=True)
+    stale = models.BooleanField(default=False)
+    last_seen = models.DateTimeField(default=timezone.now)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+    # failed refreshes in a row, the feed is not tried again before retry_at
+    failures = models.PositiveIntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name and indexes in db
+        '''
+        db_table = "userfeed"
+        indexes = [
+            models.Index(fields=["stale", "last_seen"], name="userfeed_stale"),
+        ]
+
+class Follow(models.Model):
+    '''
+        model for a follow edge, follower follows followee
+    '''
+    id = models.BigAutoField(primary_key=True)
+    follower = models.ForeignKey(UserInfo, on_delete=models.CASCADE, related_name="following_edges")
+    followee = models.ForeignKey(UserInfo, on_delete=models.CASCADE, related_name="follower_edges")
+    created = models.DateTimeField(default=timezone.now)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name, constraints and indexes in db
+        '''
+        db_table = "follow"
+        constraints = [
+            models.UniqueConstraint(fields=["follower", "followee"], name="follow_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["follower", "-created", "-id"], name="follow_follower_time"),
+            models.Index(fields=["followee", "-created", "-id"], name="follow_followee_time"),
+        ]
+
+class GifLike(models.Model):
+    '''
+        model for a like of a gif by a user
+    '''
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(UserInfo, on_delete=models.CASCADE, related_name="gif_likes")
+    gif = models.ForeignKey(GifMetadata, on_delete=models.CASCADE, related_name="liked_by")
+    created = models.DateTimeField(default=timezone.now)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name, constraints and indexes in db
+        '''
+        db_table = "giflike"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "gif"], name="giflike_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "-created", "-id"], name="giflike_user_time"),
+        ]
+
+class CommentLike(models.Model):
+    '''
+        model for a like of a comment by a user
+    '''
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(UserInfo, on_delete=models.CASCADE, related_name="comment_likes")
+    comment = models.ForeignKey(GifComment, on_delete=models.CASCADE, related_name="liked_by")
+    created = models.DateTimeField(default=timezone.now)
+    objects = models.Manager()
+
+    class Meta:
+        '''
+            set table name and constraints in db
+        '''
+        db_table = "commentlike"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "comment"], name="commentlike_unique"),
+        ]
+
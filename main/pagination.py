@@ -0,0 +1,130 @@
+'''
+    Keyset pagination - listings newest first, each page taken after an
+    opaque cursor over its (timestamp, id) key. A page costs the same
+    whatever its depth; counting the pages is optional.
+'''
+import json
+import math
+import heapq
+import base64
+import binascii
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    '''
+        A cursor or page size the client sent is malformed
+    '''
+
+
+class Page:
+    '''
+        Items of one page, the cursor of the next page (None on the
+        last one) and the number of pages when it was asked for
+    '''
+    def __init__(self, items, next_cursor, page_count=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.page_count = page_count
+
+    def response(self, page_data):
+        '''
+            Data of a listing response with page_data as its items
+        '''
+        data = {"page_data": page_data, "next_cursor": self.next_cursor}
+        if self.page_count is not None:
+            data["page_count"] = self.page_count
+        return data
+
+
+def encode_cursor(timestamp, key):
+    '''
+        Opaque cursor of the last item of a page
+    '''
+    if hasattr(timestamp, "isoformat"):
+        timestamp = timestamp.isoformat()
+    payload = json.dumps([timestamp, key], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    '''
+        (timestamp, key) of a cursor, raise InvalidCursor
+    '''
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, key = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as error:
+        raise InvalidCursor("invalid cursor") from error
+    if not isinstance(timestamp, str) or not isinstance(key, (int, str)):
+        raise InvalidCursor("invalid cursor")
+    return timestamp, key
+
+
+def cursor_params(params, default_size, max_size):
+    '''
+        (cursor, size, count) of a request, from its query string or
+        json body: cursor is "" for the first page, count asks for
+        the page count. Raise InvalidCursor.
+    '''
+    cursor = params.get("cursor") or ""
+    if not isinstance(cursor, str):
+        raise InvalidCursor("invalid cursor")
+    try:
+        size = int(params.get("size", default_size))
+    except (TypeError, ValueError) as error:
+        raise InvalidCursor("invalid size") from error
+    if not 0 < size <= max_size:
+        raise InvalidCursor(f"size must be between 1 and {max_size}")
+    count = str(params.get("count", "")).lower() in ("1", "true")
+    return cursor, size, count
+
+
+def paginate_queryset(queryset, cursor, size, time_field="pub_time", count=False):
+    '''
+        Page of a queryset ordered by (time_field, id) descending,
+        one query (two with count); an index on those fields after
+        the filtered ones keeps it a range scan
+    '''
+    if cursor:
+        timestamp, key = decode_cursor(cursor)
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None or not isinstance(key, int):
+            raise InvalidCursor("invalid cursor")
+        after = queryset.filter(
+            Q(**{f"{time_field}__lt": timestamp}) | Q(**{time_field: timestamp, "id__lt": key})
+        )
+    else:
+        after = queryset
+    rows = list(after.order_by(f"-{time_field}", "-id")[:size + 1])
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(getattr(rows[-1], time_field), rows[-1].id)
+    page_count = math.ceil(queryset.count() / size) if count else None
+    return Page(rows, next_cursor, page_count)
+
+
+def paginate_pairs(pairs, cursor, size, count=False):
+    '''
+        Page of (key, timestamp) pairs such as the items of a
+        UserInfo json history, ordered by (timestamp, key) descending;
+        the pairs come with the user row, only the page is sorted
+    '''
+    def order(pair):
+        key, timestamp = pair
+        return str(timestamp), int(key) if str(key).isdigit() else 0, str(key)
+
+    candidates = pairs
+    if cursor:
+        timestamp, key = decode_cursor(cursor)
+        last = order((key, timestamp))
+        candidates = [pair for pair in pairs if order(pair) < last]
+    ordered = heapq.nlargest(size + 1, candidates, key=order)
+    next_cursor = None
+    if len(ordered) > size:
+        key, timestamp = ordered[size - 1]
+        next_cursor = encode_cursor(str(timestamp), key)
+    page_count = math.ceil(len(pairs) / size) if count else None
+    return Page(ordered[:size], next_cursor, page_count)
@@ -0,0 +1,200 @@
+'''
+    Item-to-item collaborative filtering - gifs favorited or read by
+    the same users, built offline by manage.py build_related_gifs
+'''
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+
+# neighbours kept per gif
+MAX_NEIGHBOURS = 50
+
+# a favorite counts more than a read
+FAVORITE_WEIGHT = 2.0
+READ_WEIGHT = 1.0
+
+# gifs per block of the co-occurrence product, one block per task
+BLOCK_SIZE = 2000
+
+# seconds between two checks of the neighbour file
+CHECK_INTERVAL = 60
+
+_WORKER = {}
+
+
+def interaction_matrix(rows):
+    '''
+        Sparse user x gif matrix from (liked gif ids, read_history) rows,
+        and the sorted gif ids of its columns
+    '''
+    user_rows, gif_ids, weights = [], [], []
+    for user_row, (favorites, read_history) in enumerate(rows):
+        items = {}
+        for gif_id in read_history or {}:
+            if str(gif_id).isdecimal():
+                items[int(gif_id)] = READ_WEIGHT
+        for gif_id in favorites or {}:
+            if str(gif_id).isdecimal():
+                items[int(gif_id)] = FAVORITE_WEIGHT
+        user_rows.extend([user_row] * len(items))
+        gif_ids.extend(items.keys())
+        weights.extend(items.values())
+    gif_ids = np.asarray(gif_ids, dtype=np.int64)
+    items = np.unique(gif_ids)
+    matrix = sparse.csr_matrix(
+        (np.asarray(weights, dtype=np.float32), (np.asarray(user_rows, dtype=np.int64), np.searchsorted(items, gif_ids))),
+        shape=(user_rows[-1] + 1 if user_rows else 0, len(items))
+    )
+    return items, matrix
+
+
+def _init_worker(matrix, count):
+    '''
+        Keep the matrix in the worker, it is sent once per process
+    '''
+    _WORKER["matrix"] = matrix
+    _WORKER["columns"] = matrix.T.tocsr()
+    _WORKER["norms"] = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    _WORKER["count"] = count
+
+
+def _neighbour_block(start, stop):
+    '''
+        Top neighbours of the gifs in columns [start, stop) by cosine
+        similarity of their user vectors
+    '''
+    count = _WORKER["count"]
+    norms = _WORKER["norms"]
+    block = (_WORKER["columns"][start:stop] @ _WORKER["matrix"]).tocsr()
+    neighbours = np.full((stop - start, count), -1, dtype=np.int32)
+    scores = np.zeros((stop - start, count), dtype=np.float32)
+    for row in range(stop - start):
+        begin, end = block.indptr[row], block.indptr[row + 1]
+        columns = block.indices[begin:end]
+        values = block.data[begin:end] / (norms[start + row] * norms[columns])
+        keep = columns != start + row
+        columns, values = columns[keep], values[keep]
+        if len(columns) > count:
+            top = np.argpartition(-values, count - 1)[:count]
+            columns, values = columns[top], values[top]
+        order = np.lexsort((columns, -values))
+        neighbours[row, :len(order)] = columns[order]
+        scores[row, :len(order)] = values[order]
+    return start, neighbours, scores
+
+
+def top_neighbours(matrix, count=MAX_NEIGHBOURS, workers=1, block_size=BLOCK_SIZE):
+    '''
+        Column indexes and scores of the count nearest gifs of every
+        gif, -1 padded; blocks of gifs are spread over a process pool
+    '''
+    size = matrix.shape[1]
+    neighbours = np.full((size, count), -1, dtype=np.int32)
+    scores = np.zeros((size, count), dtype=np.float32)
+    blocks = [(start, min(start + block_size, size)) for start in range(0, size, block_size)]
+    if workers <= 1:
+        _init_worker(matrix, count)
+        results = (_neighbour_block(start, stop) for start, stop in blocks)
+        for start, block_neighbours, block_scores in results:
+            neighbours[start:start + len(block_neighbours)] = block_neighbours
+            scores[start:start + len(block_scores)] = block_scores
+        _WORKER.clear()
+        return neighbours, scores
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(matrix, count)) as pool:
+        futures = [pool.submit(_neighbour_block, start, stop) for start, stop in blocks]
+        for future in futures:
+            start, block_neighbours, block_scores = future.result()
+            neighbours[start:start + len(block_neighbours)] = block_neighbours
+            scores[start:start + len(block_scores)] = block_scores
+    return neighbours, scores
+
+
+def save_neighbours(path, items, neighbours, scores):
+    '''
+        Write the neighbour arrays, atomically
+    '''
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        np.savez(file, items=items, neighbours=neighbours, scores=scores)
+    os.replace(temp_path, path)
+
+
+class RelatedGifs:
+    '''
+        Neighbour arrays loaded from the file written by the build
+        job, reloaded when it changes. Row i holds the neighbours of
+        gif items[i] as indexes into items, best first.
+    '''
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.items = np.zeros(0, dtype=np.int64)
+        self.neighbours = np.zeros((0, 0), dtype=np.int32)
+        self.scores = np.zeros((0, 0), dtype=np.float32)
+        self.mtime = None
+        self.checked_at = None
+
+    def refresh(self):
+        '''
+            Load the neighbour file if it changed since the last check
+        '''
+        with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < self.check_interval:
+                return
+            self.checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self.mtime:
+                    return
+                with np.load(self.path) as arrays:
+                    self.items = arrays["items"]
+                    self.neighbours = arrays["neighbours"]
+                    self.scores = arrays["scores"]
+                self.mtime = mtime
+            except (OSError, ValueError, KeyError) as error:
+                print(error)
+
+    def row(self, gif_id):
+        '''
+            Row of a gif, None if it has no neighbours
+        '''
+        index = int(np.searchsorted(self.items, gif_id))
+        if index < len(self.items) and self.items[index] == gif_id:
+            return index
+        return None
+
+    def related(self, gif_id, count=MAX_NEIGHBOURS):
+        '''
+            Ids of the gifs most often liked or read along with gif_id
+        '''
+        self.refresh()
+        index = self.row(gif_id)
+        if index is None:
+            return []
+        columns = self.neighbours[index, :count]
+        return [int(gif) for gif in self.items[columns[columns >= 0]]]
+
+    def blend(self, seed_ids, count=MAX_NEIGHBOURS):
+        '''
+            Ids of the gifs closest to a set of seed gifs, scores of the
+            neighbours of every seed summed; the seeds are left out
+        '''
+        self.refresh()
+        seeds = set(seed_ids)
+        totals = {}
+        for gif_id in seeds:
+            index = self.row(gif_id)
+            if index is None:
+                continue
+            for column, score in zip(self.neighbours[index], self.scores[index]):
+                if column < 0:
+                    break
+                neighbour = int(self.items[column])
+                if neighbour not in seeds:
+                    totals[neighbour] = totals.get(neighbour, 0.0) + float(score)
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+        return [gif_id for gif_id, _ in ranked[:count]]
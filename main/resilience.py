@@ -0,0 +1,109 @@
+'''
+    Calls to remote services - bounded retries with jitter and a
+    circuit breaker
+'''
+import time
+import random
+import threading
+
+
+class ServiceUnavailable(Exception):
+    '''
+        The service failed or its circuit breaker is open
+    '''
+
+
+def retry_call(func, attempts, base_delay, max_delay, retry_on, sleep=time.sleep):
+    '''
+        Call func, calling it again up to attempts times in all while
+        retry_on(error) holds, sleeping a random time below an
+        exponentially growing cap in between (full jitter)
+    '''
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as error:  # pylint: disable=broad-except
+            if attempt == attempts - 1 or not retry_on(error):
+                raise
+            sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+    raise ValueError("attempts must be positive")
+
+
+class CircuitBreaker:
+    '''
+        Counts consecutive failures of a service. After
+        failure_threshold of them the circuit opens and calls fail
+        fast for reset_timeout seconds, then a single trial call is let
+        through: success closes the circuit, failure opens it again.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        '''
+            "closed", "open" or "half-open"
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.clock() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def allow(self):
+        '''
+            Whether a call may go through now
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        '''
+            Close the circuit
+        '''
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        '''
+            Count a failure, open the circuit at the threshold or
+            when the trial call failed
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial = False
+
+    def call(self, func, is_failure=lambda error: True):
+        '''
+            Call func through the breaker. Errors for which is_failure
+            holds count against the service and are raised as
+            ServiceUnavailable, other errors are raised unchanged.
+        '''
+        if not self.allow():
+            raise ServiceUnavailable("circuit open")
+        try:
+            result = func()
+        except Exception as error:
+            if not is_failure(error):
+                self.record_success()
+                raise
+            self.record_failure()
+            raise ServiceUnavailable(str(error)) from error
+        self.record_success()
+        return result
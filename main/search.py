@@ -7,10 +7,259 @@ Contact: luty21@mails.tsinghua.edu.cn
 # import pycorrector
 # import re
 import json
-from elasticsearch import Elasticsearch
+from abc import ABC, abstractmethod
+from django.conf import settings
+from elasticsearch import Elasticsearch, ConnectionError as TransportConnectionError, TransportError
+from elasticsearch.helpers import bulk, BulkIndexError
+from .search_log import SearchLogWriter
+from .resilience import CircuitBreaker, ServiceUnavailable, retry_call
 
+# hits returned when no page is requested
+MAX_HITS = 1000
 
-class ElasticSearchEngine():
+MAX_PAGE_SIZE = 20
+
+# deepest hit reachable with from/size, see index.max_result_window
+MAX_RESULT_WINDOW = 10000
+
+# hits fetched per request while walking deep pages with search_after
+SEARCH_AFTER_CHUNK = 1000
+
+# seconds of the first retry backoff cap, doubled on each attempt
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 0.5
+
+# statuses of an overloaded or restarting cluster
+UNAVAILABLE_STATUSES = (429, 502, 503, 504)
+
+
+def is_unavailable(error):
+    """
+    [unavailable]
+        Whether an error of the client means the cluster is down or
+        overloaded, rather than a bad request.
+    """
+    if isinstance(error, TransportConnectionError):
+        return True
+    return isinstance(error, TransportError) and error.status_code in UNAVAILABLE_STATUSES
+
+
+class SearchHits(list):
+
+    """
+    [SearchHits]
+        list of gif ids which also carries the total number of hits,
+        so a single page of ids is enough to compute page_count.
+        degraded is set on hits of a fallback while the engine is
+        unavailable.
+    """
+
+    degraded = False
+
+    def __init__(self, ids=(), total=None):
+        super().__init__(ids)
+        self.total = len(self) if total is None else total
+
+    def page(self, page, size=MAX_PAGE_SIZE):
+        '''
+            Slice one 0-based page out of the ids held,
+            None if the page lies past them
+        '''
+        end = (page + 1) * size
+        if end > len(self) and len(self) < self.total:
+            return None
+        hits = SearchHits(self[page * size:end], self.total)
+        hits.degraded = self.degraded
+        return hits
+
+    def page_count(self, size=MAX_PAGE_SIZE):
+        '''
+            Number of pages of the given size
+        '''
+        return -(-self.total // size)
+
+
+class SearchEngine(ABC):
+
+    """
+    [SearchEngine]
+        Interface shared by every search backend. The backend used by
+        the app is chosen by SEARCH_BACKEND in settings and built once
+        in config.py.
+
+    - search function
+        |- search_perfect
+        |- search_partial
+        |- search_related
+        |- search_fuzzy
+    - suggest function
+        |- suggest_search
+        |- personalization_search
+        |- hotwords_search
+        |- correct_search
+        |- suggest_and_correct
+    - synchronization function
+        |- post_metadata
+        |- delete_metadata
+        |- bulk_post_metadata
+        |- bulk_delete_metadata
+
+    in_process is True for backends whose index lives in the worker,
+    each process then applies the search outbox to its own index from
+    the catch-up thread of its OutboxConsumer (see search_outbox.py).
+    """
+
+    in_process = False
+
+    @abstractmethod
+    def search_perfect(self, request, page=None, size=MAX_PAGE_SIZE):
+        """
+        [perfect match]
+            request: dic of filter info, see ElasticSearchEngine
+            page: 0-based page index, None for every hit
+            size: number of hits per page
+            return: SearchHits of gif ids, sorted by correlation scores
+        """
+
+    @abstractmethod
+    def search_partial(self, request, page=None, size=MAX_PAGE_SIZE):
+        """
+        [partial match]
+            request: dic of filter info, see ElasticSearchEngine
+            page: 0-based page index, None for every hit
+            size: number of hits per page
+            return: SearchHits of gif ids, sorted by correlation scores
+        """
+
+    @abstractmethod
+    def search_related(self, request, page=None, size=MAX_PAGE_SIZE):
+        """
+        [related search]
+            request: dic of filter info, see ElasticSearchEngine
+            page: 0-based page index, None for every hit
+            size: number of hits per page
+            return: SearchHits of gif ids, sorted by correlation scores
+        """
+
+    @abstractmethod
+    def search_fuzzy(self, request, page=None, size=MAX_PAGE_SIZE):
+        """
+        [fuzzy match]
+            request: dic of filter info, see ElasticSearchEngine
+            page: 0-based page index, None for every hit
+            size: number of hits per page
+            return: SearchHits of gif ids, sorted by correlation scores
+        """
+
+    @abstractmethod
+    def hotwords_search(self):
+        """
+        [hot words]
+            return: list of hot candidate words
+        """
+
+    @abstractmethod
+    def personalization_search(self, tag_fre):
+        """
+        [personlization]
+            tag_fre(dic): tag frequency table, {"animal": 1.0, "cute": 0.2}
+            return: list of gif ids
+        """
+
+    @abstractmethod
+    def suggest_search(self, user_input):
+        """
+        [suggest]
+            user_input(str): prefix typed in by user
+            return: list of suggestion string
+        """
+
+    @abstractmethod
+    def post_metadata(self, data):
+        """
+        [post meta data]
+            data(dict): necessary metadata for SEARCH, see ElasticSearchEngine
+        """
+
+    @abstractmethod
+    def correct_search(self, input, target):
+        """
+        [correct user input]
+            input(str): input from user
+            target(str): title(default) or uploader
+            return: list of suggestion string
+        """
+
+    def suggest_and_correct(self, user_input, target):
+        """
+        [suggest and correct]
+            user_input(str): prefix typed in by user
+            target(str): title(default) or uploader
+            return: (list of suggestion string, list of correction string)
+        """
+        return self.suggest_search(user_input), self.correct_search(input=user_input, target=target)
+
+    @abstractmethod
+    def delete_metadata(self, gif_id):
+        """
+        [delete meta data]
+            gif_id(int): id of a deleted gif, missing ids are ignored
+        """
+
+    def bulk_post_metadata(self, documents):
+        """
+        [bulk post meta data]
+            documents(list): metadata dicts as taken by post_metadata
+            return: number of documents indexed
+        """
+        for data in documents:
+            self.post_metadata(data)
+        return len(documents)
+
+    def bulk_delete_metadata(self, gif_ids):
+        """
+        [bulk delete meta data]
+            gif_ids(list): ids of deleted gifs, missing ids are ignored
+            return: number of ids handled
+        """
+        for gif_id in gif_ids:
+            self.delete_metadata(gif_id)
+        return len(gif_ids)
+
+
+def compile_query(request, match=None):
+    """
+    [query compiler]
+        Search body shared by the four search modes. Only the keyword
+        clause is scored, category, tags and ranges go to filter
+        context, where elastic search caches them and skips scoring.
+        Filters are emitted in a fixed order so that the same filter
+        combination gives the same body and hits the request cache.
+
+    [params]
+        request(dict): search request, see search_perfect
+        match(dict): keyword clause, None to match every gif
+
+    [return value]
+        search body
+    """
+
+    filters = []
+    if request["category"] != "":
+        filters.append({"term": {"category.keyword": request["category"]}})
+    # tags provided by user should be the subset of real gif tags
+    for tag in sorted(set(request["tags"])):
+        filters.append({"term": {"tags.keyword": tag}})
+    # width / height / duration ranges
+    filters += sorted(request["filter"], key=lambda clause: json.dumps(clause, sort_keys=True))
+
+    query = {"filter": filters}
+    if match is not None:
+        query["must"] = [match]
+    return {"query": {"bool": query}}
+
+
+class ElasticSearchEngine(SearchEngine):
 
     """
     [ElasticEngine]
@@ -28,8 +277,12 @@ class ElasticSearchEngine():
         |- personlization_search
         |- hotwords_search
         |- correct_search
+        |- suggest_and_correct
     - synchronization function
         |- post metadata
+        |- delete metadata
+        |- bulk post metadata
+        |- bulk delete metadata
     - test function
         |- test_search_perfect
         |- test_post_metadata
@@ -45,13 +298,121 @@ class ElasticSearchEngine():
     # bind to elastic search server
     def __init__(self):
         # self.client = Elasticsearch([{"host": "127.0.0.1", "port": 9200}])
+        # hosts, credentials and limits come from settings, see ELASTICSEARCH_*
         self.client = Elasticsearch(
-            ['https://router.nasuyun.com:9200'],
-            http_auth=('gif_search', '8BOeYq2P3t2JPWn6G6jfVB5top'),
-            scheme="https",
+            settings.ELASTICSEARCH_HOSTS,
+            http_auth=(settings.ELASTICSEARCH_USER, settings.ELASTICSEARCH_PASSWORD),
+            timeout=settings.ELASTICSEARCH_TIMEOUT,
+            maxsize=settings.ELASTICSEARCH_POOL_SIZE,
+            max_retries=0,
+        )
+        self.breaker = CircuitBreaker(
+            settings.ELASTICSEARCH_BREAKER_FAILURES,
+            settings.ELASTICSEARCH_BREAKER_RESET
+        )
+        # searched keywords are written to message_index in the background
+        self.search_log = SearchLogWriter(self.client)
+
+    def query(self, **kwargs):
+        """
+        [query]
+            Run client.search with bounded retries through the circuit
+            breaker. Connection errors, timeouts and overload statuses
+            are retried with jitter and count as failures of the
+            cluster; once the breaker opens, calls fail fast.
+
+        [params]
+            kwargs: arguments of client.search
+
+        [return value]
+            search response, raise ServiceUnavailable if the cluster
+            failed or the breaker is open
+        """
+
+        return self.breaker.call(
+            lambda: retry_call(
+                lambda: self.client.search(**kwargs),
+                settings.ELASTICSEARCH_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, is_unavailable
+            ),
+            is_unavailable
         )
 
-    def search_perfect(self, request):
+    def run_search(self, body, search_text, page, size):
+        """
+        [run search]
+            Queue the keyword for the search log and run a search body
+            against the gif index.
+            A page is fetched with from/size and without _source, pages
+            past MAX_RESULT_WINDOW are reached by walking search_after.
+            Searches within the window ask for the shard request cache,
+            repeated filter combinations are served from it, see
+            compile_query.
+
+        [params]
+            body(dict): search body with a query
+            search_text(str): keyword typed in by user
+            page(int): 0-based page index, None for the first 1000 hits
+            size(int): number of hits per page
+
+        [return value]
+            SearchHits of gif ids
+        """
+
+        if search_text != "":
+            self.search_log.log(search_text)
+        # a stable sort so that from/size and search_after agree
+        body["sort"] = [{"_score": "desc"}, {"id": "asc"}]
+        body["_source"] = False
+        body["track_total_hits"] = True
+        if page is None:
+            response = self.query(
+                index="gif", body=body, size=MAX_HITS, preference="primary", request_cache=True
+            )
+            return SearchHits(
+                [hit["_id"] for hit in response["hits"]["hits"]],
+                response["hits"]["total"]["value"]
+            )
+
+        start = page * size
+        if start + size <= MAX_RESULT_WINDOW:
+            body["from"] = start
+            body["size"] = size
+            response = self.query(index="gif", body=body, preference="primary", request_cache=True)
+            return SearchHits(
+                [hit["_id"] for hit in response["hits"]["hits"]],
+                response["hits"]["total"]["value"]
+            )
+
+        # deep page: skip whole chunks with search_after, only sort values are read
+        body["size"] = SEARCH_AFTER_CHUNK
+        skipped = 0
+        hits = []
+        total = 0
+        while True:
+            response = self.query(
+                index="gif", body=body, preference="primary",
+                filter_path="hits.total,hits.hits._id,hits.hits.sort"
+            )
+            total = response["hits"]["total"]["value"]
+            hits = response["hits"].get("hits", [])
+            if not hits or skipped + len(hits) > start:
+                break
+            skipped += len(hits)
+            body["search_after"] = hits[-1]["sort"]
+        offset = start - skipped
+        ids = [hit["_id"] for hit in hits[offset:offset + size]]
+        if len(ids) < size and len(hits) == SEARCH_AFTER_CHUNK:
+            # the page spans two chunks
+            body["search_after"] = hits[-1]["sort"]
+            body["size"] = size - len(ids)
+            response = self.query(
+                index="gif", body=body, preference="primary",
+                filter_path="hits.hits._id"
+            )
+            ids += [hit["_id"] for hit in response.get("hits", {}).get("hits", [])]
+        return SearchHits(ids, total)
+
+    def search_perfect(self, request, page=None, size=MAX_PAGE_SIZE):
         """
         [perfect match]
             This function is used to search gifs with a particular title
@@ -72,9 +433,13 @@ class ElasticSearchEngine():
                 "tags": [str1, str2, str3 ...] (default=[])
             }
             all segments are optional!
+            page: 0-based page index, None for the first 1000 hits
+            size: number of hits per page
 
         [return value]
-            list of gif ids, sorted by correlation scores
+            SearchHits of gif ids, sorted by correlation scores.
+            Only ids of the given page (0-based) are returned when
+            page is not None, hits.total is the number of all hits.
         """
 
         # query example
@@ -82,16 +447,12 @@ class ElasticSearchEngine():
         #     "query": {
         #         "bool": {
         #             "must": [
-        #                 {"term": {"title.keyword": "still dog"}},
-        #                 {"term": {"category.keyword": "animal"}}
-        #                 {"terms_set": {
-        #                     "tags": {
-        #                         "terms": ["animal", "cat"],
-        #                         "minimum_should_match_script": {
-        #                             "source": "2"
-        #                         }
-        #                     }
-        #                 }}
+        #                 {"term": {"title.keyword": "still dog"}}
+        #             ],
+        #             "filter": [
+        #                 {"term": {"category.keyword": "animal"}}, # optional
+        #                 {"term": {"tags.keyword": "animal"}},
+        #                 {"term": {"tags.keyword": "cat"}},
         #                 {"range": {"width": {"gte": 1, "lte": 2}}},
         #                 {"range": {"height": {"gte": 1, "lte": 2}}},
         #                 {"range": {"duration": {"gte": 1, "lte": 2}}}
@@ -100,55 +461,17 @@ class ElasticSearchEngine():
         #     }
         # }
 
-        body = {
-            "query": {
-                "bool": {
-                    "must": []
-                }
-            }
-        }
-
         # match title or uploader
-        must_array = []
-        target = request["target"]
         search_text = request["keyword"]
-        if target == "uploader":
-            must_array.append(
-                {"term": {"uploader.keyword": search_text}})
-        elif target == "title":
-            must_array.append({"term": {"title.keyword": search_text}})
-
-        # filter width / height / duration
-        must_array += request["filter"]
-
-        # filter category
-        if request["category"] != "":
-            must_array.append(
-                {"term": {"category.keyword": request["category"]}})
-
-        # filter tags
-        # tags provided by user should be the subset of real gif tags
-        tags = request["tags"]
-        if tags:
-            must_array.append({"terms_set": {
-                "tags.keyword": {
-                    "terms": tags,
-                    "minimum_should_match_script": {
-                        "source": str(len(tags))
-                    }
-                }
-            }})
+        match = None
+        if request["target"] == "uploader":
+            match = {"term": {"uploader.keyword": search_text}}
+        elif request["target"] == "title":
+            match = {"term": {"title.keyword": search_text}}
 
-        body["query"]["bool"]["must"] = must_array
-        if search_text != "":
-            self.client.index(
-                index="message_index", body={"message": search_text}
-            )
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
-        # hits_num = response["hits"]["total"]["value"]
-        return [hit["_id"] for hit in response["hits"]["hits"]]
+        return self.run_search(compile_query(request, match), search_text, page, size)
 
-    def search_partial(self, request):
+    def search_partial(self, request, page=None, size=MAX_PAGE_SIZE):
         """
         [partial match]
             This function allows you search gifs with a particular
@@ -172,7 +495,9 @@ class ElasticSearchEngine():
             all segments are optional
 
         [return value]
-            list of gif ids, sorted by correlation scores
+            SearchHits of gif ids, sorted by correlation scores.
+            Only ids of the given page (0-based) are returned when
+            page is not None, hits.total is the number of all hits.
         """
 
         # query example
@@ -185,16 +510,12 @@ class ElasticSearchEngine():
         #                         "query": "still dog",
         #                         "operator": "and"
         #                     }
-        #                 }},
+        #                 }}
+        #             ],
+        #             "filter": [
         #                 {"term": {"category.keyword": "animal"}}, # optional
-        #                 {"terms_set": {
-        #                     "tags": {
-        #                         "terms": ["animal", "cat"],
-        #                         "minimum_should_match_script": {
-        #                             "source": "2"
-        #                         }
-        #                     }
-        #                 }},
+        #                 {"term": {"tags.keyword": "animal"}},
+        #                 {"term": {"tags.keyword": "cat"}},
         #                 {"range": {"width": {"gte": 1, "lte": 2}}},
         #                 {"range": {"height": {"gte": 1, "lte": 2}}},
         #                 {"range": {"duration": {"gte": 1, "lte": 2}}}
@@ -203,72 +524,22 @@ class ElasticSearchEngine():
         #     }
         # }
 
-        body = {
-            "query": {
-                "bool": {
-                    "must": []
-                }
-            }
-        }
-
         # match title or uploader
-        must_array = []
-        target = request["target"]
         search_text = request["keyword"]
-        if target == "uploader":
-            must_array.append({
+        match = None
+        if request["target"] in ("uploader", "title"):
+            match = {
                 "match": {
-                    "uploader": {
-                        "query": request["keyword"],
-                        "operator": "and"
-                    }
-                }
-            })
-        elif target == "title":
-            must_array.append({
-                "match": {
-                    "title": {
-                        "query": request["keyword"],
+                    request["target"]: {
+                        "query": search_text,
                         "operator": "and"
                     }
                 }
-            })
-
-        # filter width / height / duration
-        must_array += request["filter"]
-
-        # filter category
-        if request["category"] != "":
-            must_array.append({
-                "term": {
-                    "category.keyword": request["category"]
-                }
-            })
-
-
-        # filter tags
-        # tags provided by user should be the subset of real gif tags
-        tags = request["tags"]
-        if tags:
-            must_array.append({"terms_set": {
-                "tags.keyword": {
-                    "terms": tags,
-                    "minimum_should_match_script": {
-                        "source": str(len(tags))
-                    }
-                }
-            }})
+            }
 
-        body["query"]["bool"]["must"] = must_array
-        if search_text != "":
-            self.client.index(
-                index="message_index", body={"message": search_text}
-            )
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
-        # hits_num = response["hits"]["total"]["value"]
-        return [hit["_id"] for hit in response["hits"]["hits"]]
+        return self.run_search(compile_query(request, match), search_text, page, size)
     
-    def search_related(self, request):
+    def search_related(self, request, page=None, size=MAX_PAGE_SIZE):
         """
         [related search]
             This function search targets based on relevant words.
@@ -288,7 +559,7 @@ class ElasticSearchEngine():
             }
 
         [return value]
-            list of gif ids
+            SearchHits of gif ids, see search_perfect
         """
 
         # query example
@@ -301,16 +572,12 @@ class ElasticSearchEngine():
         #                       "query": "done",
         #                        "analyzer": "my_analyzer"
         #                     }
-        #                   }},
-        #                 {"term": {"category.keyword": "animal"}} # optional
-        #                 {"terms_set": {
-        #                     "tags": {
-        #                         "terms": ["animal", "cat"],
-        #                         "minimum_should_match_script": {
-        #                             "source": "2"
-        #                         }
-        #                     }
-        #                 }}
+        #                   }}
+        #             ],
+        #             "filter": [
+        #                 {"term": {"category.keyword": "animal"}}, # optional
+        #                 {"term": {"tags.keyword": "animal"}},
+        #                 {"term": {"tags.keyword": "cat"}},
         #                 {"range": {"width": {"gte": 1, "lte": 2}}},
         #                 {"range": {"height": {"gte": 1, "lte": 2}}},
         #                 {"range": {"duration": {"gte": 1, "lte": 2}}}
@@ -319,68 +586,22 @@ class ElasticSearchEngine():
         #     }
         # }
 
-        body = {
-            "query": {
-                "bool": {
-                    "must": []
-                }
-            }
-        }
-
         # match title or uploader
-        must_array = []
-        target = request["target"]
         search_text = request["keyword"]
-        if target == "uploader":
-            must_array.append({
-                "match": {
-                    "uploader": {
-                        "query": request["keyword"],
-                        "analyzer": "my_analyzer"
-                    }
-                }
-            })
-        elif target == "title":
-            must_array.append({
+        match = None
+        if request["target"] in ("uploader", "title"):
+            match = {
                 "match": {
-                    "title": {
-                        "query": request["keyword"],
+                    request["target"]: {
+                        "query": search_text,
                         "analyzer": "my_analyzer"
                     }
                 }
-            })
-
-        # filter width / height / duration
-        must_array += request["filter"]
-
-        # filter category
-        if request["category"] != "":
-            must_array.append(
-                {"term": {"category.keyword": request["category"]}})
-
-        # filter tags
-        # tags provided by user should be the subset of real gif tags
-        tags = request["tags"]
-        if tags:
-            must_array.append({"terms_set": {
-                "tags.keyword": {
-                    "terms": tags,
-                    "minimum_should_match_script": {
-                        "source": str(len(tags))
-                    }
-                }
-            }})
+            }
 
-        body["query"]["bool"]["must"] = must_array
-        if search_text != "":
-            self.client.index(
-                index="message_index", body={"message": search_text}
-            )
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
-        # hits_num = response["hits"]["total"]["value"]
-        return [hit["_id"] for hit in response["hits"]["hits"]]
+        return self.run_search(compile_query(request, match), search_text, page, size)
 
-    def search_fuzzy(self, request):
+    def search_fuzzy(self, request, page=None, size=MAX_PAGE_SIZE):
         '''
         [fuzzy match]
         [params]
@@ -398,86 +619,24 @@ class ElasticSearchEngine():
             }
             all segments are optional
         [return]
-            list of gif ids, sorted by correlation scores
+            SearchHits of gif ids, see search_perfect
         '''
 
-        body = {
-            "query": {
-                "bool": {
-                    "must": []
-                }
-            }
-        }
-
         # match title or uploader
-        must_array = []
         search_text = request["keyword"]
-        if request["target"] == "uploader":
-            # must_array.append({
-            #     "fuzzy": {
-            #         "title": {
-            #             "value": request["keyword"],
-            #             "fuzziness": "AUTO",
-            #             # "transpositions": True,
-            #             # fuzziness：最大编辑距离，一个字符串要与另一个字符串相同必须更改的一个字符数】。默认为AUTO。
-            #             # prefix_length：不会被“模糊化”的初始字符数。这有助于减少必须检查的术语数量。默认为0。
-            #             # max_expansions：fuzzy查询将扩展到的最大术语数。默认为50。
-            #             # transpositions：是否支持模糊转置（ab→ ba）。默认值为false。
-            #         }
-            #     }
-            # })
-            must_array.append({
-                "match": {
-                    "uploader": {
-                        "query": search_text,
-                        "fuzziness": "AUTO",
-                        "operator": "and"
-                    }
-                }
-            })
-        elif request["target"] == "title":
-            must_array.append({
+        match = None
+        if request["target"] in ("uploader", "title"):
+            match = {
                 "match": {
-                    "title": {
+                    request["target"]: {
                         "query": search_text,
                         "fuzziness": "AUTO",
                         "operator": "and"
                     }
                 }
-            })
-
-        # filter width / height / duration
-        must_array += request["filter"]
-
-        # filter category
-        if request["category"] != "":
-            must_array.append({
-                "term": {
-                    "category.keyword": request["category"]
-                }
-            })
-
-        # filter tags
-        # tags provided by user should be the subset of real gif tags
-        tags = request["tags"]
-        if tags:
-            must_array.append({"terms_set": {
-                "tags.keyword": {
-                    "terms": tags,
-                    "minimum_should_match_script": {
-                        "source": str(len(tags))
-                    }
-                }
-            }})
+            }
 
-        body["query"]["bool"]["must"] = must_array
-        if search_text != "":
-            self.client.index(
-                index="message_index", body={"message": search_text}
-            )
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
-        # hits_num = response["hits"]["total"]["value"]
-        return [hit["_id"] for hit in response["hits"]["hits"]]
+        return self.run_search(compile_query(request, match), search_text, page, size)
 
     def hotwords_search(self):
         """
@@ -502,7 +661,11 @@ class ElasticSearchEngine():
                 }
             }
         }
-        response = self.client.search(index="message_index", body=body)
+        try:
+            response = self.query(index="message_index", body=body)
+        except ServiceUnavailable as error:
+            print(error)
+            return []
         return [
             bucket["key"]
             for bucket in response["aggregations"]["messages"]["buckets"]
@@ -566,7 +729,11 @@ class ElasticSearchEngine():
                 }
             })
 
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
+        try:
+            response = self.query(index="gif", body=body, size=1000, preference="primary")
+        except ServiceUnavailable as error:
+            print(error)
+            return []
         # hits_num = response["hits"]["total"]["value"]
         return [hit["_id"] for hit in response["hits"]["hits"]]
 
@@ -609,12 +776,61 @@ class ElasticSearchEngine():
             }
         }
 
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
+        try:
+            response = self.query(index="gif", body=body, size=1000, preference="primary")
+        except ServiceUnavailable as error:
+            print(error)
+            return []
         return [
             op["_source"]["suggest"]
             for op in response["suggest"]["title_suggest"][0]["options"]
         ]
 
+    def suggest_and_correct(self, user_input, target):
+        """
+        [suggest and correct]
+            Completion and phrase suggestions of one input in a single
+            request, both suggesters run in the same round trip.
+
+        [params]
+            user_input(str): type in
+            target(str): title(default) or uploader
+
+        [return value]
+            (list of suggestion string, list of correction string)
+        """
+
+        body = {
+            "suggest": {
+                "title_suggest": {
+                    "prefix": user_input,
+                    "completion": {
+                        "field": "suggest",
+                        "skip_duplicates": True
+                    }
+                },
+                "correct": {
+                    "text": user_input,
+                    "phrase": {"field": target}
+                }
+            }
+        }
+
+        try:
+            response = self.query(index="gif", body=body, size=0, preference="primary")
+        except ServiceUnavailable as error:
+            print(error)
+            return [], []
+        suggestions = [
+            op["_source"]["suggest"]
+            for op in response["suggest"]["title_suggest"][0]["options"]
+        ]
+        corrections = [
+            option["text"]
+            for option in response["suggest"]["correct"][0]["options"]
+        ]
+        return suggestions, corrections
+
     def post_metadata(self, data):
         """
         [post meta data]
@@ -654,6 +870,62 @@ class ElasticSearchEngine():
         )
         return response
 
+    def bulk_post_metadata(self, documents):
+        """
+        [bulk post meta data]
+            Index many gifs with one bulk request, used by reindex_gifs.
+
+        [params]
+            documents(list): metadata dicts, see post_metadata
+
+        [return value]
+            number of documents indexed, raise BulkIndexError if any failed
+        """
+
+        actions = []
+        for data in documents:
+            data["suggestion"] = data["title"]
+            actions.append({"_index": "gif", "_id": int(data["id"]), "_source": data})
+        success, _ = bulk(self.client, actions, chunk_size=max(len(actions), 1))
+        return success
+
+    def delete_metadata(self, gif_id):
+        """
+        [delete meta data]
+            This function is called when a gif is deleted.
+
+        [params]
+            gif_id(int): id of the gif, a missing document is not an error
+
+        [return value]
+            response of relevant es request
+        """
+
+        return self.client.delete(index="gif", id=int(gif_id), ignore=[404])
+
+    def bulk_delete_metadata(self, gif_ids):
+        """
+        [bulk delete meta data]
+            Delete many gifs with one bulk request.
+
+        [params]
+            gif_ids(list): ids of deleted gifs
+
+        [return value]
+            number of ids handled, raise BulkIndexError if any failed
+            for another reason than a missing document
+        """
+
+        actions = [
+            {"_op_type": "delete", "_index": "gif", "_id": int(gif_id)}
+            for gif_id in gif_ids
+        ]
+        _, errors = bulk(self.client, actions, chunk_size=max(len(actions), 1), raise_on_error=False)
+        errors = [error for error in errors if error.get("delete", {}).get("status") != 404]
+        if errors:
+            raise BulkIndexError(f"{len(errors)} document(s) failed to delete.", errors)
+        return len(actions)
+
     def correct_search(self, input, target):
         """
         [correct user input]
@@ -680,7 +952,11 @@ class ElasticSearchEngine():
         body["suggest"]["correct"]["phrase"] = phrase
         body["suggest"]["correct"]["text"] = input
 
-        response = self.client.search(index="gif", body=body, size=1000, preference="primary")
+        try:
+            response = self.query(index="gif", body=body, size=1000, preference="primary")
+        except ServiceUnavailable as error:
+            print(error)
+            return []
         return [
             option["text"]
             for option in response["suggest"]["correct"][0]["options"]
@@ -690,6 +966,11 @@ class ElasticSearchEngine():
 # end ElasticSearchEngine
 
 
+# The test_* functions below need the live cluster. To measure or check
+# the engine offline, run it against the stand-in in benchmarks/, see
+# benchmarks/search_modes.py.
+
+
 def test_search_perfect():
     """
     Unit test for perfect_metadata
@@ -0,0 +1,229 @@
+'''
+    Search result cache shared by views - LRU + TTL with write invalidation
+'''
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from django.core.cache import caches
+from .metrics import timed
+
+KEY_PREFIX = "search"
+
+
+def counter_seed():
+    '''
+        First value of a shared counter, above any value it held before
+        it was evicted as long as it was not increased more than once a
+        microsecond on average
+    '''
+    return time.time_ns() // 1000
+
+
+class MemoryCacheBackend:
+    '''
+        Per-process cache backend, O(1) LRU eviction and per-entry TTL.
+        Pinned entries live in their own LRU so that bursts of one-off
+        queries cannot push them out before they expire
+    '''
+    def __init__(self, max_entries, max_pinned=0):
+        self.max_entries = max_entries
+        self.max_pinned = max_pinned
+        self.entries = OrderedDict()
+        self.pinned = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+            Get a value, None if missing or expired
+        '''
+        with self.lock:
+            for entries in (self.pinned, self.entries):
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                value, expire_at = entry
+                if expire_at < time.monotonic():
+                    del entries[key]
+                    return None
+                entries.move_to_end(key)
+                return value
+            return None
+
+    def set(self, key, value, ttl, pin=False):
+        '''
+            Set a value which expires after ttl seconds
+        '''
+        with self.lock:
+            if pin and self.max_pinned > 0:
+                entries, max_entries = self.pinned, self.max_pinned
+                self.entries.pop(key, None)
+            else:
+                entries, max_entries = self.entries, self.max_entries
+                self.pinned.pop(key, None)
+            entries[key] = (value, time.monotonic() + ttl)
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def delete(self, key):
+        '''
+            Delete a value
+        '''
+        with self.lock:
+            self.entries.pop(key, None)
+            self.pinned.pop(key, None)
+
+    def get_counter(self, key):
+        '''
+            Get a counter, counters are never evicted
+        '''
+        with self.lock:
+            return self.counters.get(key, 0)
+
+    def incr_counter(self, key):
+        '''
+            Increase a counter by one
+        '''
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        '''
+            Drop every entry and counter
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.counters.clear()
+
+
+class DjangoCacheBackend:
+    '''
+        Cache backend on a django cache alias (file, memcached, redis ...),
+        shared by every worker using the same cache location
+    '''
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        '''
+            Get a value, None if missing or expired
+        '''
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl, pin=False):
+        '''
+            Set a value which expires after ttl seconds,
+            eviction is left to the cache server so pin is advisory
+        '''
+        self.cache.set(key, value, ttl)
+
+    def delete(self, key):
+        '''
+            Delete a value
+        '''
+        self.cache.delete(key)
+
+    def get_counter(self, key):
+        '''
+            Get a counter. The cache may evict it like any entry, so a
+            missing counter starts again from the current time in
+            microseconds: it never goes back to a value that was used
+            before, and entries of old generations are never read again
+        '''
+        value = self.cache.get(key)
+        if value is None:
+            self.cache.add(key, counter_seed(), None)
+            value = self.cache.get(key, 0)
+        return value
+
+    def incr_counter(self, key):
+        '''
+            Increase a counter by one
+        '''
+        self.cache.add(key, counter_seed(), None)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # evicted between add and incr
+            value = counter_seed()
+            self.cache.set(key, value, None)
+            return value
+
+    def clear(self):
+        '''
+            Drop every entry and counter
+        '''
+        self.cache.clear()
+
+
+class SearchCache:
+    '''
+        Cache of search results keyed by helpers.generate_cache_body.
+        A result is the ranked id list of a query (SearchHits), pages
+        are sliced from it. Lists prefetched by a first page are pinned
+        for pin_ttl seconds so the following pages keep hitting.
+
+        Every key embeds the generation of its category. Indexing a gif
+        bumps the generation of its category and of "" (any category),
+        so affected entries are never read again and age out by LRU/TTL.
+    '''
+    def __init__(self, backend, ttl, pin_ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.pin_ttl = pin_ttl or ttl
+
+    def generation_key(self, category):
+        '''
+            Key of the generation counter of a category
+        '''
+        digest = hashlib.md5(category.encode("utf-8")).hexdigest()
+        return f"{KEY_PREFIX}:generation:{digest}"
+
+    def entry_key(self, cache_body, category):
+        '''
+            Key of a cached result in the current generation
+        '''
+        generation = self.backend.get_counter(self.generation_key(category))
+        digest = hashlib.md5(cache_body.encode("utf-8")).hexdigest()
+        return f"{KEY_PREFIX}:{generation}:{digest}"
+
+    @timed("cache")
+    def get(self, cache_body, category):
+        '''
+            Get cached result, None on miss
+        '''
+        return self.backend.get(self.entry_key(cache_body, category))
+
+    @timed("cache")
+    def set(self, cache_body, category, value, pin=False):
+        '''
+            Cache a result, pinned results are kept for pin_ttl
+        '''
+        ttl = self.pin_ttl if pin else self.ttl
+        self.backend.set(self.entry_key(cache_body, category), value, ttl, pin)
+
+    def invalidate(self, categories):
+        '''
+            Invalidate results which may contain gifs of the categories
+        '''
+        for category in {""} | {category or "" for category in categories}:
+            self.backend.incr_counter(self.generation_key(category))
+
+    def clear(self):
+        '''
+            Drop the whole cache
+        '''
+        self.backend.clear()
+
+
+def create_search_cache(backend, alias, max_entries, ttl, max_pinned=0, pin_ttl=None):
+    '''
+        Build the search cache from settings
+    '''
+    if backend == "django":
+        return SearchCache(DjangoCacheBackend(alias), ttl, pin_ttl)
+    return SearchCache(MemoryCacheBackend(max_entries, max_pinned), ttl, pin_ttl)
@@ -0,0 +1,151 @@
+'''
+    Search log writer - buffers searched keywords in process and
+    bulk indexes them from a background thread
+'''
+import os
+import time
+import queue
+import atexit
+import threading
+from elasticsearch.helpers import bulk
+
+MESSAGE_INDEX = "message_index"
+
+# keywords held in memory at most, newer ones are dropped when full
+MAX_QUEUED_MESSAGES = 10000
+
+# keywords sent per bulk request
+FLUSH_BATCH_SIZE = 500
+
+# seconds a keyword may wait before being flushed
+FLUSH_INTERVAL = 2.0
+
+# seconds allowed for the last flush on shutdown
+CLOSE_TIMEOUT = 5.0
+
+
+class SearchLogWriter:
+    '''
+        Non-blocking writer of the message index.
+
+        log() only puts the keyword into a bounded queue, a daemon
+        thread flushes the queue with the bulk API once FLUSH_BATCH_SIZE
+        keywords are waiting or FLUSH_INTERVAL has passed. When the
+        queue is full the keyword is dropped and counted, so a slow or
+        unreachable cluster never slows down searches. The thread is
+        started on first use in each process (workers fork after
+        import) and drained at interpreter exit.
+    '''
+    def __init__(self, client, index=MESSAGE_INDEX, max_queued=MAX_QUEUED_MESSAGES,
+                 batch_size=FLUSH_BATCH_SIZE, interval=FLUSH_INTERVAL):
+        self.client = client
+        self.index = index
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(max_queued)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        '''
+            Start the flush thread of this process if it is not running
+        '''
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                # a forked child must not flush keywords queued by its parent
+                self.queue = queue.Queue(self.max_queued)
+                atexit.register(self.close)
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name="search-log-writer", daemon=True)
+            self.thread.start()
+
+    def log(self, message):
+        '''
+            Queue a searched keyword without blocking
+        '''
+        if self.pid != os.getpid() or self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def take_batch(self, timeout):
+        '''
+            Wait up to timeout for the first keyword,
+            then take what is queued up to batch_size
+        '''
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def send(self, batch):
+        '''
+            Bulk index a batch of keywords, failures are only counted
+        '''
+        if not batch:
+            return
+        actions = (
+            {"_index": self.index, "_source": {"message": message}}
+            for message in batch
+        )
+        try:
+            sent, failed = bulk(self.client, actions, stats_only=True, raise_on_error=False)
+        except Exception:  # pylint: disable=broad-except
+            sent, failed = 0, len(batch)
+        self.sent += sent
+        self.failed += failed
+
+    def run(self):
+        '''
+            Flush loop of the background thread
+        '''
+        pending = []
+        deadline = time.monotonic() + self.interval
+        while not self.stopped.is_set():
+            pending += self.take_batch(max(deadline - time.monotonic(), 0.01))
+            if len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                self.send(pending)
+                pending = []
+                deadline = time.monotonic() + self.interval
+        self.send(pending)
+
+    def flush(self):
+        '''
+            Send every queued keyword from the calling thread
+        '''
+        while True:
+            batch = self.take_batch(0)
+            if not batch:
+                return
+            self.send(batch)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        '''
+            Stop the flush thread and send what is left
+        '''
+        self.stopped.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                # the cluster is stuck, give up on what is left
+                return
+        self.flush()
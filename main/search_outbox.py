@@ -0,0 +1,357 @@
+'''
+    Search outbox - gif changes are written next to the gif in one
+    transaction and pushed to the search engine by a drainer. Every
+    process also applies them to its in-process indexes (the in-process
+    search engine, title suggester and spelling corrector) from the
+    background thread of its OutboxConsumer, rows are pruned once every
+    live consumer passed them
+'''
+import os
+import time
+import socket
+import logging
+import datetime
+import threading
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from . import config
+from .models import GifMetadata, UserInfo, SearchOutbox, SearchOutboxConsumer
+
+INDEX = "index"
+
+DELETE = "delete"
+
+# outbox rows handled per drain
+DRAIN_BATCH_SIZE = 500
+
+# seconds before the first retry, doubled for every failed attempt
+RETRY_DELAY = 5
+
+MAX_RETRY_DELAY = 3600
+
+# seconds between two catch-ups of a process outside its own writes
+CATCH_UP_INTERVAL = 2
+
+# False leaves catching up to explicit catch_up() calls, as in tests
+BACKGROUND_CATCH_UP = True
+
+# rows younger than this may still have uncommitted rows below them,
+# a consumer keeps its watermark behind them and rereads the window
+SETTLE_TIME = datetime.timedelta(seconds=60)
+
+# consumers not seen for this long are dropped and no longer hold rows,
+# they rebuild their indexes when they come back
+CONSUMER_TIMEOUT = datetime.timedelta(minutes=10)
+
+# name of the SearchOutboxConsumer row holding the last pruned row id
+PRUNED = "#pruned"
+
+logger = logging.getLogger(__name__)
+
+
+def generate_search_document(gif: GifMetadata, uploader_name: str):
+    '''
+        Generate the search engine document of a gif
+    '''
+    return {
+        "id": gif.id,
+        "title": gif.title,
+        "uploader": uploader_name,
+        "width": gif.width,
+        "height": gif.height,
+        "category": gif.category,
+        "tags": gif.tags,
+        "duration": gif.duration,
+        "pub_time": gif.pub_time.isoformat() if gif.pub_time else None,
+        "like": gif.likes,
+        "is_liked": False
+    }
+
+
+def enqueue(gif_id, action, categories):
+    '''
+        Write an outbox row in the current transaction. The in-process
+        search engine has nothing to push to, its rows only wait for
+        the consumers; the consumer of the writing process is woken
+        once it commits
+    '''
+    SearchOutbox.objects.create(
+        gif_id=gif_id,
+        action=action,
+        categories=sorted({category or "" for category in categories}),
+        pushed=getattr(config.SEARCH_ENGINE, "in_process", False)
+    )
+    transaction.on_commit(CONSUMER.wake)
+
+
+def enqueue_index(gif: GifMetadata, old_category=None):
+    '''
+        Queue a created or updated gif
+    '''
+    enqueue(gif.id, INDEX, [gif.category, old_category])
+
+
+def enqueue_delete(gif: GifMetadata):
+    '''
+        Queue a deleted gif
+    '''
+    enqueue(gif.id, DELETE, [gif.category])
+
+
+def retry_later(rows, error):
+    '''
+        Back off failed rows exponentially, they are never dropped
+    '''
+    now = timezone.now()
+    for row in rows:
+        delay = min(RETRY_DELAY * 2 ** row.attempts, MAX_RETRY_DELAY)
+        row.attempts += 1
+        row.next_attempt_at = now + datetime.timedelta(seconds=delay)
+        row.last_error = str(error)[:1000]
+    SearchOutbox.objects.bulk_update(rows, ["attempts", "next_attempt_at", "last_error"])
+
+
+def load_changes(rows):
+    '''
+        (gifs by id, search documents, deleted gif ids) of outbox rows,
+        read from the current state of the database
+    '''
+    changed_ids = {row.gif_id for row in rows}
+    gifs = GifMetadata.objects.in_bulk(changed_ids)
+    user_names = dict(
+        UserInfo.objects.filter(id__in={gif.uploader for gif in gifs.values()}).values_list("id", "user_name")
+    )
+    documents = [
+        generate_search_document(gif, user_names.get(gif.uploader, ""))
+        for gif in gifs.values()
+    ]
+    return gifs, documents, sorted(changed_ids - gifs.keys())
+
+
+def drain(batch_size=DRAIN_BATCH_SIZE, gif_ids=None):
+    '''
+        Push the oldest due rows to the search engine, return the number
+        of rows done.
+
+        Rows of one gif are coalesced: a gif is indexed from its current
+        row in the database, or deleted if it is gone, so replaying a
+        batch is harmless and several drainers may run at once. Pushed
+        rows stay until the consumers passed them, see prune().
+    '''
+    rows = SearchOutbox.objects.filter(pushed=False, next_attempt_at__lte=timezone.now())
+    if gif_ids is not None:
+        rows = rows.filter(gif_id__in=gif_ids)
+    rows = list(rows.order_by("id")[:batch_size])
+    if not rows:
+        prune()
+        return 0
+
+    categories = {category for row in rows for category in row.categories}
+    _, documents, deleted_ids = load_changes(rows)
+
+    search_engine = config.SEARCH_ENGINE
+    try:
+        if documents:
+            search_engine.bulk_post_metadata(documents)
+        if deleted_ids:
+            search_engine.bulk_delete_metadata(deleted_ids)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning("Pushing %d outbox rows failed: %s", len(rows), error)
+        retry_later(rows, error)
+        return 0
+
+    SearchOutbox.objects.filter(id__in=[row.id for row in rows]).update(pushed=True)
+    config.SEARCH_CACHE.invalidate(categories)
+    prune()
+    return len(rows)
+
+
+def prune():
+    '''
+        Drop consumers not seen for CONSUMER_TIMEOUT, then delete the
+        pushed rows every remaining consumer has passed; return the
+        number of rows deleted
+    '''
+    consumers = SearchOutboxConsumer.objects.exclude(name=PRUNED)
+    consumers.filter(seen_at__lt=timezone.now() - CONSUMER_TIMEOUT).delete()
+    bound = consumers.aggregate(bound=Min("watermark"))["bound"]
+    rows = SearchOutbox.objects.filter(pushed=True)
+    if bound is not None:
+        rows = rows.filter(id__lte=bound)
+    last_id = rows.aggregate(last=Max("id"))["last"]
+    if last_id is None:
+        return 0
+    with transaction.atomic():
+        deleted, _ = rows.filter(id__lte=last_id).delete()
+        marker, _ = SearchOutboxConsumer.objects.select_for_update().get_or_create(name=PRUNED)
+        if marker.watermark < last_id:
+            marker.watermark = last_id
+            marker.save(update_fields=["watermark"])
+    return deleted
+
+
+class OutboxConsumer:
+    '''
+        Outbox reader of one process. catch_up() applies the rows past
+        the process watermark to its in-process indexes and records the
+        watermark, so every uWSGI worker, the Celery worker and the
+        management commands see the writes of the others. The watermark
+        stays behind rows younger than SETTLE_TIME, rows committing out
+        of id order are picked up when the window is read again.
+
+        A consumer dropped by prune() while rows it had not read were
+        deleted expires its indexes, they are rebuilt from the database.
+        The indexes default to the ones of config, read at call time.
+
+        Requests only call start(), which starts a daemon thread running
+        catch_up() every interval seconds, or sooner when wake() is
+        called after a write of the process commits; like the rebuilds
+        of BackgroundIndex, no request waits for the database.
+    '''
+    def __init__(self, search_engine=None, suggester=None, corrector=None, name=None,
+                 interval=CATCH_UP_INTERVAL):
+        self.indexes = (search_engine, suggester, corrector)
+        self.given_name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.name = None
+        self.watermark = None
+        self.applied = set()
+        self.checked_at = None
+        self.thread_pid = None
+        self.woken = threading.Event()
+
+    def targets(self):
+        '''
+            (in-process search engine or None, suggester, corrector)
+        '''
+        search_engine, suggester, corrector = self.indexes
+        search_engine = search_engine or config.SEARCH_ENGINE
+        if not getattr(search_engine, "in_process", False):
+            search_engine = None
+        return search_engine, suggester or config.TITLE_SUGGESTER, corrector or config.SPELLING_CORRECTOR
+
+    def expire(self):
+        '''
+            Make every index rebuild from the database
+        '''
+        for index in self.targets():
+            if index is not None:
+                index.expire()
+
+    def apply(self, rows):
+        '''
+            Apply outbox rows to the indexes
+        '''
+        search_engine, suggester, corrector = self.targets()
+        gifs, documents, deleted_ids = load_changes(rows)
+        if search_engine is not None:
+            if documents:
+                search_engine.bulk_post_metadata(documents)
+            if deleted_ids:
+                search_engine.bulk_delete_metadata(deleted_ids)
+            config.SEARCH_CACHE.invalidate({category for row in rows for category in row.categories})
+        for gif in gifs.values():
+            suggester.add_gif(gif.id, gif.title, gif.likes)
+            corrector.add_text("title", gif.title)
+
+    def catch_up(self, force=False):
+        '''
+            Apply the rows written since the last catch-up, at most
+            once every interval seconds unless forced; return the
+            number of rows applied
+        '''
+        if not force and self.checked_at is not None and time.monotonic() - self.checked_at < self.interval:
+            return 0
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if self.pid != os.getpid():
+                # a forked worker is a consumer of its own
+                self.pid = os.getpid()
+                self.name = self.given_name or f"{socket.gethostname()}:{self.pid}:{id(self)}"
+                self.watermark = None
+            marks = dict(
+                SearchOutboxConsumer.objects.filter(name__in=[self.name, PRUNED]).values_list("name", "watermark")
+            )
+            pruned = marks.get(PRUNED, 0)
+            if self.name not in marks:
+                # first catch-up, or dropped meanwhile: replay what is left
+                if self.watermark is not None and self.watermark < pruned:
+                    self.expire()
+                self.watermark = pruned
+                self.applied = set()
+
+            cutoff = timezone.now() - SETTLE_TIME
+            applied = 0
+            settled = True
+            last_id = self.watermark
+            while True:
+                batch = list(SearchOutbox.objects.filter(id__gt=last_id).order_by("id")[:DRAIN_BATCH_SIZE])
+                rows = [row for row in batch if row.id not in self.applied]
+                if rows:
+                    self.apply(rows)
+                    self.applied.update(row.id for row in rows)
+                    applied += len(rows)
+                for row in batch:
+                    settled = settled and row.created_at <= cutoff
+                    if settled:
+                        self.watermark = row.id
+                if len(batch) < DRAIN_BATCH_SIZE:
+                    break
+                last_id = batch[-1].id
+            self.applied = {row_id for row_id in self.applied if row_id > self.watermark}
+            SearchOutboxConsumer.objects.update_or_create(
+                name=self.name, defaults={"watermark": self.watermark, "seen_at": timezone.now()}
+            )
+        if applied:
+            prune()
+        return applied
+
+    def start(self):
+        '''
+            Start the catch-up thread of this process, once; a forked
+            worker starts its own
+        '''
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+        threading.Thread(target=self.run, name="OutboxConsumer-catch-up", daemon=True).start()
+
+    def wake(self):
+        '''
+            Make the catch-up thread run now, starting it if needed
+        '''
+        self.woken.set()
+        if BACKGROUND_CATCH_UP:
+            self.start()
+
+    def run(self):
+        '''
+            Catch up every interval seconds or when woken, in the thread
+        '''
+        while True:
+            self.woken.clear()
+            try:
+                self.catch_up(force=True)
+            except Exception:  # pylint: disable=broad-except
+                # the indexes stay stale until the next round
+                logger.exception("Catching up with the search outbox failed")
+            finally:
+                connection.close()
+            self.woken.wait(self.interval)
+
+
+CONSUMER = OutboxConsumer()
+
+
+def start():
+    '''
+        Make sure this process applies the outbox in the background
+    '''
+    if BACKGROUND_CATCH_UP:
+        CONSUMER.start()
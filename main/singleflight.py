@@ -0,0 +1,97 @@
+'''
+    Request coalescing - one computation per key at a time, the
+    requests arriving meanwhile wait for it and share its result
+'''
+import time
+import hashlib
+import threading
+from django.core.cache import caches
+
+# seconds a waiter waits for the computation before running it itself
+MAX_WAIT = 30
+
+# seconds a result stays visible to other processes
+SHARED_RESULT_TTL = 1
+
+# seconds after which the lock of a crashed process expires
+SHARED_LOCK_TTL = 30
+
+SHARED_POLL_INTERVAL = 0.01
+
+_MISSING = object()
+
+
+class _Call:
+    '''
+        One computation in flight and the threads waiting for it
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+        Runs func once per key among the threads of a process asking
+        for it at the same time. With a cache alias, the processes
+        sharing that cache also take turns through a lock in it, and
+        the result is published there for SHARED_RESULT_TTL seconds.
+        Results are shared, callers must not modify them.
+    '''
+    def __init__(self, alias=None, max_wait=MAX_WAIT):
+        self.alias = alias
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        '''
+            Result of func for key, computed once per burst
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(self.max_wait):
+                return func()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self.run_shared(key, func) if self.alias else func()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def run_shared(self, key, func):
+        '''
+            Run func unless another process is running it for key,
+            in which case wait for its result
+        '''
+        cache = caches[self.alias]
+        digest = hashlib.md5(repr(key).encode("utf-8")).hexdigest()
+        lock_key = f"singleflight:lock:{digest}"
+        result_key = f"singleflight:result:{digest}"
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            result = cache.get(result_key, _MISSING)
+            if result is not _MISSING:
+                return result
+            if cache.add(lock_key, 1, SHARED_LOCK_TTL):
+                try:
+                    result = func()
+                    cache.set(result_key, result, SHARED_RESULT_TTL)
+                    return result
+                finally:
+                    cache.delete(lock_key)
+            if time.monotonic() > deadline:
+                return func()
+            time.sleep(SHARED_POLL_INTERVAL)
@@ -0,0 +1,162 @@
+'''
+    Spelling correction - symmetric delete (SymSpell) dictionaries of
+    title tokens and uploader names
+'''
+from collections import OrderedDict
+from .background import BackgroundIndex
+from .local_search import tokenize, fuzziness, edit_distance
+
+MAX_EDIT_DISTANCE = 2
+
+# only the leading chars of a word get deletes, longer words share them
+PREFIX_LENGTH = 7
+
+# seconds between two rebuilds from the database
+REBUILD_INTERVAL = 600
+
+MAX_MEMOIZED_CORRECTIONS = 10000
+
+TARGETS = ("title", "uploader")
+
+
+def deletes(word, max_distance):
+    '''
+        Every string reached by deleting up to max_distance chars of word
+    '''
+    result = {word}
+    edge = {word}
+    for _ in range(max_distance):
+        edge = {
+            item[:i] + item[i + 1:]
+            for item in edge if len(item) > 1
+            for i in range(len(item))
+        } - result
+        result |= edge
+    return result
+
+
+class SymSpell:
+    '''
+        Words and their frequency, plus the deletes of the first
+        PREFIX_LENGTH chars of every word. A misspelled word and the
+        right one share a delete whenever they are close, so a lookup
+        only checks the words filed under the deletes of its input.
+    '''
+    def __init__(self, max_distance=MAX_EDIT_DISTANCE, prefix_length=PREFIX_LENGTH):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.words = {}
+        self.deletes = {}
+
+    def add_word(self, word, count=1):
+        '''
+            Add count occurrences of a word
+        '''
+        if word in self.words:
+            self.words[word] += count
+            return
+        self.words[word] = count
+        for delete in deletes(word[:self.prefix_length], self.max_distance):
+            self.deletes.setdefault(delete, []).append(word)
+
+    def lookup(self, word, max_distance):
+        '''
+            Closest known word within max_distance, most frequent first
+            among equally close ones; None if there is none
+        '''
+        if word in self.words:
+            return word
+        max_distance = min(max_distance, self.max_distance)
+        best = None
+        seen = set()
+        for delete in deletes(word[:self.prefix_length], max_distance):
+            for candidate in self.deletes.get(delete, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(word, candidate, max_distance)
+                if distance <= max_distance:
+                    rank = (distance, -self.words[candidate], candidate)
+                    if best is None or rank < best:
+                        best = rank
+        return None if best is None else best[2]
+
+
+class SpellingCorrector(BackgroundIndex):
+    '''
+        Corrects queries token by token against the dictionary of the
+        target, with a bounded LRU of recent answers. Built in the
+        background (see BackgroundIndex), new gifs and users are added
+        in between. correct() returns None until the first build.
+    '''
+    def __init__(self, rebuild_interval=REBUILD_INTERVAL):
+        super().__init__(rebuild_interval)
+        self.dictionaries = {target: SymSpell() for target in TARGETS}
+        self.memo = OrderedDict()
+
+    def build(self, titles, user_names):
+        '''
+            Replace the dictionaries with the tokens of titles and user names
+        '''
+        dictionaries = {target: SymSpell() for target in TARGETS}
+        for title in titles:
+            for token in tokenize(title):
+                dictionaries["title"].add_word(token)
+        for user_name in user_names:
+            for token in tokenize(user_name):
+                dictionaries["uploader"].add_word(token)
+        with self.lock:
+            self.dictionaries = dictionaries
+            self.memo = OrderedDict()
+            self.mark_built()
+
+    def load(self):
+        '''
+            Build from every gif title and user name
+        '''
+        # pylint: disable=import-outside-toplevel
+        from .models import GifMetadata, UserInfo
+        self.build(
+            GifMetadata.objects.values_list("title", flat=True).iterator(chunk_size=5000),
+            UserInfo.objects.values_list("user_name", flat=True).iterator(chunk_size=5000)
+        )
+
+    def add_text(self, target, text):
+        '''
+            Add the tokens of a new title or user name
+        '''
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        with self.lock:
+            if not self.ready:
+                return
+            for token in tokens:
+                self.dictionaries[target].add_word(token)
+            self.memo = OrderedDict()
+
+    def correct(self, text, target="title"):
+        '''
+            List with the corrected text, empty if nothing was corrected,
+            None if the corrector is not built yet
+        '''
+        self.ensure_fresh()
+        target = target if target in TARGETS else "title"
+        tokens = tokenize(text)
+        key = (target, " ".join(tokens))
+        with self.lock:
+            if not self.ready:
+                return None
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return list(self.memo[key])
+            dictionary = self.dictionaries[target]
+            corrected = [
+                dictionary.lookup(token, max(fuzziness(token), 1)) or token
+                for token in tokens
+            ]
+            result = [" ".join(corrected)] if corrected != tokens else []
+            self.memo[key] = result
+            if len(self.memo) > MAX_MEMOIZED_CORRECTIONS:
+                self.memo.popitem(last=False)
+        return list(result)
@@ -0,0 +1,105 @@
+'''
+    Title autocomplete - sorted-array prefix suggester weighted by likes
+'''
+import heapq
+import bisect
+from .background import BackgroundIndex
+
+MAX_SUGGESTIONS = 5
+
+# seconds between two rebuilds from the database
+REBUILD_INTERVAL = 600
+
+# prefixes matching more titles than this have their answer memoized
+SCAN_LIMIT = 2000
+
+MAX_MEMOIZED_PREFIXES = 10000
+
+
+class PrefixSuggester(BackgroundIndex):
+    '''
+        Titles sorted by lower-case form, so the titles starting with a
+        prefix are one bisect range. The weight of a title is the sum
+        of likes + 1 of its gifs. Short prefixes cover long ranges,
+        their top titles are memoized until the next change.
+
+        Built in the background (see BackgroundIndex) and updated
+        between rebuilds by add_gif. suggest() returns None until the
+        first build is done.
+    '''
+    def __init__(self, rebuild_interval=REBUILD_INTERVAL):
+        super().__init__(rebuild_interval)
+        self.keys = []
+        self.titles = []
+        self.weights = {}
+        self.added = set()
+        self.memo = {}
+
+    def build(self, rows):
+        '''
+            Replace the suggester with (title, likes) rows
+        '''
+        weights = {}
+        for title, likes in rows:
+            if title:
+                weights[title] = weights.get(title, 0) + (likes or 0) + 1
+        entries = sorted((title.lower(), title) for title in weights)
+        with self.lock:
+            self.keys = [key for key, _ in entries]
+            self.titles = [title for _, title in entries]
+            self.weights = weights
+            self.added = set()
+            self.memo = {}
+            self.mark_built()
+
+    def load(self):
+        '''
+            Build from every gif title
+        '''
+        # pylint: disable=import-outside-toplevel
+        from .models import GifMetadata
+        self.build(GifMetadata.objects.values_list("title", "likes").iterator(chunk_size=5000))
+
+    def add_gif(self, gif_id, title, likes=0):
+        '''
+            Count a new gif until the next rebuild, once per gif
+        '''
+        if not title:
+            return
+        with self.lock:
+            if not self.ready or gif_id in self.added:
+                return
+            self.added.add(gif_id)
+            if title not in self.weights:
+                index = bisect.bisect_left(self.keys, title.lower())
+                self.keys.insert(index, title.lower())
+                self.titles.insert(index, title)
+                self.weights[title] = 0
+            self.weights[title] += (likes or 0) + 1
+            self.memo = {}
+
+    def suggest(self, prefix, count=MAX_SUGGESTIONS):
+        '''
+            Heaviest titles starting with prefix (case insensitive),
+            None if the suggester is not built yet
+        '''
+        self.ensure_fresh()
+        prefix = (prefix or "").lower()
+        with self.lock:
+            if not self.ready:
+                return None
+            memoized = self.memo.get((prefix, count))
+            if memoized is not None:
+                return list(memoized)
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)
+            best = heapq.nlargest(
+                count, range(start, end),
+                key=lambda index: (self.weights[self.titles[index]], -index)
+            )
+            result = [self.titles[index] for index in best]
+            if end - start > SCAN_LIMIT:
+                if len(self.memo) >= MAX_MEMOIZED_PREFIXES:
+                    self.memo = {}
+                self.memo[(prefix, count)] = result
+        return list(result)
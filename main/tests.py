@@ -3,13 +3,53 @@
 '''
 import time
 import uuid
+import os
+import json
+import tempfile
+from io import StringIO
 import datetime
+import threading
+from types import SimpleNamespace
+import hashlib
 from PIL import Image
+from elasticsearch import Elasticsearch, ConnectionError as TransportConnectionError, TransportError
+from elasticsearch.serializer import JSONSerializer
 from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.cache import caches
 from django.test import TestCase
+from django.utils import timezone
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 from django.core.files.uploadedfile import SimpleUploadedFile
-from main.models import UserInfo, GifMetadata, GifFile, UserVerification
+from GifExplorer import settings
+from benchmarks.es_standin import StandInElasticsearch
+from benchmarks.es_server import StandInServer
+from main.models import UserInfo, GifMetadata, GifFile, UserVerification, Message
 from . import helpers
+from .local_search import InvertedIndexSearchEngine
+from .search import ElasticSearchEngine, SearchHits, compile_query, is_unavailable
+from .resilience import CircuitBreaker, ServiceUnavailable, retry_call
+from .singleflight import SingleFlight
+from .search_cache import SearchCache, MemoryCacheBackend, DjangoCacheBackend
+from .search_log import SearchLogWriter
+from .hotwords import SpaceSaving, HotWords
+from .search_outbox import generate_search_document, drain, prune, OutboxConsumer
+from . import search_outbox
+from .models import SearchOutbox, SearchOutboxConsumer, TrigramPosting, UserFeed, GifComment, Follow, GifLike, CommentLike
+from . import trigram
+from .suggest import PrefixSuggester
+from .spelling import SymSpell, SpellingCorrector, deletes
+from .related import RelatedGifs
+from . import feeds
+from . import metrics
+from . import serializers
+from . import pagination
+from . import config
+
+# tests apply the outbox with explicit catch-ups, not from a thread
+search_outbox.BACKGROUND_CATCH_UP = False
 
 class ViewsTests(TestCase):
     '''
@@ -1860,6 +1900,27 @@ class ViewsTests(TestCase):
         self.assertEqual(res.json()["data"]["duplication"], False)
         helpers.delete_token_from_white_list(token)
 
+    def test_image_upload_atomic(self):
+        '''
+            Test a gif whose outbox row cannot be written is not created
+        '''
+        token = self.user_token[0]
+        helpers.add_token_to_white_list(token)
+        gif_count = GifMetadata.objects.count()
+        post_search_metadata = helpers.post_search_metadata
+
+        def failing_post(gif, old_category=None):
+            raise RuntimeError("outbox unavailable")
+        helpers.post_search_metadata = failing_post
+        try:
+            res = self.image_upload_with_correct_response_method(url="files/tests/Strawberry.gif", title="Strawberry", category="food", tags=["food", "strawberry"], token=token)
+        finally:
+            helpers.post_search_metadata = post_search_metadata
+        self.assertEqual(res.json()["code"], 1003)
+        self.assertEqual(GifMetadata.objects.count(), gif_count)
+        self.assertFalse(GifFile.objects.filter(metadata__title="Strawberry").exists())
+        helpers.delete_token_from_white_list(token)
+
     def test_image_upload_with_user_not_exist(self):
         '''
             Test image upload when user not exist
@@ -3325,3 +3386,2101 @@ class ViewsTests(TestCase):
         res = self.search_hotwords_with_worng_response_method()
         self.assertEqual(res.status_code, 404)
         self.assertEqual(res.json()["code"], 1000)
+
+class LocalSearchTests(TestCase):
+    '''
+        Test the in-process inverted index search engine
+    '''
+    def setUp(self):
+        self.engine = InvertedIndexSearchEngine(documents=[
+            {"id": 1, "title": "Still Dog", "uploader": "spider", "width": 100, "height": 100,
+             "duration": 1.0, "category": "animal", "tags": ["animal", "dog"]},
+            {"id": 2, "title": "Running dog", "uploader": "spider", "width": 300, "height": 200,
+             "duration": 2.0, "category": "animal", "tags": ["animal", "dog", "funny"]},
+            {"id": 3, "title": "Delicious food", "uploader": "Alice", "width": 500, "height": 500,
+             "duration": 3.0, "category": "food", "tags": ["food"]},
+        ])
+
+    def search_request(self, **kwargs):
+        '''
+            Build a search request with default fields
+        '''
+        request = {"target": "", "keyword": "", "category": "", "filter": [], "tags": []}
+        request.update(kwargs)
+        return request
+
+    def test_search_perfect(self):
+        '''
+            Test perfect match on title and uploader
+        '''
+        self.assertEqual(self.engine.search_perfect(self.search_request(target="title", keyword="Still Dog")), ["1"])
+        self.assertEqual(self.engine.search_perfect(self.search_request(target="title", keyword="Still")), [])
+        self.assertEqual(set(self.engine.search_perfect(self.search_request(target="uploader", keyword="spider"))), {"1", "2"})
+
+    def test_search_partial_and_related(self):
+        '''
+            Test partial match requires every token and related match any token
+        '''
+        self.assertEqual(self.engine.search_partial(self.search_request(target="title", keyword="dog still")), ["1"])
+        self.assertEqual(set(self.engine.search_related(self.search_request(target="title", keyword="dog food"))), {"1", "2", "3"})
+        self.assertEqual(self.engine.search_related(self.search_request(target="title", keyword="still dog"))[0], "1")
+
+    def test_search_fuzzy(self):
+        '''
+            Test fuzzy match tolerates typos
+        '''
+        self.assertEqual(self.engine.search_fuzzy(self.search_request(target="title", keyword="delicous")), ["3"])
+        self.assertEqual(self.engine.search_fuzzy(self.search_request(target="title", keyword="runnning dgo")), ["2"])
+
+    def test_search_filters(self):
+        '''
+            Test category, tags and range filters
+        '''
+        request = self.search_request(category="animal", tags=["funny"])
+        self.assertEqual(self.engine.search_partial(request), ["2"])
+        request = self.search_request(filter=[{"range": {"width": {"gte": 200, "lte": 1000}}}])
+        self.assertEqual(set(self.engine.search_partial(request)), {"2", "3"})
+
+    def test_post_metadata(self):
+        '''
+            Test new and updated gifs are searchable at once
+        '''
+        self.engine.post_metadata({"id": 4, "title": "Sleeping cat", "uploader": "Bob", "width": 1, "height": 1,
+                                   "duration": 1.0, "category": "animal", "tags": ["cat"]})
+        self.assertEqual(self.engine.search_partial(self.search_request(target="title", keyword="cat")), ["4"])
+        self.engine.post_metadata({"id": 4, "title": "Sleeping kitten", "uploader": "Bob", "width": 1, "height": 1,
+                                   "duration": 1.0, "category": "animal", "tags": ["cat"]})
+        self.assertEqual(self.engine.search_partial(self.search_request(target="title", keyword="cat")), [])
+
+    def test_suggest_correct_and_personalization(self):
+        '''
+            Test suggest, correct, hotwords and personalization search
+        '''
+        self.assertEqual(self.engine.suggest_search("d"), ["Delicious food"])
+        self.assertEqual(self.engine.correct_search(input="delicous fodd", target="title"), ["delicious food"])
+        self.assertEqual(self.engine.correct_search(input="spidr", target="uploader"), ["spider"])
+        self.assertEqual(self.engine.personalization_search({"funny": 1.0, "food": 0.5}), ["2", "3"])
+        self.engine.search_partial(self.search_request(target="title", keyword="dog"))
+        self.assertEqual(self.engine.hotwords_search(), ["dog"])
+
+    def test_search_page(self):
+        '''
+            Test a page of hits carries the total number of hits
+        '''
+        hits = self.engine.search_partial(self.search_request(target="title", keyword="dog"), page=1, size=1)
+        self.assertEqual(len(hits), 1)
+        self.assertEqual(hits.total, 2)
+        self.assertEqual(hits.page_count(1), 2)
+
+class FakeElasticsearch:
+    '''
+        Stand-in for the elastic search client used by paging tests
+    '''
+    def __init__(self, total):
+        self.total = total
+        self.bodies = []
+        self.params = []
+        self.messages = []
+        self.sources = []
+        self.deleted = []
+        self.missing = False
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def bulk(self, body, **kwargs):
+        '''
+            Keep bulk indexed documents and deleted ids, wait for release first
+        '''
+        self.entered.set()
+        self.release.wait(5)
+        lines = iter(json.loads(line) for line in body.splitlines() if line)
+        items = []
+        for action in lines:
+            if "delete" in action:
+                self.deleted.append(action["delete"]["_id"])
+                items.append({"delete": {"status": 404 if self.missing else 200}})
+                continue
+            source = next(lines)
+            self.sources.append(source)
+            if "message" in source:
+                self.messages.append(source["message"])
+            items.append({"index": {"status": 201}})
+        return {"errors": self.missing, "items": items}
+
+    def search(self, index, body, **kwargs):
+        '''
+            Serve hits 0, 1, 2 ... sorted by id
+        '''
+        self.bodies.append(dict(body))
+        self.params.append(kwargs)
+        start = body.get("from", 0)
+        if "search_after" in body:
+            start = body["search_after"][1] + 1
+        size = body.get("size", kwargs.get("size", 10))
+        hits = [{"_id": str(i), "sort": [1.0, i]} for i in range(start, min(start + size, self.total))]
+        return {"hits": {"total": {"value": self.total}, "hits": hits}}
+
+class ElasticSearchPagingTests(TestCase):
+    '''
+        Test pagination pushed down into elastic search
+    '''
+    def setUp(self):
+        self.engine = ElasticSearchEngine()
+        self.engine.client = FakeElasticsearch(total=12000)
+        self.engine.search_log.client = self.engine.client
+        self.request = {"target": "title", "keyword": "", "category": "", "filter": [], "tags": []}
+
+    def test_prefetch_result_set(self):
+        '''
+            Test the leading hits are prefetched once and pages sliced from them
+        '''
+        hits = self.engine.search_partial(self.request)
+        self.assertEqual(len(hits), 1000)
+        self.assertEqual(hits.total, 12000)
+        self.assertFalse(self.engine.client.bodies[-1]["_source"])
+        self.assertEqual(hits.page(1, 20), [str(i) for i in range(20, 40)])
+        self.assertEqual(hits.page(1, 20).total, 12000)
+        self.assertIsNone(hits.page(50, 20))
+        self.assertEqual(SearchHits(["1", "2"], 2).page(3, 20), [])
+
+    def test_search_page_with_from_size(self):
+        '''
+            Test shallow pages only fetch one page without _source
+        '''
+        hits = self.engine.search_partial(self.request, page=2, size=20)
+        self.assertEqual(hits, [str(i) for i in range(40, 60)])
+        self.assertEqual(hits.total, 12000)
+        self.assertEqual(hits.page_count(20), 600)
+        body = self.engine.client.bodies[-1]
+        self.assertEqual((body["from"], body["size"], body["_source"]), (40, 20, False))
+
+    def test_search_page_with_search_after(self):
+        '''
+            Test deep pages are reached with search_after
+        '''
+        hits = self.engine.search_fuzzy(self.request, page=550, size=20)
+        self.assertEqual(hits, [str(i) for i in range(11000, 11020)])
+        self.assertNotIn("from", self.engine.client.bodies[-1])
+        hits = self.engine.search_fuzzy(self.request, page=366, size=30)
+        self.assertEqual(hits, [str(i) for i in range(10980, 11010)])
+
+    def test_filter_context(self):
+        '''
+            Test filters are compiled into bool.filter and cached
+        '''
+        request = {
+            "target": "title", "keyword": "dog", "category": "animal",
+            "filter": [{"range": {"width": {"gte": 1, "lte": 2}}}], "tags": ["cat", "animal", "cat"]
+        }
+        for search in (self.engine.search_perfect, self.engine.search_partial,
+                       self.engine.search_related, self.engine.search_fuzzy):
+            search(request, page=0, size=20)
+            query = self.engine.client.bodies[-1]["query"]["bool"]
+            self.assertEqual(len(query["must"]), 1)
+            self.assertEqual(query["filter"], [
+                {"term": {"category.keyword": "animal"}},
+                {"term": {"tags.keyword": "animal"}},
+                {"term": {"tags.keyword": "cat"}},
+                {"range": {"width": {"gte": 1, "lte": 2}}},
+            ])
+            self.assertTrue(self.engine.client.params[-1]["request_cache"])
+        self.assertEqual(compile_query(self.request), {"query": {"bool": {"filter": []}}})
+
+class SearchCacheTests(TestCase):
+    '''
+        Test the search result cache
+    '''
+    def search_body(self, **kwargs):
+        '''
+            Build a search body with default fields
+        '''
+        body = {"type": "partial", "target": "title", "keyword": "cat", "category": "animal",
+                "filter": [], "tags": [], "page": 1}
+        body.update(kwargs)
+        return body
+
+    def test_generate_cache_body(self):
+        '''
+            Test equivalent requests share a cache body
+        '''
+        self.assertEqual(helpers.generate_cache_body(self.search_body(keyword="Cute  cat", tags=["b", "a"])),
+                         helpers.generate_cache_body(self.search_body(keyword="cute cat", tags=["a", "b"])))
+        self.assertNotEqual(helpers.generate_cache_body(self.search_body(type="perfect", keyword="Cat")),
+                            helpers.generate_cache_body(self.search_body(type="perfect", keyword="cat")))
+        self.assertNotEqual(helpers.generate_cache_body(self.search_body(tags=["a"])),
+                            helpers.generate_cache_body(self.search_body(tags=["b"])))
+        self.assertEqual(helpers.generate_cache_body(self.search_body(page=1)),
+                         helpers.generate_cache_body(self.search_body(page=3)))
+
+    def test_memory_backend_lru_and_ttl(self):
+        '''
+            Test least recently used entries are evicted and expired entries dropped
+        '''
+        backend = MemoryCacheBackend(max_entries=2)
+        backend.set("a", 1, 60)
+        backend.set("b", 2, 60)
+        self.assertEqual(backend.get("a"), 1)
+        backend.set("c", 3, 60)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), 1)
+        backend.set("d", 4, -1)
+        self.assertIsNone(backend.get("d"))
+
+    def test_memory_backend_pinned(self):
+        '''
+            Test pinned entries are not evicted by unpinned ones
+        '''
+        backend = MemoryCacheBackend(max_entries=1, max_pinned=1)
+        backend.set("pinned", 1, 60, pin=True)
+        backend.set("a", 2, 60)
+        backend.set("b", 3, 60)
+        self.assertEqual(backend.get("pinned"), 1)
+        self.assertIsNone(backend.get("a"))
+        backend.set("other", 4, 60, pin=True)
+        self.assertIsNone(backend.get("pinned"))
+        backend.delete("other")
+        self.assertIsNone(backend.get("other"))
+
+    def test_invalidate(self):
+        '''
+            Test indexing a gif invalidates its category and any-category results
+        '''
+        for backend in [MemoryCacheBackend(max_entries=10), DjangoCacheBackend("default")]:
+            cache = SearchCache(backend, ttl=60)
+            cache.clear()
+            cache.set("animal query", "animal", SearchHits(["1"], 5))
+            cache.set("food query", "food", SearchHits(["2"], 7))
+            cache.set("any query", "", SearchHits(["3"], 9))
+            self.assertEqual(cache.get("animal query", "animal").total, 5)
+            cache.invalidate(["animal"])
+            self.assertIsNone(cache.get("animal query", "animal"))
+            self.assertIsNone(cache.get("any query", ""))
+            self.assertEqual(cache.get("food query", "food"), ["2"])
+
+    def test_evicted_generation(self):
+        '''
+            Test a generation counter evicted from a shared cache never
+            goes back to a generation used before
+        '''
+        cache = SearchCache(DjangoCacheBackend("default"), ttl=60)
+        cache.clear()
+        cache.get("animal query", "animal")
+        cache.invalidate(["animal"])
+        cache.set("animal query", "animal", SearchHits(["1"], 5))
+        first = cache.entry_key("animal query", "animal")
+        for _ in range(3):
+            cache.invalidate(["animal"])
+        # culled along with the entries
+        cache.backend.delete(cache.generation_key("animal"))
+        self.assertNotEqual(cache.entry_key("animal query", "animal"), first)
+        self.assertIsNone(cache.get("animal query", "animal"))
+
+class SearchLogWriterTests(TestCase):
+    '''
+        Test the background search log writer
+    '''
+    def test_batched_flush(self):
+        '''
+            Test searched keywords are bulk indexed off the request thread
+        '''
+        client = FakeElasticsearch(total=0)
+        engine = ElasticSearchEngine()
+        engine.client = client
+        engine.search_log = SearchLogWriter(client, batch_size=2, interval=0.05)
+        engine.search_partial({"target": "title", "keyword": "cat", "category": "",
+                               "filter": [], "tags": []}, page=0)
+        engine.search_log.log("dog")
+        engine.search_log.log("bird")
+        engine.search_log.close()
+        self.assertEqual(sorted(client.messages), ["bird", "cat", "dog"])
+        self.assertEqual(engine.search_log.sent, 3)
+
+    def test_back_pressure(self):
+        '''
+            Test keywords are dropped instead of blocking when the queue is full
+        '''
+        client = FakeElasticsearch(total=0)
+        client.release.clear()
+        writer = SearchLogWriter(client, max_queued=2, batch_size=1, interval=0.01)
+        writer.log("first")
+        self.assertTrue(client.entered.wait(5))
+        for message in ["second", "third", "fourth"]:
+            writer.log(message)
+        self.assertEqual(writer.dropped, 1)
+        client.release.set()
+        writer.close()
+        self.assertEqual(client.messages, ["first", "second", "third"])
+
+class HotWordsTests(TestCase):
+    '''
+        Test hot words counted by space saving
+    '''
+    def test_heavy_hitters_kept(self):
+        '''
+            Test frequent keywords survive a stream of rare ones in bounded memory
+        '''
+        counter = SpaceSaving(capacity=10, half_life=3600, now=0)
+        for i in range(1000):
+            counter.offer("cat" if i % 3 == 0 else f"rare{i}", now=0)
+            if i % 5 == 0:
+                counter.offer("dog", now=0)
+        self.assertLessEqual(len(counter.counts), 10)
+        self.assertEqual(counter.top(2), ["cat", "dog"])
+
+    def test_time_decay(self):
+        '''
+            Test recent searches outweigh older ones in short windows only
+        '''
+        hot_words = HotWords(windows={"hour": 3600, "week": 604800})
+        for _ in range(10):
+            hot_words.record("Old  Word", now=0)
+        for _ in range(3):
+            hot_words.record("new word", now=7 * 3600)
+        self.assertEqual(hot_words.top(2, "hour"), ["new word", "old word"])
+        self.assertEqual(hot_words.top(2, "week"), ["old word", "new word"])
+
+    def test_rescale(self):
+        '''
+            Test counts are rescaled instead of overflowing
+        '''
+        counter = SpaceSaving(capacity=10, half_life=1, now=0)
+        counter.offer("a", now=0)
+        counter.offer("b", now=2000)
+        self.assertEqual(counter.landmark, 2000)
+        self.assertEqual(counter.top(2), ["b", "a"])
+
+    def test_snapshot(self):
+        '''
+            Test hot words are restored from a snapshot
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hotwords.json")
+            hot_words = HotWords(path)
+            hot_words.record("cat")
+            hot_words.record("cat")
+            hot_words.record("dog")
+            hot_words.save()
+            self.assertEqual(HotWords(path).top(), ["cat", "dog"])
+
+    def test_worker_snapshots(self):
+        '''
+            Test workers write their own snapshots and a restart merges
+            the ones of the last run
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hotwords.json")
+            first = HotWords(path)
+            for keyword in ("cat", "cat", "dog"):
+                first.record(keyword)
+            first.save()
+            # written by another worker
+            os.replace(first.snapshot_file(), f"{path}.1")
+            second = HotWords(path)
+            second.loaded = True
+            for keyword in ("dog", "dog", "bird"):
+                second.record(keyword)
+            second.save()
+            old = f"{path}.2"
+            with open(old, "w", encoding="utf-8") as snapshot:
+                json.dump({"day": {"landmark": time.time(), "counts": [["fish", 100, 0]]}}, snapshot)
+            os.utime(old, (time.time() - 3600, time.time() - 3600))
+
+            restored = HotWords(path)
+            self.assertEqual(restored.top(), ["dog", "cat", "bird"])
+            self.assertAlmostEqual(restored.windows["day"].counts["dog"], 1.5, places=3)
+            self.assertFalse(os.path.exists(old))
+
+    def test_search_hotwords_window(self):
+        '''
+            Test the endpoint answers from searched keywords
+        '''
+        config.HOT_WORDS.clear()
+        config.HOT_WORDS.record("spider")
+        res = self.client.get('/image/search/hotwords?window=hour')
+        self.assertEqual(res.json()["data"][0], "spider")
+        res = self.client.get('/image/search/hotwords?window=year')
+        self.assertEqual(res.json()["code"], 1005)
+
+class ReindexTests(TestCase):
+    '''
+        Test the reindex_gifs management command
+    '''
+    def setUp(self):
+        self.engine = InvertedIndexSearchEngine(documents=[])
+        self.default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = self.engine
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.directory.name, "checkpoint")
+        user = UserInfo.objects.create(user_name="spider", password="", salt="")
+        self.gifs = [
+            GifMetadata.objects.create(title=f"gif {i}", uploader=user.id, category="animal", tags=["dog"])
+            for i in range(7)
+        ]
+
+    def tearDown(self):
+        config.SEARCH_ENGINE = self.default_engine
+        self.directory.cleanup()
+
+    def reindex(self, *args):
+        '''
+            Run the command, return its output
+        '''
+        out = StringIO()
+        call_command("reindex_gifs", "--chunk-size", "3", "--workers", "2",
+                     "--checkpoint", self.checkpoint, *args, stdout=out)
+        return out.getvalue()
+
+    def test_reindex(self):
+        '''
+            Test every gif is indexed with its uploader name and a second
+            complete run indexes every gif again
+        '''
+        output = self.reindex()
+        self.assertIn("Indexed 7 gifs", output)
+        self.assertEqual(set(self.engine.documents), {gif.id for gif in self.gifs})
+        self.assertEqual(self.engine.documents[self.gifs[0].id]["uploader"], "spider")
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.engine.documents.clear()
+        output = self.reindex()
+        self.assertNotIn("Resuming", output)
+        self.assertIn("Indexed 7 gifs", output)
+        self.assertEqual(set(self.engine.documents), {gif.id for gif in self.gifs})
+
+    def test_resume(self):
+        '''
+            Test an interrupted run resumes after the checkpoint
+        '''
+        with open(self.checkpoint, "w", encoding="utf-8") as checkpoint:
+            checkpoint.write(str(self.gifs[4].id))
+        output = self.reindex()
+        self.assertIn("Indexed 2 gifs", output)
+        self.assertEqual(set(self.engine.documents), {gif.id for gif in self.gifs[5:]})
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.reindex("--restart")
+        self.assertEqual(len(self.engine.documents), 7)
+
+    def test_elastic_bulk(self):
+        '''
+            Test elastic search indexes a chunk with one bulk request
+        '''
+        engine = ElasticSearchEngine()
+        engine.client = FakeElasticsearch(total=0)
+        count = engine.bulk_post_metadata([
+            generate_search_document(gif, "spider") for gif in self.gifs
+        ])
+        self.assertEqual(count, 7)
+        self.assertEqual([source["id"] for source in engine.client.sources], [gif.id for gif in self.gifs])
+        self.assertEqual(engine.client.sources[0]["suggestion"], "gif 0")
+
+class FailingSearchEngine(InvertedIndexSearchEngine):
+    '''
+        Search engine standing for an unreachable cluster
+    '''
+    in_process = False
+
+    def bulk_post_metadata(self, documents):
+        raise ConnectionError("cluster unreachable")
+
+
+class SearchOutboxTests(TestCase):
+    '''
+        Test gif changes reach the search engine through the outbox
+    '''
+    def setUp(self):
+        self.engine = InvertedIndexSearchEngine(documents=[])
+        self.default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = self.engine
+        self.user = UserInfo.objects.create(user_name="spider", password="", salt="")
+
+    def tearDown(self):
+        config.SEARCH_ENGINE = self.default_engine
+
+    def test_drain_on_commit(self):
+        '''
+            Test the consumer of the process is woken once the gif
+            commits and its catch-up updates the in-process engine
+        '''
+        consumer = search_outbox.CONSUMER
+        consumer.woken.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            gif = GifMetadata.objects.create(title="Still Dog", uploader=self.user.id, category="animal")
+            helpers.post_search_metadata(gif)
+            self.assertFalse(consumer.woken.is_set())
+        self.assertTrue(consumer.woken.is_set())
+        consumer.catch_up(force=True)
+        self.assertEqual(self.engine.documents[gif.id]["uploader"], "spider")
+        # kept for the other processes until every consumer passed it
+        self.assertTrue(SearchOutbox.objects.get().pushed)
+        with self.captureOnCommitCallbacks(execute=True):
+            helpers.delete_search_metadata(gif)
+            gif.delete()
+        consumer.catch_up(force=True)
+        self.assertNotIn(gif.id, self.engine.documents)
+
+    def test_background_catch_up(self):
+        '''
+            Test the consumer thread catches up on start and when woken
+        '''
+        rounds = []
+        done = threading.Event()
+
+        class CountingConsumer(OutboxConsumer):
+            '''
+                Consumer recording its catch-ups instead of reading the outbox
+            '''
+            def catch_up(self, force=False):
+                rounds.append(force)
+                done.set()
+                return 0
+
+        consumer = CountingConsumer(interval=3600)
+        consumer.start()
+        consumer.start()
+        self.assertTrue(done.wait(5))
+        done.clear()
+        consumer.wake()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(rounds, [True, True])
+
+    def test_drain_coalesces(self):
+        '''
+            Test rows of one gif are coalesced into its latest state
+        '''
+        client = FakeElasticsearch(total=0)
+        engine = ElasticSearchEngine()
+        engine.client = client
+        config.SEARCH_ENGINE = engine
+        gif = GifMetadata.objects.create(title="Still Dog", uploader=self.user.id, category="animal")
+        helpers.post_search_metadata(gif)
+        gif.category = "funny"
+        gif.save()
+        helpers.post_search_metadata(gif, old_category="animal")
+        removed = GifMetadata.objects.create(title="Gone", uploader=self.user.id, category="food")
+        helpers.post_search_metadata(removed)
+        removed_id = removed.id
+        helpers.delete_search_metadata(removed)
+        removed.delete()
+        self.assertEqual(drain(), 4)
+        self.assertEqual([(source["id"], source["category"]) for source in client.sources], [(gif.id, "funny")])
+        self.assertEqual(client.deleted, [removed_id])
+        self.assertFalse(SearchOutbox.objects.exists())
+        helpers.delete_search_metadata(gif)
+        client.missing = True
+        self.assertEqual(drain(), 1)
+
+    def test_retry(self):
+        '''
+            Test failed rows are kept and retried later
+        '''
+        config.SEARCH_ENGINE = FailingSearchEngine(documents=[])
+        gif = GifMetadata.objects.create(title="Still Dog", uploader=self.user.id, category="animal")
+        helpers.post_search_metadata(gif)
+        self.assertEqual(drain(), 0)
+        row = SearchOutbox.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertIn("unreachable", row.last_error)
+        self.assertEqual(drain(), 0)
+        self.assertEqual(SearchOutbox.objects.get().attempts, 1)
+        config.SEARCH_ENGINE = self.engine
+        SearchOutbox.objects.update(next_attempt_at=row.created_at)
+        out = StringIO()
+        call_command("drain_search_outbox", stdout=out)
+        self.assertIn("Drained 1", out.getvalue())
+        self.assertIn(gif.id, self.engine.documents)
+
+class OutboxConsumerTests(TestCase):
+    '''
+        Test every process applies the outbox to its own indexes
+    '''
+    def setUp(self):
+        self.user = UserInfo.objects.create(user_name="spider", password="", salt="")
+        self.default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = InvertedIndexSearchEngine(documents=[])
+        # two workers, each with its own engine, suggester and corrector
+        self.workers = []
+        for name in ("worker-a", "worker-b"):
+            engine = InvertedIndexSearchEngine(documents=[])
+            suggester, corrector = PrefixSuggester(), SpellingCorrector()
+            suggester.load()
+            corrector.load()
+            self.workers.append((engine, suggester, OutboxConsumer(engine, suggester, corrector, name=name)))
+
+    def tearDown(self):
+        config.SEARCH_ENGINE = self.default_engine
+
+    def write(self, title):
+        '''
+            Save and queue a gif
+        '''
+        gif = GifMetadata.objects.create(title=title, uploader=self.user.id, category="animal")
+        helpers.post_search_metadata(gif)
+        return gif
+
+    def age(self):
+        '''
+            Make every outbox row older than the settle time
+        '''
+        SearchOutbox.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+
+    def test_two_engines(self):
+        '''
+            Test a write reaches both engines and rows are pruned only
+            once both passed them
+        '''
+        (engine_a, suggester_a, worker_a), (engine_b, suggester_b, worker_b) = self.workers
+        worker_a.catch_up(force=True)
+        worker_b.catch_up(force=True)
+        gif = self.write("Still Dog")
+        self.assertEqual(worker_a.catch_up(force=True), 1)
+        self.assertIn(gif.id, engine_a.documents)
+        self.assertEqual(suggester_a.suggest("sti"), ["Still Dog"])
+        self.assertNotIn(gif.id, engine_b.documents)
+        # applied once, reread until settled
+        self.assertEqual(worker_a.catch_up(force=True), 0)
+        self.age()
+        worker_a.catch_up(force=True)
+        self.assertEqual(prune(), 0)
+        self.assertTrue(SearchOutbox.objects.exists())
+
+        self.assertEqual(worker_b.catch_up(force=True), 1)
+        self.assertEqual(engine_b.documents[gif.id]["title"], "Still Dog")
+        self.assertEqual(suggester_b.suggest("sti"), ["Still Dog"])
+        self.assertFalse(SearchOutbox.objects.exists())
+
+        gif_id = gif.id
+        helpers.delete_search_metadata(gif)
+        gif.delete()
+        worker_b.catch_up(force=True)
+        self.assertNotIn(gif_id, engine_b.documents)
+        self.assertIn(gif_id, engine_a.documents)
+        worker_a.catch_up(force=True)
+        self.assertNotIn(gif_id, engine_a.documents)
+
+    def test_dropped_consumer(self):
+        '''
+            Test a consumer silent past the timeout stops holding rows
+            and rebuilds its indexes when rows it missed were pruned
+        '''
+        (engine_a, _, worker_a), (engine_b, _, worker_b) = self.workers
+        worker_a.catch_up(force=True)
+        worker_b.catch_up(force=True)
+        SearchOutboxConsumer.objects.filter(name="worker-b").update(
+            seen_at=timezone.now() - search_outbox.CONSUMER_TIMEOUT * 2
+        )
+        gif = self.write("Still Dog")
+        self.age()
+        worker_a.catch_up(force=True)
+        self.assertFalse(SearchOutbox.objects.exists())
+        self.assertFalse(SearchOutboxConsumer.objects.filter(name="worker-b").exists())
+
+        engine_b.loaded = True
+        worker_b.catch_up(force=True)
+        self.assertFalse(engine_b.loaded)
+        engine_b.ensure_loaded()
+        self.assertIn(gif.id, engine_b.documents)
+
+class TrigramSearchTests(TestCase):
+    '''
+        Test regex search prefiltered by the trigram index
+    '''
+    def setUp(self):
+        self.spider = UserInfo.objects.create(user_name="spider", password="", salt="")
+        self.alice = UserInfo.objects.create(user_name="Alice", password="", salt="")
+        self.gifs = [
+            GifMetadata.objects.create(title="Still Dog", uploader=self.spider.id, category="animal"),
+            GifMetadata.objects.create(title="Running dogs", uploader=self.spider.id, category="animal"),
+            GifMetadata.objects.create(title="Delicious food", uploader=self.alice.id, category="food"),
+        ]
+
+    def test_required_trigrams(self):
+        '''
+            Test trigrams every match must contain are read from the pattern
+        '''
+        self.assertEqual(trigram.required_trigrams("cat.*dog"), {"cat", "dog"})
+        self.assertEqual(trigram.required_trigrams("(Dogs)+!"), {"dog", "ogs"})
+        self.assertEqual(trigram.required_trigrams("[abc]def"), {"def"})
+        self.assertEqual(trigram.required_trigrams("cat|dog"), set())
+        self.assertEqual(trigram.required_trigrams("(cat)?"), set())
+        self.assertEqual(trigram.required_trigrams("(?!abc)ab"), set())
+
+    def test_postings(self):
+        '''
+            Test postings follow title changes and deletes
+        '''
+        gif = self.gifs[0]
+        self.assertIn("dog", TrigramPosting.objects.filter(field="title", object_id=gif.id).values_list("trigram", flat=True))
+        gif.title = "Still cat"
+        gif.save()
+        self.assertEqual(trigram.regex_search("title", "Dog"), [])
+        gif_id = gif.id
+        gif.delete()
+        self.assertFalse(TrigramPosting.objects.filter(field="title", object_id=gif_id).exists())
+        TrigramPosting.objects.all().delete()
+        call_command("rebuild_trigram_index", stdout=StringIO())
+        self.assertEqual(trigram.regex_search("title", "dogs$"), [self.gifs[1].id])
+
+    def test_unchanged_text(self):
+        '''
+            Test saves which keep the title or user name leave the postings alone
+        '''
+        gif = GifMetadata.objects.get(id=self.gifs[1].id)
+        user = UserInfo.objects.get(id=self.spider.id)
+        with CaptureQueriesContext(connection) as queries:
+            gif.tags = ["dog"]
+            gif.save()
+            user.signature = "hello"
+            user.save()
+        self.assertFalse([query for query in queries if "trigramposting" in query["sql"]])
+        user.user_name = "spiders"
+        user.save()
+        self.assertEqual(trigram.regex_search("uploader", "spiders"), [self.gifs[0].id, self.gifs[1].id])
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertFalse([query for query in queries if "trigramposting" in query["sql"]])
+
+    def test_regex_search(self):
+        '''
+            Test titles and uploaders are matched on candidates only
+        '''
+        self.assertEqual(trigram.regex_search("title", "[Dd]og"), [self.gifs[0].id, self.gifs[1].id])
+        self.assertEqual(trigram.regex_search("title", "Dog"), [self.gifs[0].id])
+        self.assertEqual(trigram.regex_search("title", "dog", Q(category="food")), [])
+        self.assertEqual(trigram.regex_search("uploader", "^Ali"), [self.gifs[2].id])
+        self.assertEqual(trigram.regex_search("uploader", "", Q(category="animal")),
+                         [self.gifs[0].id, self.gifs[1].id])
+        self.assertEqual(trigram.regex_search("title", "", Q(category="food")), [self.gifs[2].id])
+
+class PrefixSuggesterTests(TestCase):
+    '''
+        Test title autocomplete
+    '''
+    def setUp(self):
+        self.suggester = PrefixSuggester()
+        self.suggester.built_at = time.monotonic()
+        self.suggester.build([("Dog running", 10), ("dog sleeping", 0), ("Dog running", 5),
+                              ("Delicious food", 3), ("cat", 100)])
+
+    def test_suggest(self):
+        '''
+            Test completions are ranked by likes, case insensitive
+        '''
+        self.assertEqual(self.suggester.suggest("DOG"), ["Dog running", "dog sleeping"])
+        self.assertEqual(self.suggester.suggest("d", 2), ["Dog running", "Delicious food"])
+        self.assertEqual(self.suggester.suggest("bird"), [])
+        pending = PrefixSuggester()
+        pending.retry_at = time.monotonic() + 60
+        self.assertIsNone(pending.suggest("dog"))
+
+    def test_add_gif(self):
+        '''
+            Test uploads are counted once each until the next rebuild
+        '''
+        self.assertEqual(self.suggester.suggest("", 1), ["cat"])
+        for _ in range(2):
+            self.suggester.add_gif(100, "Dog dancing", 200)
+        self.assertEqual(self.suggester.suggest("", 1), ["Dog dancing"])
+        self.assertEqual(self.suggester.weights["Dog dancing"], 201)
+        self.assertEqual(self.suggester.suggest("dog d"), ["Dog dancing"])
+
+    def test_suggest_view(self):
+        '''
+            Test the endpoint answers from the suggester
+        '''
+        default_suggester = config.TITLE_SUGGESTER
+        config.TITLE_SUGGESTER = self.suggester
+        try:
+            res = self.client.post('/image/search/suggest', {"query": "dog", "correct": False},
+                                   content_type="application/json")
+        finally:
+            config.TITLE_SUGGESTER = default_suggester
+        self.assertEqual(res.json()["data"]["suggestions"], ["Dog running", "dog sleeping"])
+
+class SpellingCorrectorTests(TestCase):
+    '''
+        Test symmetric delete spelling correction
+    '''
+    def setUp(self):
+        self.corrector = SpellingCorrector()
+        self.corrector.build(["Delicious food", "Food and drink", "Cold drink", "Good dog"], ["spider", "Alice"])
+
+    def test_deletes(self):
+        '''
+            Test deletes up to the max distance
+        '''
+        self.assertEqual(deletes("abc", 1), {"abc", "bc", "ac", "ab"})
+        self.assertIn("a", deletes("abc", 2))
+
+    def test_lookup(self):
+        '''
+            Test the closest and most frequent word wins
+        '''
+        dictionary = SymSpell()
+        for word, count in [("food", 3), ("good", 1), ("drink", 2)]:
+            dictionary.add_word(word, count)
+        self.assertEqual(dictionary.lookup("fodd", 1), "food")
+        self.assertEqual(dictionary.lookup("oood", 1), "food")
+        self.assertEqual(dictionary.lookup("driink", 2), "drink")
+        self.assertIsNone(dictionary.lookup("xyz", 1))
+
+    def test_correct(self):
+        '''
+            Test queries are corrected token by token and memoized
+        '''
+        self.assertEqual(self.corrector.correct("fodd and driink"), ["food and drink"])
+        self.assertEqual(self.corrector.correct("food"), [])
+        self.assertEqual(self.corrector.correct("spidr", "uploader"), ["spider"])
+        self.assertIn(("title", "fodd and driink"), self.corrector.memo)
+        self.corrector.add_text("uploader", "spiderman")
+        self.assertEqual(self.corrector.memo, {})
+        self.assertEqual(self.corrector.correct("spidermn", "uploader"), ["spiderman"])
+
+    def test_correct_view(self):
+        '''
+            Test uploader suggestions come from the corrector
+        '''
+        default_corrector = config.SPELLING_CORRECTOR
+        config.SPELLING_CORRECTOR = self.corrector
+        try:
+            res = self.client.post('/image/search/suggest', {"query": "alcie", "target": "uploader"},
+                                   content_type="application/json")
+        finally:
+            config.SPELLING_CORRECTOR = default_corrector
+        self.assertEqual(res.json()["data"]["suggestions"], ["alice"])
+
+
+class FeedTests(TestCase):
+    '''
+        Test precomputed personalization feeds
+    '''
+    def setUp(self):
+        self.engine = InvertedIndexSearchEngine(documents=[])
+        self.default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = self.engine
+        feeds.feed_cache().clear()
+        self.uploader = UserInfo.objects.create(user_name="spider", password="", salt="")
+        self.user = UserInfo.objects.create(user_name="reader", password="", salt="", tags={"cat": 3})
+        self.gifs = [
+            GifMetadata.objects.create(title="Cat", uploader=self.uploader.id, tags=["cat"], likes=2),
+            GifMetadata.objects.create(title="Cat Dog", uploader=self.uploader.id, tags=["cat", "dog"]),
+            GifMetadata.objects.create(title="Dog", uploader=self.uploader.id, tags=["dog"]),
+        ]
+        self.engine.bulk_post_metadata([generate_search_document(gif, "spider") for gif in self.gifs])
+
+    def tearDown(self):
+        config.SEARCH_ENGINE = self.default_engine
+        feeds.feed_cache().clear()
+
+    def test_get_feed(self):
+        '''
+            Test the feed is computed once, then served from the cache
+        '''
+        ids = feeds.get_feed(self.user)
+        self.assertEqual(ids, [self.gifs[1].id, self.gifs[0].id])
+        self.assertFalse(UserFeed.objects.get(user_id=self.user.id).stale)
+        self.engine.bulk_post_metadata([{**generate_search_document(self.gifs[2], "spider"), "tags": ["cat"]}])
+        self.assertEqual(feeds.get_feed(self.user), ids)
+
+    def test_empty_feed(self):
+        '''
+            Test an empty feed is cached for EMPTY_FEED_TIMEOUT only and
+            a failed one is not cached
+        '''
+        newcomer = UserInfo.objects.create(user_name="newcomer", password="", salt="")
+        default_timeout = feeds.EMPTY_FEED_TIMEOUT
+        # expire at once
+        feeds.EMPTY_FEED_TIMEOUT = 0
+        try:
+            self.assertEqual(feeds.get_feed(newcomer), [])
+            self.assertIsNone(feeds.feed_cache().get(feeds.feed_key(newcomer.id)))
+            self.assertTrue(feeds.get_feed(self.user))
+            self.assertIsNotNone(feeds.feed_cache().get(feeds.feed_key(self.user.id)))
+        finally:
+            feeds.EMPTY_FEED_TIMEOUT = default_timeout
+
+        def unreachable(tag_fre):
+            raise ServiceUnavailable("search")
+        self.engine.personalization_search = unreachable
+        with self.assertRaises(ServiceUnavailable):
+            feeds.get_feed(newcomer)
+        self.assertIsNone(feeds.feed_cache().get(feeds.feed_key(newcomer.id)))
+
+    def test_refresh_stale(self):
+        '''
+            Test tag changes mark the feed stale and refresh_feeds recomputes it
+        '''
+        feeds.get_feed(self.user)
+        helpers.update_user_tags(self.user, ["dog", "dog", "dog", "dog"])
+        self.assertTrue(UserFeed.objects.get(user_id=self.user.id).stale)
+        out = StringIO()
+        call_command("refresh_feeds", stdout=out)
+        self.assertIn("Refreshed 1", out.getvalue())
+        self.assertFalse(UserFeed.objects.get(user_id=self.user.id).stale)
+        self.assertEqual(feeds.get_feed(self.user)[0], self.gifs[1].id)
+        self.assertEqual(len(feeds.get_feed(self.user)), 3)
+        UserFeed.objects.update(stale=True, last_seen=timezone.now() - datetime.timedelta(days=30))
+        self.assertEqual(feeds.refresh_stale_feeds(), 0)
+
+    def test_refresh_failure(self):
+        '''
+            Test a feed failing to refresh stays stale and backs off
+            without stopping the other feeds of the batch
+        '''
+        other = UserInfo.objects.create(user_name="other", password="", salt="", tags={"dog": 1})
+        feeds.get_feed(self.user)
+        feeds.get_feed(other)
+        UserFeed.objects.update(stale=True)
+        personalization_search = self.engine.personalization_search
+
+        def failing_search(tag_fre):
+            if "cat" in tag_fre:
+                raise ServiceUnavailable("search")
+            return personalization_search(tag_fre)
+        self.engine.personalization_search = failing_search
+        with self.assertLogs("main.feeds", level="ERROR"):
+            self.assertEqual(feeds.refresh_stale_feeds(), 2)
+        self.assertFalse(UserFeed.objects.get(user_id=other.id).stale)
+        failed = UserFeed.objects.get(user_id=self.user.id)
+        self.assertTrue(failed.stale)
+        self.assertEqual(failed.failures, 1)
+        self.assertGreater(failed.retry_at, timezone.now() + datetime.timedelta(seconds=feeds.REFRESH_BACKOFF - 5))
+        self.assertEqual(feeds.refresh_stale_feeds(), 0)
+
+        UserFeed.objects.filter(user_id=self.user.id).update(retry_at=timezone.now())
+        self.engine.personalization_search = personalization_search
+        out = StringIO()
+        call_command("refresh_feeds", stdout=out)
+        self.assertIn("Refreshed 1", out.getvalue())
+        refreshed = UserFeed.objects.get(user_id=self.user.id)
+        self.assertEqual((refreshed.stale, refreshed.failures, refreshed.retry_at), (False, 0, None))
+
+    def test_hydrate_feed(self):
+        '''
+            Test hydration keeps the feed order and skips deleted gifs
+        '''
+        removed = self.gifs[0].id
+        self.gifs[0].delete()
+        ids = [self.gifs[2].id, removed, self.gifs[1].id]
+        with self.assertNumQueries(1):
+            gifs = feeds.hydrate_feed(ids)
+        self.assertEqual([gif["id"] for gif in gifs], [self.gifs[2].id, self.gifs[1].id])
+        self.assertEqual(gifs[0]["uploader"], "spider")
+        self.assertEqual(len(feeds.hydrate_feed(ids, count=1)), 1)
+
+class RelatedGifsTests(TestCase):
+    '''
+        Test item-to-item neighbours built from favorites and read history
+    '''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "related.npz")
+        self.default_related = config.RELATED_GIFS
+        self.uploader = UserInfo.objects.create(user_name="spider", password="", salt="")
+        self.gifs = [
+            GifMetadata.objects.create(title=f"Gif {index}", uploader=self.uploader.id, tags=["cat"])
+            for index in range(4)
+        ]
+        ids = [str(gif.id) for gif in self.gifs]
+        alice = UserInfo.objects.create(user_name="alice", password="", salt="")
+        UserInfo.objects.create(user_name="bob", password="", salt="",
+                                read_history={ids[0]: "2023-05-01", ids[1]: "2023-05-01", ids[2]: "2023-05-03"})
+        carol = UserInfo.objects.create(user_name="carol", password="", salt="")
+        GifLike.objects.bulk_create([
+            GifLike(user=user, gif=self.gifs[index], created=datetime.datetime(2023, 5, day, tzinfo=datetime.timezone.utc))
+            for user, index, day in ((alice, 0, 1), (alice, 1, 2), (carol, 2, 1), (carol, 3, 2))
+        ])
+
+    def tearDown(self):
+        config.RELATED_GIFS = self.default_related
+        self.directory.cleanup()
+
+    def build(self, workers=1):
+        '''
+            Run the build command into the temporary file
+        '''
+        out = StringIO()
+        call_command("build_related_gifs", output=self.path, workers=workers, block_size=2, stdout=out)
+        self.assertIn("Wrote neighbours of 4 gifs from 7 interactions", out.getvalue())
+        return RelatedGifs(self.path)
+
+    def test_related(self):
+        '''
+            Test neighbours are ranked by cosine similarity
+        '''
+        first, second, third, fourth = [gif.id for gif in self.gifs]
+        related = self.build()
+        self.assertEqual(related.related(first), [second, third])
+        self.assertEqual(related.related(fourth), [third])
+        self.assertEqual(related.related(first, 1), [second])
+        self.assertEqual(related.related(9999), [])
+        self.assertEqual(related.blend([first, fourth]), [third, second])
+
+    def test_process_pool(self):
+        '''
+            Test the process pool gives the same neighbours
+        '''
+        inline = self.build()
+        pooled = self.build(workers=2)
+        for gif in self.gifs:
+            self.assertEqual(inline.related(gif.id), pooled.related(gif.id))
+
+    def test_missing_file(self):
+        '''
+            Test a missing neighbour file means no neighbours
+        '''
+        self.assertEqual(RelatedGifs(self.path).related(self.gifs[0].id), [])
+
+    def test_related_view(self):
+        '''
+            Test the related gifs endpoint and its tag fallback
+        '''
+        config.RELATED_GIFS = self.build()
+        res = self.client.get(f"/image/related/{self.gifs[3].id}")
+        self.assertEqual(res.json()["code"], 0)
+        self.assertEqual([gif["id"] for gif in res.json()["data"]], [self.gifs[2].id])
+        self.assertEqual(res.json()["data"][0]["uploader"], "spider")
+        config.RELATED_GIFS = RelatedGifs(self.path + ".missing")
+        engine = InvertedIndexSearchEngine(documents=[])
+        engine.bulk_post_metadata([generate_search_document(gif, "spider") for gif in self.gifs])
+        default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = engine
+        try:
+            res = self.client.get(f"/image/related/{self.gifs[3].id}")
+        finally:
+            config.SEARCH_ENGINE = default_engine
+        self.assertEqual(len(res.json()["data"]), 3)
+        self.assertNotIn(self.gifs[3].id, [gif["id"] for gif in res.json()["data"]])
+        self.assertEqual(self.client.get("/image/related/9999").json()["code"], 9)
+
+    def test_feed_blend(self):
+        '''
+            Test related gifs of the latest favorites join the feed
+        '''
+        config.RELATED_GIFS = self.build()
+        engine = InvertedIndexSearchEngine(documents=[])
+        default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = engine
+        try:
+            carol = UserInfo.objects.get(user_name="carol")
+            self.assertEqual(feeds.compute_feed(carol), [self.gifs[0].id, self.gifs[1].id])
+        finally:
+            config.SEARCH_ENGINE = default_engine
+
+class SuggestClient(FakeElasticsearch):
+    '''
+        Stand-in answering completion and phrase suggesters
+    '''
+    completions = ["Still Dog"]
+
+    def search(self, index, body, **kwargs):
+        self.bodies.append(dict(body))
+        self.params.append(kwargs)
+        response = {"hits": {"total": {"value": 0}, "hits": []}, "suggest": {}}
+        if "title_suggest" in body["suggest"]:
+            response["suggest"]["title_suggest"] = [{"options": [
+                {"_source": {"suggest": suggestion}} for suggestion in self.completions
+            ]}]
+        if "correct" in body["suggest"]:
+            response["suggest"]["correct"] = [{"options": [{"text": "still dog"}, {"text": "Still Dog"}]}]
+        return response
+
+class SuggestAndCorrectTests(TestCase):
+    '''
+        Test completion and correction share one elastic search round trip
+    '''
+    def setUp(self):
+        self.engine = ElasticSearchEngine()
+        self.engine.client = SuggestClient(total=0)
+        self.defaults = (config.SEARCH_ENGINE, config.TITLE_SUGGESTER, config.SPELLING_CORRECTOR)
+        config.SEARCH_ENGINE = self.engine
+        # neither in-process index is built, both fall back to the engine
+        config.TITLE_SUGGESTER = PrefixSuggester()
+        config.TITLE_SUGGESTER.retry_at = time.monotonic() + 3600
+        config.SPELLING_CORRECTOR = SpellingCorrector()
+        config.SPELLING_CORRECTOR.retry_at = time.monotonic() + 3600
+
+    def tearDown(self):
+        config.SEARCH_ENGINE, config.TITLE_SUGGESTER, config.SPELLING_CORRECTOR = self.defaults
+
+    def test_one_round_trip(self):
+        '''
+            Test both suggesters go in one request without hits
+        '''
+        self.assertEqual(
+            self.engine.suggest_and_correct("stil", "title"),
+            (["Still Dog"], ["still dog", "Still Dog"])
+        )
+        self.assertEqual(len(self.engine.client.bodies), 1)
+        self.assertEqual(self.engine.client.params[-1]["size"], 0)
+
+    def test_search_suggest(self):
+        '''
+            Test the suggest view gets both lists in one request and
+            merges corrections only when completions fall short
+        '''
+        res = self.client.post("/image/search/suggest", {"query": "stil"}, content_type="application/json")
+        self.assertEqual(res.json()["data"]["suggestions"], ["Still Dog", "still dog"])
+        self.assertEqual(len(self.engine.client.bodies), 1)
+        self.assertEqual(set(self.engine.client.bodies[0]["suggest"]), {"title_suggest", "correct"})
+        self.engine.client.completions = ["Still Dog", "Still Cat", "Still Life", "Still Water"]
+        res = self.client.post("/image/search/suggest", {"query": "stil"}, content_type="application/json")
+        self.assertEqual(res.json()["data"]["suggestions"], self.engine.client.completions)
+        self.assertEqual(len(self.engine.client.bodies), 2)
+        self.engine.client.completions = ["Still Dog"]
+        res = self.client.post(
+            "/image/search/suggest", {"query": "stil", "correct": False}, content_type="application/json"
+        )
+        self.assertEqual(res.json()["data"]["suggestions"], ["Still Dog"])
+        self.assertNotIn("correct", self.engine.client.bodies[-1]["suggest"])
+
+class HydrationTests(TestCase):
+    '''
+        Test ranked search hits are hydrated in bulk and in order
+    '''
+    def setUp(self):
+        self.alice = UserInfo.objects.create(user_name="alice", password="", salt="")
+        self.bob = UserInfo.objects.create(user_name="bob", password="", salt="")
+        self.gifs = [
+            GifMetadata.objects.create(title=f"Dog {index}", uploader=uploader.id, category="animal")
+            for index, uploader in enumerate([self.alice, self.bob] * 15)
+        ]
+
+    def test_hydrate_gifs(self):
+        '''
+            Test a page costs one query and keeps the ranking
+        '''
+        ranked = [str(gif.id) for gif in reversed(self.gifs)][:20]
+        with self.assertNumQueries(1):
+            cards = helpers.hydrate_gifs(ranked)
+        self.assertEqual([str(card["id"]) for card in cards], ranked)
+        self.assertEqual(cards[0]["uploader"], "bob")
+        self.assertEqual(cards[1]["uploader"], "alice")
+        removed = self.gifs[-1].id
+        self.gifs[-1].delete()
+        self.assertEqual(len(helpers.hydrate_gifs(ranked)), 19)
+        self.assertNotIn(removed, [card["id"] for card in helpers.hydrate_gifs(ranked)])
+        with self.assertNumQueries(0):
+            self.assertEqual(helpers.hydrate_gifs([]), [])
+
+    def test_search_order(self):
+        '''
+            Test image search returns the page in the engine ranking
+        '''
+        engine = InvertedIndexSearchEngine(documents=[])
+        engine.bulk_post_metadata([generate_search_document(gif, "alice") for gif in self.gifs])
+        default_engine = helpers.SEARCH_ENGINE
+        helpers.SEARCH_ENGINE = engine
+        config.SEARCH_CACHE.clear()
+        try:
+            body = {"target": "title", "keyword": "dog", "type": "partial", "filter": []}
+            res = self.client.post("/image/search", body, content_type="application/json")
+            ranked = engine.search_partial(dict(body, category="", tags=[]))
+        finally:
+            helpers.SEARCH_ENGINE = default_engine
+            config.SEARCH_CACHE.clear()
+        self.assertEqual([str(card["id"]) for card in res.json()["data"]["page_data"]], ranked[:20])
+
+class MetricsTests(TestCase):
+    '''
+        Test request timing, Server-Timing headers and the metrics endpoint
+    '''
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        self.user = UserInfo.objects.create(user_name="alice", password="", salt="")
+        GifMetadata.objects.create(title="Still Dog", uploader=self.user.id, category="animal")
+
+    def test_server_timing(self):
+        '''
+            Test phases of a request are sent in the Server-Timing header
+        '''
+        res = self.client.get("/startup")
+        self.assertRegex(res["Server-Timing"], r"^total;dur=\d+\.\d\d$")
+        token = helpers.create_token(self.user.user_name, self.user.id)
+        helpers.add_token_to_white_list(token)
+        body = {"target": "", "keyword": "", "type": "regex", "filter": []}
+        res = self.client.post("/image/search", body, content_type="application/json", HTTP_AUTHORIZATION=token)
+        phases = [entry.split(";")[0] for entry in res["Server-Timing"].split(", ")]
+        for name in ("search", "db", "hydrate", "serialize", "total"):
+            self.assertIn(name, phases)
+
+    def test_metrics_endpoint(self):
+        '''
+            Test latency and query histograms are kept per route
+        '''
+        self.client.get("/image/detail/1")
+        self.client.get("/image/detail/1")
+        self.client.get("/no/such/route")
+        res = self.client.get("/metrics")
+        self.assertTrue(res["Content-Type"].startswith("text/plain"))
+        text = res.content.decode()
+        self.assertIn('gifexplorer_request_duration_seconds_count{route="image/detail/<gif_id>"} 2', text)
+        self.assertIn('gifexplorer_request_duration_seconds_bucket{route="image/detail/<gif_id>",le="+Inf"} 2', text)
+        self.assertIn('gifexplorer_request_db_queries_bucket{route="image/detail/<gif_id>",le="0"} 0', text)
+        self.assertIn('gifexplorer_requests_total{route="unmatched",status="404"} 1', text)
+        self.assertIn('phase="db"', text)
+
+    def test_metrics_access(self):
+        '''
+            Test only internal addresses or the metrics token read /metrics
+        '''
+        res = self.client.get("/metrics", REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(res.status_code, 401)
+        default_token = settings.METRICS_TOKEN
+        settings.METRICS_TOKEN = "scrape-secret"
+        try:
+            res = self.client.get("/metrics", REMOTE_ADDR="203.0.113.7", HTTP_AUTHORIZATION="Bearer wrong")
+            self.assertEqual(res.status_code, 401)
+            res = self.client.get("/metrics", REMOTE_ADDR="203.0.113.7", HTTP_AUTHORIZATION="Bearer scrape-secret")
+            self.assertEqual(res.status_code, 200)
+        finally:
+            settings.METRICS_TOKEN = default_token
+
+    def test_phase_outside_request(self):
+        '''
+            Test timers do nothing outside of a request
+        '''
+        with metrics.phase("search"):
+            pass
+        self.assertEqual(metrics.REGISTRY.routes, {})
+
+class DownClient(FakeElasticsearch):
+    '''
+        Stand-in of an unreachable cluster
+    '''
+    def search(self, index, body, **kwargs):
+        self.bodies.append(dict(body))
+        raise TransportConnectionError("N/A", "connection refused", None)
+
+class ResilienceTests(TestCase):
+    '''
+        Test retries, the circuit breaker and the database fallback of searches
+    '''
+    def setUp(self):
+        self.engine = ElasticSearchEngine()
+        self.engine.client = DownClient(total=0)
+        self.engine.search_log.client = self.engine.client
+        self.request = {"type": "partial", "target": "title", "keyword": "dog", "category": "", "filter": [], "tags": []}
+
+    def test_retry_call(self):
+        '''
+            Test retriable errors are retried with jittered sleeps, others are not
+        '''
+        calls = []
+        sleeps = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise TransportError(503, "unavailable")
+            return "ok"
+        self.assertEqual(retry_call(flaky, 3, 0.1, 1.0, is_unavailable, sleeps.append), "ok")
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.2)
+        calls.clear()
+        with self.assertRaises(TransportError):
+            retry_call(flaky, 2, 0.1, 1.0, is_unavailable, sleeps.append)
+        def bad_request():
+            calls.append(1)
+            raise TransportError(400, "parsing_exception")
+        calls.clear()
+        with self.assertRaises(TransportError):
+            retry_call(bad_request, 3, 0.1, 1.0, is_unavailable, sleeps.append)
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_breaker(self):
+        '''
+            Test the breaker opens, fails fast, then lets one trial through
+        '''
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        def fail():
+            raise ValueError("down")
+        for _ in range(2):
+            with self.assertRaises(ServiceUnavailable):
+                breaker.call(fail)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(ServiceUnavailable):
+            breaker.call(lambda: "never called")
+        now[0] = 11
+        self.assertEqual(breaker.state, "half-open")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        now[0] = 22
+        self.assertEqual(breaker.call(lambda: "up"), "up")
+        self.assertEqual(breaker.state, "closed")
+        with self.assertRaises(KeyError):
+            breaker.call(lambda: {}["missing"], is_failure=lambda error: not isinstance(error, KeyError))
+        self.assertEqual(breaker.failures, 0)
+
+    def test_engine_fails_fast(self):
+        '''
+            Test the engine stops calling a dead cluster once the breaker opens
+        '''
+        self.engine.breaker.failure_threshold = 2
+        for _ in range(2):
+            with self.assertRaises(ServiceUnavailable):
+                self.engine.search_partial(self.request)
+        calls = len(self.engine.client.bodies)
+        self.assertEqual(calls, 4)
+        with self.assertRaises(ServiceUnavailable):
+            self.engine.search_partial(self.request)
+        self.assertEqual(len(self.engine.client.bodies), calls)
+        self.assertEqual(self.engine.suggest_search("do"), [])
+        self.assertEqual(self.engine.suggest_and_correct("do", "title"), ([], []))
+
+    def test_database_fallback(self):
+        '''
+            Test searches fall back to the database and are not cached
+        '''
+        alice = UserInfo.objects.create(user_name="alice", password="", salt="")
+        bob = UserInfo.objects.create(user_name="bobdog", password="", salt="")
+        first = GifMetadata.objects.create(title="Still Dog", uploader=alice.id, category="animal", width=300)
+        second = GifMetadata.objects.create(title="Hot DOG", uploader=bob.id, category="food", width=800)
+        GifMetadata.objects.create(title="Cat", uploader=alice.id, category="animal")
+        default_engine = helpers.SEARCH_ENGINE
+        helpers.SEARCH_ENGINE = self.engine
+        config.SEARCH_CACHE.clear()
+        try:
+            hits = helpers.run_search(self.request)
+            self.assertEqual(hits, [str(second.id), str(first.id)])
+            self.assertTrue(hits.degraded)
+            filtered = dict(self.request, filter=[{"range": {"width": {"gte": 0, "lte": 500}}}])
+            self.assertEqual(helpers.run_search(filtered, page=0, size=1), [str(first.id)])
+            by_uploader = dict(self.request, target="uploader")
+            self.assertEqual(helpers.run_search(by_uploader), [str(second.id)])
+            res = self.client.post("/image/search", self.request, content_type="application/json")
+            self.assertEqual([card["id"] for card in res.json()["data"]["page_data"]], [second.id, first.id])
+            self.assertIsNone(config.SEARCH_CACHE.get(helpers.generate_cache_body(self.request), ""))
+        finally:
+            helpers.SEARCH_ENGINE = default_engine
+            config.SEARCH_CACHE.clear()
+
+class SingleFlightTests(TestCase):
+    '''
+        Test identical concurrent reads are computed once
+    '''
+    def run_concurrently(self, flight, key, func, count=5):
+        '''
+            Call flight.do from count threads, return their results
+            and errors
+        '''
+        results = []
+        errors = []
+
+        def request():
+            try:
+                results.append(flight.do(key, func))
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        threads = [threading.Thread(target=request) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_coalesce(self):
+        '''
+            Test concurrent callers share one call and its result
+        '''
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return ["1", "2"]
+
+        threads, results, errors = self.run_concurrently(flight, ("search", "dog"), compute)
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [["1", "2"]] * 5)
+        self.assertEqual(flight.calls, {})
+        self.assertEqual(flight.do(("search", "dog"), lambda: ["3"]), ["3"])
+
+    def test_error(self):
+        '''
+            Test the error of the call reaches every waiter
+        '''
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("down")
+
+        threads, results, errors = self.run_concurrently(flight, "key", fail, count=3)
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [])
+        self.assertEqual([str(error) for error in errors], ["down"] * 3)
+        self.assertEqual(flight.calls, {})
+
+    def test_shared(self):
+        '''
+            Test a result published by another process is used, and a
+            stuck lock only delays the call
+        '''
+        flight = SingleFlight("default", max_wait=0.2)
+        digest = hashlib.md5(repr(("detail", 1)).encode("utf-8")).hexdigest()
+        cache = caches["default"]
+        cache.clear()
+        try:
+            cache.add(f"singleflight:lock:{digest}", 1)
+
+            def publish():
+                time.sleep(0.05)
+                cache.set(f"singleflight:result:{digest}", {"id": 1})
+
+            publisher = threading.Thread(target=publish)
+            publisher.start()
+            self.assertEqual(flight.do(("detail", 1), lambda: {"id": 2}), {"id": 1})
+            publisher.join()
+
+            cache.delete(f"singleflight:result:{digest}")
+            started = time.monotonic()
+            self.assertEqual(flight.do(("detail", 1), lambda: {"id": 3}), {"id": 3})
+            self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+            cache.clear()
+            self.assertEqual(flight.do(("detail", 1), lambda: {"id": 4}), {"id": 4})
+            self.assertIsNone(cache.get(f"singleflight:lock:{digest}"))
+            self.assertEqual(flight.do(("detail", 1), lambda: {"id": 5}), {"id": 4})
+        finally:
+            cache.clear()
+
+    def test_views_keep_user_flags(self):
+        '''
+            Test shared gif details and comments carry each user's own
+            liked and followed flags
+        '''
+        alice = UserInfo.objects.create(user_name="alice", password="", salt="")
+        bob = UserInfo.objects.create(user_name="bob", password="", salt="")
+        gif = GifMetadata.objects.create(title="Dog", uploader=bob.id, category="animal")
+        comment = GifComment.objects.create(metadata=gif, user=bob, content="nice")
+        reply = GifComment.objects.create(metadata=gif, user=alice, content="yes", parent=comment)
+        helpers.like_gif(alice, gif)
+        helpers.like_comment(alice, reply)
+        helpers.follow_user(alice, bob)
+        tokens = {}
+        for user in (alice, bob):
+            tokens[user.user_name] = helpers.create_token(user_name=user.user_name, user_id=user.id)
+            helpers.add_token_to_white_list(tokens[user.user_name])
+
+        for name, liked in (("alice", True), ("bob", False)):
+            res = self.client.get(f"/image/detail/{gif.id}", HTTP_AUTHORIZATION=tokens[name])
+            data = res.json()["data"]
+            self.assertEqual(data["gif_data"]["title"], "Dog")
+            self.assertEqual(data["gif_data"]["is_liked"], liked)
+            self.assertEqual(data["user_data"]["is_followed"], liked)
+            res = self.client.get(f"/image/comment/{gif.id}", HTTP_AUTHORIZATION=tokens[name])
+            comments = res.json()["data"]
+            self.assertEqual([item["content"] for item in comments], ["nice"])
+            self.assertFalse(comments[0]["is_liked"])
+            self.assertEqual(comments[0]["replies"][0]["is_liked"], liked)
+        self.assertEqual(self.client.get("/image/detail/999999").json()["code"], 9)
+
+class StandInServerTests(TestCase):
+    '''
+        Test the engine against the local elastic search stand-in
+        the benchmarks use
+    '''
+    def setUp(self):
+        corpus = [
+            {"id": 1, "title": "still dog", "uploader": "alice", "category": "animal",
+             "tags": ["cute", "dog"], "width": 300, "height": 200, "duration": 1.0},
+            {"id": 2, "title": "happy dog dance", "uploader": "bob", "category": "animal",
+             "tags": ["dog"], "width": 800, "height": 600, "duration": 3.0},
+            {"id": 3, "title": "cat food", "uploader": "alice", "category": "food",
+             "tags": ["cat"], "width": 400, "height": 400, "duration": 2.0},
+        ]
+        self.server = StandInServer(StandInElasticsearch(corpus)).start()
+        self.engine = ElasticSearchEngine()
+        self.engine.client = Elasticsearch([self.server.url])
+        self.engine.search_log = SearchLogWriter(self.engine.client)
+
+    def tearDown(self):
+        self.engine.search_log.close()
+        self.server.stop()
+
+    def test_search_modes(self):
+        '''
+            Test every search mode returns the matching gifs
+        '''
+        request = {"target": "title", "keyword": "dog", "category": "animal", "filter": [], "tags": []}
+        self.assertEqual(sorted(self.engine.search_partial(request)), ["1", "2"])
+        self.assertEqual(self.engine.search_perfect(dict(request, keyword="still dog")), ["1"])
+        self.assertEqual(sorted(self.engine.search_fuzzy(dict(request, keyword="dgo"))), ["1", "2"])
+        narrowed = dict(request, tags=["cute"], filter=[{"range": {"width": {"gte": 0, "lte": 500}}}])
+        hits = self.engine.search_partial(narrowed)
+        self.assertEqual((hits, hits.total), (["1"], 1))
+        self.assertEqual(self.engine.search_partial(request, page=1, size=1).total, 2)
+        self.assertEqual(self.engine.personalization_search({"cat": 5})[0], "3")
+        self.assertEqual(self.engine.suggest_search("happy"), ["happy dog dance"])
+        self.assertEqual(self.engine.suggest_and_correct("stil dgo", "title"), ([], ["still dog"]))
+
+    def test_writes(self):
+        '''
+            Test indexing, deleting and the search log reach the stand-in
+        '''
+        request = {"target": "title", "keyword": "zebra", "category": "", "filter": [], "tags": []}
+        self.assertEqual(self.engine.search_partial(request), [])
+        self.engine.bulk_post_metadata([{"id": 9, "title": "zebra run", "uploader": "carol", "category": "animal",
+                                         "tags": [], "width": 1, "height": 1, "duration": 1.0}])
+        self.assertEqual(self.engine.search_partial(request), ["9"])
+        self.engine.delete_metadata(9)
+        self.engine.delete_metadata(9)
+        self.assertEqual(self.engine.search_partial(request), [])
+        self.assertEqual(self.engine.bulk_delete_metadata([1, 404]), 2)
+        self.engine.search_log.close()
+        self.assertEqual(self.engine.hotwords_search(), ["zebra"])
+
+class SerializerTests(TestCase):
+    '''
+        Test gif cards are built without a query per gif
+    '''
+    def setUp(self):
+        self.uploaders = [
+            UserInfo.objects.create(user_name=f"uploader{index}", password="", salt="")
+            for index in range(4)
+        ]
+        self.gifs = [
+            GifMetadata.objects.create(
+                title=f"Cat {index}", uploader=self.uploaders[index % 4].id, category="animal", tags=["cat"]
+            )
+            for index in range(12)
+        ]
+        self.viewer = UserInfo.objects.create(
+            user_name="viewer", password="", salt="", tags={"cat": 3},
+            read_history={str(gif.id): f"2023-05-01 10:00:{index:02}" for index, gif in enumerate(self.gifs)}
+        )
+        GifLike.objects.bulk_create([GifLike(user=self.viewer, gif=gif) for gif in self.gifs[::2]])
+        self.token = helpers.create_token(user_name=self.viewer.user_name, user_id=self.viewer.id)
+        helpers.add_token_to_white_list(self.token)
+
+    def add_gifs(self, count):
+        '''
+            More gifs by new uploaders
+        '''
+        for index in range(count):
+            uploader = UserInfo.objects.create(user_name=f"extra{index}", password="", salt="")
+            GifMetadata.objects.create(title=f"Cat extra {index}", uploader=uploader.id, category="animal")
+
+    def test_serialize_gifs(self):
+        '''
+            Test rows and ids give the same cards in order
+        '''
+        ids = [self.gifs[3].id, 999999, self.gifs[0].id]
+        with self.assertNumQueries(1):
+            cards = serializers.serialize_gifs(ids)
+        self.assertEqual([card["id"] for card in cards], [self.gifs[3].id, self.gifs[0].id])
+        self.assertEqual(cards[0]["uploader"], "uploader3")
+        self.assertEqual(list(cards[0]), list(serializers.SEARCH_CARD))
+        with self.assertNumQueries(0):
+            self.assertEqual(serializers.serialize_gifs(self.gifs)[5]["uploader"], "uploader1")
+        with self.assertNumQueries(1):
+            cards = serializers.serialize_gifs(self.gifs[:2], serializers.PROFILE_CARD, viewer=self.viewer)
+        with self.assertNumQueries(0):
+            self.assertEqual(serializers.serialize_gifs([], viewer=self.viewer), [])
+        self.assertEqual([card["is_liked"] for card in cards], [True, False])
+        self.assertNotIn("uploader", cards[0])
+
+    def test_allgifs(self):
+        '''
+            Test the category listing costs the same whatever its length
+        '''
+        with self.assertNumQueries(1):
+            res = self.client.post("/image/allgifs", {"category": "animal"}, content_type="application/json")
+        self.assertEqual(len(res.json()["data"]), 12)
+        self.assertEqual(res.json()["data"][0]["uploader"], "uploader3")
+        self.add_gifs(20)
+        with self.assertNumQueries(1):
+            res = self.client.post("/image/allgifs", {"category": "animal"}, content_type="application/json")
+        self.assertEqual(len(res.json()["data"]), 32)
+
+    def test_profile(self):
+        '''
+            Test the profile gifs need no uploader query
+        '''
+        with self.assertNumQueries(2):
+            res = self.client.get(f"/user/profile/{self.uploaders[1].id}")
+        self.assertEqual([gif["id"] for gif in res.json()["data"]["data"]], [gif.id for gif in self.gifs[9:0:-4]])
+
+    def test_read_history(self):
+        '''
+            Test a read history page costs the same whatever its length
+        '''
+        with self.assertNumQueries(5):
+            res = self.client.get("/user/readhistory", {"page": 1}, HTTP_AUTHORIZATION=self.token)
+        page = res.json()["data"]["page_data"]
+        self.assertEqual([item["data"]["id"] for item in page], [gif.id for gif in reversed(self.gifs)])
+        self.assertEqual(page[0]["data"]["uploader"], "uploader3")
+        self.assertEqual([item["data"]["is_liked"] for item in page][-2:], [False, True])
+        self.add_gifs(20)
+        self.viewer.read_history.update({str(gif.id): "2023-05-01 09:00:00" for gif in GifMetadata.objects.all()})
+        self.viewer.save()
+        with self.assertNumQueries(5):
+            res = self.client.get("/user/readhistory", {"page": 1}, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(len(res.json()["data"]["page_data"]), config.MAX_GIFS_PER_PAGE)
+
+    def test_personalize(self):
+        '''
+            Test a cached feed is served with one gif query
+        '''
+        engine = InvertedIndexSearchEngine(documents=[])
+        engine.bulk_post_metadata([
+            generate_search_document(gif, self.uploaders[gif.uploader % 4].user_name) for gif in self.gifs
+        ])
+        default_engine = config.SEARCH_ENGINE
+        config.SEARCH_ENGINE = engine
+        feeds.feed_cache().clear()
+        try:
+            self.client.get("/user/personalize", HTTP_AUTHORIZATION=self.token)
+            with self.assertNumQueries(4):
+                res = self.client.get("/user/personalize", HTTP_AUTHORIZATION=self.token)
+        finally:
+            config.SEARCH_ENGINE = default_engine
+            feeds.feed_cache().clear()
+        cards = res.json()["data"]
+        self.assertEqual(len(cards), feeds.FEED_PAGE_SIZE)
+        self.assertEqual(list(cards[0]), list(serializers.FEED_CARD) + ["is_liked"])
+        self.assertEqual(
+            [card["is_liked"] for card in cards],
+            [card["id"] in {gif.id for gif in self.gifs[::2]} for card in cards]
+        )
+        self.assertIn(True, [card["is_liked"] for card in cards])
+
+class UploaderBackfillTests(TestCase):
+    '''
+        Test the uploader foreign key, its name and their backfill
+    '''
+    def setUp(self):
+        self.alice = UserInfo.objects.create(user_name="alice", password="", salt="")
+        self.bob = UserInfo.objects.create(user_name="bob", password="", salt="")
+
+    def test_save(self):
+        '''
+            Test saving a gif fills the uploader and a rename follows
+        '''
+        gif = GifMetadata.objects.create(title="Cat", uploader=self.alice.id)
+        self.assertEqual((gif.uploader_user_id, gif.uploader_name), (self.alice.id, "alice"))
+        gif.uploader = self.bob.id
+        gif.save(update_fields=["uploader"])
+        gif.refresh_from_db()
+        self.assertEqual((gif.uploader_user_id, gif.uploader_name), (self.bob.id, "bob"))
+        orphan = GifMetadata.objects.create(title="Dog", uploader=999999)
+        self.assertEqual((orphan.uploader_user_id, orphan.uploader_name), (None, ""))
+
+        bob = UserInfo.objects.get(id=self.bob.id)
+        with CaptureQueriesContext(connection) as queries:
+            bob.signature = "hi"
+            bob.save()
+        self.assertFalse([query for query in queries if "gifmetadata" in query["sql"]])
+        bob.user_name = "robert"
+        bob.save()
+        gif.refresh_from_db()
+        self.assertEqual(gif.uploader_name, "robert")
+        self.assertEqual(list(bob.uploaded_gifs.all()), [gif])
+
+    def test_backfill(self):
+        '''
+            Test the command fills rows written around save in chunks
+        '''
+        GifMetadata.objects.bulk_create([
+            GifMetadata(title=f"Cat {index}", uploader=[self.alice, self.bob][index % 2].id)
+            for index in range(7)
+        ] + [GifMetadata(title="Gone", uploader=999999)])
+        with self.assertNumQueries(2):
+            cards = serializers.serialize_gifs(GifMetadata.objects.order_by("id")[:2])
+        self.assertEqual([card["uploader"] for card in cards], ["alice", "bob"])
+
+        out = StringIO()
+        call_command("backfill_uploaders", "--batch-size", "3", stdout=out)
+        self.assertIn("Scanned 8 gifs, updated 7", out.getvalue())
+        self.assertEqual(
+            sorted(GifMetadata.objects.values_list("uploader_name", flat=True)),
+            [""] + ["alice"] * 4 + ["bob"] * 3
+        )
+        self.assertEqual(GifMetadata.objects.filter(uploader_user=self.bob).count(), 3)
+        with self.assertNumQueries(1):
+            cards = serializers.serialize_gifs(GifMetadata.objects.order_by("id")[:2])
+        self.assertEqual([card["uploader"] for card in cards], ["alice", "bob"])
+
+        out = StringIO()
+        call_command("backfill_uploaders", stdout=out)
+        self.assertIn("Scanned 8 gifs, updated 0", out.getvalue())
+
+class PaginationTests(TestCase):
+    '''
+        Test keyset cursor pagination of the listing endpoints
+    '''
+    def setUp(self):
+        self.uploader = UserInfo.objects.create(user_name="uploader", password="", salt="")
+        self.gifs = [
+            GifMetadata.objects.create(title=f"Cat {index}", uploader=self.uploader.id, category="animal")
+            for index in range(25)
+        ]
+        # a run of equal timestamps must not lose or repeat gifs at page edges
+        same_time = timezone.now()
+        GifMetadata.objects.filter(id__in=[gif.id for gif in self.gifs[5:15]]).update(pub_time=same_time)
+        self.fans = [UserInfo.objects.create(user_name=f"fan{index}", password="", salt="") for index in range(7)]
+        self.uploader.read_history = {str(gif.id): f"2023-05-01 10:00:{index:02}" for index, gif in enumerate(self.gifs)}
+        self.uploader.save()
+        for fan in self.fans:
+            helpers.follow_user(fan, self.uploader)
+        # followed at equal times too
+        Follow.objects.filter(follower__in=self.fans[:4]).update(created=same_time)
+        self.token = helpers.create_token(user_name=self.uploader.user_name, user_id=self.uploader.id)
+        helpers.add_token_to_white_list(self.token)
+
+    def walk(self, fetch, items):
+        '''
+            Ids of every page of a listing, asserting each page costs
+            the same number of queries
+        '''
+        ids, cursor, costs = [], "", set()
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                data = fetch(cursor)
+            costs.add(len(queries))
+            ids += [item["id"] for item in items(data)]
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(len(costs), 1)
+        return ids
+
+    def test_cursor(self):
+        '''
+            Test cursors roundtrip and bad ones are rejected
+        '''
+        cursor = pagination.encode_cursor(self.gifs[0].pub_time, self.gifs[0].id)
+        self.assertEqual(pagination.decode_cursor(cursor), (self.gifs[0].pub_time.isoformat(), self.gifs[0].id))
+        for bad in ("%%%", "bm90IGpzb24", pagination.encode_cursor("2023", [1])):
+            with self.assertRaises(pagination.InvalidCursor):
+                pagination.decode_cursor(bad)
+        with self.assertRaises(pagination.InvalidCursor):
+            pagination.cursor_params({"size": 500}, 20, 200)
+        self.assertEqual(pagination.cursor_params({"count": "true"}, 20, 200), ("", 20, True))
+
+        res = self.client.post("/image/allgifs", {"category": "animal", "cursor": "%%%"}, content_type="application/json")
+        self.assertNotEqual(res.json()["code"], 0)
+        res = self.client.get(f"/user/followers/{self.uploader.id}?cursor=%%%")
+        self.assertEqual(res.json()["info"], "INVALID_PAGES")
+
+    def test_allgifs(self):
+        '''
+            Test allgifs pages walk the category newest first
+        '''
+        expected = list(
+            GifMetadata.objects.filter(category="animal").order_by("-pub_time", "-id").values_list("id", flat=True)
+        )
+        ids = self.walk(
+            lambda cursor: self.client.post(
+                "/image/allgifs", {"category": "animal", "cursor": cursor, "size": 4}, content_type="application/json"
+            ).json(),
+            lambda data: data["data"]
+        )
+        self.assertEqual(ids, expected)
+        res = self.client.post("/image/allgifs", {"category": "animal", "size": 4, "count": True},
+                               content_type="application/json")
+        self.assertEqual(res.json()["page_count"], 7)
+        res = self.client.post("/image/allgifs", {"category": "animal"}, content_type="application/json")
+        self.assertNotIn("page_count", res.json())
+        self.assertIsNone(res.json()["next_cursor"])
+
+    def test_profile(self):
+        '''
+            Test profile gifs pages
+        '''
+        ids = self.walk(
+            lambda cursor: self.client.get(
+                f"/user/profile/{self.uploader.id}", {"cursor": cursor, "size": 6}
+            ).json()["data"],
+            lambda data: data["data"]
+        )
+        self.assertEqual(sorted(ids), sorted(gif.id for gif in self.gifs))
+        self.assertEqual(len(set(ids)), 25)
+
+    def test_followers(self):
+        '''
+            Test follower pages, newest follow first
+        '''
+        ids = self.walk(
+            lambda cursor: self.client.get(
+                f"/user/followers/{self.uploader.id}", {"cursor": cursor, "size": 2}
+            ).json()["data"],
+            lambda data: data["page_data"]
+        )
+        followers = Follow.objects.filter(followee=self.uploader).order_by("-created", "-id")
+        self.assertEqual(ids, [edge.follower_id for edge in followers])
+        res = self.client.get(f"/user/followers/{self.uploader.id}", {"cursor": "", "size": 2, "count": "true"})
+        self.assertEqual(res.json()["data"]["page_count"], 4)
+        res = self.client.get(f"/user/followers/{self.uploader.id}?page=1")
+        self.assertEqual(res.json()["code"], 0)
+
+    def test_read_history(self):
+        '''
+            Test read history pages, most recent read first
+        '''
+        ids = self.walk(
+            lambda cursor: self.client.get(
+                "/user/readhistory", {"cursor": cursor, "size": 10}, HTTP_AUTHORIZATION=self.token
+            ).json()["data"],
+            lambda data: [item["data"] for item in data["page_data"]]
+        )
+        self.assertEqual(ids, [gif.id for gif in reversed(self.gifs)])
+
+    def test_messages(self):
+        '''
+            Test message pages of a conversation and marking it read
+        '''
+        fan = self.fans[0]
+        Message.objects.bulk_create([
+            Message(sender=fan if index % 2 else self.uploader, receiver=self.uploader if index % 2 else fan,
+                    message=f"hi {index}")
+            for index in range(11)
+        ])
+        ids = self.walk(
+            lambda cursor: self.client.get(
+                f"/user/message/read/{fan.id}", {"cursor": cursor, "size": 3}, HTTP_AUTHORIZATION=self.token
+            ).json()["data"],
+            lambda data: data["page_data"]
+        )
+        self.assertEqual(ids, list(Message.objects.order_by("-pub_time", "-id").values_list("id", flat=True)))
+        self.assertFalse(Message.objects.filter(sender=fan, is_read=False).exists())
+
+class FollowTests(TestCase):
+    '''
+        Test the follow edges, their counters and their migration
+    '''
+    def setUp(self):
+        self.users = [UserInfo.objects.create(user_name=f"user{index}", password="", salt="") for index in range(5)]
+        self.tokens = [helpers.create_token(user_name=user.user_name, user_id=user.id) for user in self.users]
+        for token in self.tokens:
+            helpers.add_token_to_white_list(token)
+
+    def counts(self, user):
+        '''
+            (follower_count, following_count) of a user in the database
+        '''
+        user.refresh_from_db()
+        return user.follower_count, user.following_count
+
+    def test_follow(self):
+        '''
+            Test following and unfollowing keep the counters exact
+        '''
+        star = self.users[0]
+        for token in self.tokens[1:]:
+            self.assertEqual(self.client.post(f"/user/follow/{star.id}", HTTP_AUTHORIZATION=token).json()["code"], 0)
+        res = self.client.post(f"/user/follow/{star.id}", HTTP_AUTHORIZATION=self.tokens[1])
+        self.assertEqual(res.json()["code"], 14)
+        self.assertEqual(self.counts(star), (4, 0))
+        self.assertEqual(self.counts(self.users[1]), (0, 1))
+
+        # a stale copy of the user saved afterwards leaves the counters alone
+        stale = UserInfo.objects.get(id=star.id)
+        self.client.post(f"/user/unfollow/{star.id}", HTTP_AUTHORIZATION=self.tokens[2])
+        res = self.client.post(f"/user/unfollow/{star.id}", HTTP_AUTHORIZATION=self.tokens[2])
+        self.assertEqual(res.json()["code"], 14)
+        stale.signature = "hello"
+        stale.save()
+        self.assertEqual(self.counts(star), (3, 0))
+        self.assertEqual(star.signature, "hello")
+
+        res = self.client.get(f"/user/profile/{star.id}", HTTP_AUTHORIZATION=self.tokens[1])
+        self.assertEqual(res.json()["data"]["followers"], 3)
+        self.assertTrue(res.json()["data"]["is_followed"])
+        res = self.client.get(f"/user/profile/{star.id}", HTTP_AUTHORIZATION=self.tokens[2])
+        self.assertFalse(res.json()["data"]["is_followed"])
+
+    def test_pages(self):
+        '''
+            Test follower pages are one query whatever their length
+        '''
+        star = self.users[0]
+        for user in self.users[1:3]:
+            helpers.follow_user(user, star)
+        star.refresh_from_db()
+        with self.assertNumQueries(1):
+            followers, pages = helpers.show_user_followers(star, 0)
+        self.assertEqual([user["id"] for user in followers], [self.users[2].id, self.users[1].id])
+        self.assertEqual((followers[0]["following"], pages), (1, 1))
+        for user in self.users[3:]:
+            helpers.follow_user(user, star)
+        star.refresh_from_db()
+        with self.assertNumQueries(1):
+            followers, _ = helpers.show_user_followers(star, 0)
+        self.assertEqual(len(followers), 4)
+        self.users[4].refresh_from_db()
+        with self.assertNumQueries(1):
+            followings, pages = helpers.show_user_followings(self.users[4], 0)
+        self.assertEqual(([user["id"] for user in followings], pages), ([star.id], 1))
+
+    def test_migrate(self):
+        '''
+            Test the command unpacks both sides of the json dicts once
+        '''
+        first, second, third = self.users[:3]
+        UserInfo.objects.filter(id=first.id).update(
+            followings={str(second.id): "2023-05-01 10:00:00.000001", "999999": "2023-05-01 10:00:00"},
+            followers={str(third.id): "2023-05-02 10:00:00"}
+        )
+        UserInfo.objects.filter(id=second.id).update(followers={str(first.id): "2023-05-01 10:00:00.000001"})
+        UserInfo.objects.filter(id=third.id).update(followings={str(first.id): "2023-05-02 10:00:00"})
+        helpers.follow_user(self.users[4], second)
+
+        out = StringIO()
+        call_command("migrate_follows", "--batch-size", "2", stdout=out)
+        self.assertIn("recounted 3 users", out.getvalue())
+        self.assertEqual(
+            set(Follow.objects.values_list("follower_id", "followee_id")),
+            {(first.id, second.id), (third.id, first.id), (self.users[4].id, second.id)}
+        )
+        self.assertEqual(Follow.objects.get(follower=first).created.day, 1)
+        self.assertEqual([self.counts(user) for user in (first, second, third)], [(1, 1), (2, 0), (0, 1)])
+        self.assertFalse(UserInfo.objects.exclude(followers={}).exists())
+
+        # nothing left to move, the counters are not recounted
+        UserInfo.objects.filter(id=first.id).update(follower_count=5)
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command("migrate_follows", stdout=out)
+        self.assertIn("Nothing to unpack", out.getvalue())
+        self.assertEqual(self.counts(first), (5, 1))
+        out = StringIO()
+        call_command("migrate_follows", "--recount", stdout=out)
+        self.assertIn("Unpacked 0 follows, recounted 1 users", out.getvalue())
+        self.assertEqual(self.counts(first), (1, 1))
+
+    def test_concurrent_follow(self):
+        '''
+            Test a follow losing the race on the unique edge reports it
+            exists and leaves the surrounding transaction usable
+        '''
+        star = self.users[0]
+        with transaction.atomic():
+            self.assertTrue(helpers.follow_user(self.users[1], star))
+            # the lookup of get_or_create would have found no edge here
+            self.assertFalse(helpers.insert_unique(Follow, follower=self.users[1], followee=star))
+            self.assertFalse(helpers.follow_user(self.users[1], star))
+            self.assertEqual(Follow.objects.count(), 1)
+        self.assertEqual(self.counts(star), (1, 0))
+
+class LikeTests(TestCase):
+    '''
+        Test the like rows, their counters and their migration
+    '''
+    def setUp(self):
+        self.users = [UserInfo.objects.create(user_name=f"user{index}", password="", salt="") for index in range(3)]
+        self.tokens = [helpers.create_token(user_name=user.user_name, user_id=user.id) for user in self.users]
+        for token in self.tokens:
+            helpers.add_token_to_white_list(token)
+        self.gifs = [
+            GifMetadata.objects.create(title=f"Dog {index}", uploader=self.users[0].id, tags=["dog"])
+            for index in range(4)
+        ]
+        self.comment = GifComment.objects.create(metadata=self.gifs[0], user=self.users[0], content="nice")
+
+    def test_like(self):
+        '''
+            Test liking twice fails and the counters stay exact
+        '''
+        gif = self.gifs[0]
+        for token in self.tokens:
+            self.assertEqual(self.client.post(f"/image/like/{gif.id}", HTTP_AUTHORIZATION=token).json()["code"], 0)
+        self.assertEqual(self.client.post(f"/image/like/{gif.id}", HTTP_AUTHORIZATION=self.tokens[0]).json()["code"], 5)
+        # a stale copy of the gif saved afterwards leaves the counter alone
+        stale = GifMetadata.objects.get(id=gif.id)
+        self.client.post(f"/image/cancellike/{gif.id}", HTTP_AUTHORIZATION=self.tokens[1])
+        stale.title = "Dog again"
+        stale.save()
+        gif.refresh_from_db()
+        self.assertEqual((gif.likes, gif.title), (2, "Dog again"))
+        self.assertEqual(UserInfo.objects.get(id=self.users[0].id).tags, {"dog": 1})
+
+        comment_id = self.comment.id
+        for token in self.tokens[:2]:
+            self.client.post(f"/image/comment/like/{comment_id}", HTTP_AUTHORIZATION=token)
+        res = self.client.post(f"/image/comment/cancellike/{comment_id}", HTTP_AUTHORIZATION=self.tokens[2])
+        self.assertEqual(res.json()["code"], 5)
+        self.client.post(f"/image/comment/cancellike/{comment_id}", HTTP_AUTHORIZATION=self.tokens[0])
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.likes, 1)
+
+    def test_liked_ids(self):
+        '''
+            Test which of many gifs a viewer liked costs one query
+        '''
+        viewer = self.users[1]
+        helpers.like_gif(viewer, self.gifs[1])
+        helpers.like_gif(viewer, self.gifs[3])
+        helpers.like_gif(self.users[2], self.gifs[2])
+        helpers.like_comment(viewer, self.comment)
+        with self.assertNumQueries(1):
+            liked = serializers.liked_gif_ids(viewer, [gif.id for gif in self.gifs] + [999999])
+        self.assertEqual(liked, {self.gifs[1].id, self.gifs[3].id})
+        with self.assertNumQueries(0):
+            self.assertEqual(serializers.liked_gif_ids(viewer, []), set())
+        with self.assertNumQueries(1):
+            self.assertEqual(serializers.liked_comment_ids(viewer, [self.comment.id]), {self.comment.id})
+
+    def test_migrate(self):
+        '''
+            Test the command unpacks favorites once and recounts likes
+        '''
+        first, second, _ = self.users
+        UserInfo.objects.filter(id=first.id).update(
+            favorites={str(self.gifs[0].id): "2023-05-01 10:00:00", "999999": "2023-05-01 10:00:00"},
+            comment_favorites=[str(self.comment.id), "999999"]
+        )
+        UserInfo.objects.filter(id=second.id).update(favorites=[str(self.gifs[0].id), str(self.gifs[1].id)])
+        GifMetadata.objects.filter(id=self.gifs[2].id).update(likes=5)
+        helpers.like_gif(second, self.gifs[1])
+
+        out = StringIO()
+        call_command("migrate_likes", "--batch-size", "2", stdout=out)
+        self.assertIn("Unpacked 6 likes, recounted 3 gifs and comments", out.getvalue())
+        self.assertEqual(
+            dict(GifMetadata.objects.values_list("id", "likes")),
+            {self.gifs[0].id: 2, self.gifs[1].id: 1, self.gifs[2].id: 0, self.gifs[3].id: 0}
+        )
+        self.assertEqual(GifLike.objects.get(user=first).created.day, 1)
+        self.assertEqual(list(CommentLike.objects.values_list("user_id", flat=True)), [first.id])
+        self.assertFalse(UserInfo.objects.exclude(favorites={}).exists())
+
+        # nothing left to move, the counters are not recounted
+        GifMetadata.objects.filter(id=self.gifs[3].id).update(likes=4)
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command("migrate_likes", stdout=out)
+        self.assertIn("Nothing to unpack", out.getvalue())
+        out = StringIO()
+        call_command("migrate_likes", "--recount", stdout=out)
+        self.assertIn("Unpacked 0 likes, recounted 1 gifs and comments", out.getvalue())
+
+    def test_concurrent_like(self):
+        '''
+            Test a like losing the race on the unique row reports it
+            exists and leaves the surrounding transaction usable
+        '''
+        gif, user = self.gifs[0], self.users[1]
+        with transaction.atomic():
+            self.assertTrue(helpers.like_gif(user, gif))
+            self.assertFalse(helpers.like_gif(user, gif))
+            self.assertTrue(helpers.like_comment(user, self.comment))
+            self.assertFalse(helpers.like_comment(user, self.comment))
+            self.assertEqual(GifLike.objects.count() + CommentLike.objects.count(), 2)
+        gif.refresh_from_db()
+        self.comment.refresh_from_db()
+        self.assertEqual((gif.likes, self.comment.likes), (1, 1))
+
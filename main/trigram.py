@@ -0,0 +1,222 @@
+'''
+    Trigram index for regex search on gif titles and uploader names.
+
+    On PostgreSQL pg_trgm GIN indexes let the database answer title ~ pattern
+    without a sequential scan. Other databases keep trigram postings in
+    TrigramPosting: the trigrams every match must contain are read from
+    the pattern, gifs holding all of them are the candidates, and the
+    regex is checked on those candidates only.
+'''
+import re
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Count, Q
+from .models import GifMetadata, UserInfo, TrigramPosting
+from .metrics import timed
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+TITLE = "title"
+
+UPLOADER = "uploader"
+
+# rows written per bulk insert while rebuilding postings
+REBUILD_CHUNK_SIZE = 1000
+
+PG_TRGM_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS gifmetadata_title_trgm ON gifmetadata USING gin (title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS user_info_user_name_trgm ON user_info USING gin (user_name gin_trgm_ops)",
+)
+
+
+def trigrams(text):
+    '''
+        Lower-case trigrams of a text
+    '''
+    text = (text or "").lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def required_literals(items):
+    '''
+        Literal strings every match of a parsed pattern contains
+    '''
+    literals = []
+    run = []
+    for op, value in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+        literals.append("".join(run))
+        run = []
+        if op is sre_parse.SUBPATTERN:
+            literals += required_literals(value[-1])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and value[0] >= 1:
+            literals += required_literals(value[2])
+        # branches, classes, anchors ... only end the current run
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= 3]
+
+
+def required_trigrams(pattern):
+    '''
+        Trigrams every match of a regex contains, empty if none is known
+    '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return set()
+    if parsed.state.flags & re.VERBOSE:
+        return set()
+    result = set()
+    for literal in required_literals(parsed):
+        result |= trigrams(literal)
+    return result
+
+
+def uses_pg_trgm(using=DEFAULT_DB_ALIAS):
+    '''
+        True if the database answers regex lookups from pg_trgm indexes
+    '''
+    return connections[using].vendor == "postgresql"
+
+
+def candidate_ids(field, pattern):
+    '''
+        Subquery of object ids holding every required trigram,
+        None when the pattern requires none
+    '''
+    required = required_trigrams(pattern)
+    if not required:
+        return None
+    return TrigramPosting.objects.filter(field=field, trigram__in=required).values(
+        "object_id"
+    ).annotate(matched=Count("trigram", distinct=True)).filter(
+        matched=len(required)
+    ).values("object_id")
+
+
+@timed("search")
+def regex_search(target, pattern, query=Q()):
+    '''
+        Ids of gifs matching query whose title (or uploader name) matches
+        pattern, an empty pattern matches every gif
+    '''
+    gifs = GifMetadata.objects.filter(query)
+    if pattern:
+        if target == UPLOADER:
+            users = UserInfo.objects.filter(user_name__regex=pattern)
+            if not uses_pg_trgm():
+                candidates = candidate_ids(UPLOADER, pattern)
+                if candidates is not None:
+                    users = users.filter(id__in=candidates)
+            # a semi-join, the matching users are never loaded
+            gifs = gifs.filter(uploader__in=users.values("id"))
+        else:
+            gifs = gifs.filter(title__regex=pattern)
+            if not uses_pg_trgm():
+                candidates = candidate_ids(TITLE, pattern)
+                if candidates is not None:
+                    gifs = gifs.filter(id__in=candidates)
+    return list(gifs.order_by("id").values_list("id", flat=True))
+
+
+def index_text(field, object_id, text):
+    '''
+        Replace the postings of one object if its trigrams changed
+    '''
+    new = trigrams(text)
+    postings = TrigramPosting.objects.filter(field=field, object_id=object_id)
+    old = set(postings.values_list("trigram", flat=True))
+    if old == new:
+        return
+    postings.filter(trigram__in=old - new).delete()
+    TrigramPosting.objects.bulk_create([
+        TrigramPosting(field=field, object_id=object_id, trigram=trigram)
+        for trigram in new - old
+    ])
+
+
+def text_changed(instance, field, created, update_fields):
+    '''
+        Whether a save wrote a new text: full saves of loaded instances
+        list every field in update_fields, so the text is compared with
+        the one loaded from the database (see the models' from_db)
+    '''
+    if update_fields is not None and field not in update_fields:
+        return False
+    loaded = getattr(instance, f"_loaded_{field}", None)
+    return created or loaded is None or loaded != getattr(instance, field)
+
+
+def gif_saved(sender, instance, created=False, using=DEFAULT_DB_ALIAS, update_fields=None, **kwargs):
+    '''
+        post_save of GifMetadata
+    '''
+    if not text_changed(instance, "title", created, update_fields):
+        return
+    if not uses_pg_trgm(using):
+        index_text(TITLE, instance.id, instance.title)
+
+
+def gif_deleted(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    '''
+        post_delete of GifMetadata
+    '''
+    if not uses_pg_trgm(using):
+        TrigramPosting.objects.filter(field=TITLE, object_id=instance.id).delete()
+
+
+def user_saved(sender, instance, created=False, using=DEFAULT_DB_ALIAS, update_fields=None, **kwargs):
+    '''
+        post_save of UserInfo
+    '''
+    if not text_changed(instance, "user_name", created, update_fields):
+        return
+    if not uses_pg_trgm(using):
+        index_text(UPLOADER, instance.id, instance.user_name)
+
+
+def rebuild_postings(using=DEFAULT_DB_ALIAS):
+    '''
+        Write the postings of every gif title and user name again
+    '''
+    TrigramPosting.objects.using(using).all().delete()
+    sources = (
+        (TITLE, GifMetadata.objects.using(using).values_list("id", "title")),
+        (UPLOADER, UserInfo.objects.using(using).values_list("id", "user_name")),
+    )
+    count = 0
+    batch = []
+    for field, rows in sources:
+        for object_id, text in rows.order_by("id").iterator(chunk_size=REBUILD_CHUNK_SIZE):
+            batch += [
+                TrigramPosting(field=field, object_id=object_id, trigram=trigram)
+                for trigram in trigrams(text)
+            ]
+            if len(batch) >= REBUILD_CHUNK_SIZE:
+                count += len(TrigramPosting.objects.using(using).bulk_create(batch))
+                batch = []
+    count += len(TrigramPosting.objects.using(using).bulk_create(batch))
+    return count
+
+
+def create_trigram_indexes(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    '''
+        post_migrate: create the pg_trgm indexes, or fill the postings
+        of a database which has gifs but no postings yet
+    '''
+    connection = connections[using]
+    if uses_pg_trgm(using):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                for statement in PG_TRGM_INDEXES:
+                    cursor.execute(statement)
+        except Exception as error:  # pylint: disable=broad-except
+            print(error)
+        return
+    if not TrigramPosting.objects.using(using).exists() and GifMetadata.objects.using(using).exists():
+        rebuild_postings(using)
@@ -7,6 +7,7 @@ import main.views as views
 
 urlpatterns = [
     path('startup', views.startup),
+    path('metrics', views.server_metrics),
     path('user/register', views.user_register),
     path('user/verify/<token>', views.user_mail_verify),
     path('user/salt', views.user_salt),
@@ -36,6 +37,7 @@ urlpatterns = [
     path('image/watermark/<gif_id>', views.image_watermark),
     path('image/taskcheck', views.image_task_check),
     path('image/detail/<gif_id>', views.image_detail),
+    path('image/related/<gif_id>', views.image_related),
     path('image/previewlow/<gif_id>', views.image_preview_low_resolution),
     path('image/preview/<gif_id>', views.image_preview),
     path('image/download/<gif_id>', views.image_download),
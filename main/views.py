@@ -6,6 +6,8 @@ import os
 import uuid
 import math
 import json
+import re
+import hmac
 from wsgiref.util import FileWrapper
 import io
 import time
@@ -22,14 +24,21 @@ from django.views.decorators.csrf import csrf_exempt
 from django.core.mail import send_mail
 from django.core.files import File
 from django.utils.html import format_html
-from django.db.models import Q
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from utils.utils_request import not_found_error, unauthorized_error, format_error, request_failed, request_success
 from GifExplorer import settings
 from . import helpers
 from .helpers import handle_errors
 from . import config
+from . import trigram
+from . import feeds
+from . import metrics
+from . import search_outbox
 from .models import UserInfo, UserVerification, GifMetadata, GifFile, GifComment, Message, GifShare, TaskInfo
+from .serializers import serialize_gifs, liked_gif_ids, liked_comment_ids, LIST_CARD, PROFILE_CARD
+from .pagination import InvalidCursor, cursor_params, paginate_queryset
+from .hotwords import HOTWORDS_WINDOWS, DEFAULT_WINDOW, MAX_HOTWORDS
 
 # Create your views here.
 @csrf_exempt
@@ -41,6 +50,27 @@ def startup(req: HttpRequest):
     if req.method == "GET":
         return HttpResponse("Congratulations! Go ahead!")
 
+@csrf_exempt
+@handle_errors
+def server_metrics(req: HttpRequest):
+    '''
+    request:
+        None
+    response:
+        latency and query count histograms and phase times per route
+        of this worker process, in the Prometheus text format; only
+        for METRICS_ALLOWED_IPS or the METRICS_TOKEN bearer
+    '''
+    if req.method == "GET":
+        authorization = str(req.META.get("HTTP_AUTHORIZATION", ""))
+        token_valid = bool(settings.METRICS_TOKEN) and hmac.compare_digest(
+            authorization, f"Bearer {settings.METRICS_TOKEN}"
+        )
+        if req.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS and not token_valid:
+            return unauthorized_error("metrics are internal")
+        return HttpResponse(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4")
+    return not_found_error()
+
 @csrf_exempt
 @handle_errors
 def user_register(req: HttpRequest):
@@ -132,6 +162,7 @@ def user_mail_verify(req: HttpRequest, token: str):
         user.save()
         new_user = UserInfo(user_name=user.user_name, password=user.password, salt=user.salt, mail=user.mail)
         new_user.save()
+        config.SPELLING_CORRECTOR.add_text("uploader", new_user.user_name)
         user_token = helpers.create_token(user_id=new_user.id, user_name=new_user.user_name)
         return_data = {
             "data": {
@@ -453,21 +484,13 @@ def user_profile(req: HttpRequest, user_id: any):
         user = UserInfo.objects.filter(id=int(user_id)).first()
         if not user:
             return request_failed(12, "USER_NOT_FOUND", data={"data": {}})
-        profile_gifs = GifMetadata.objects.filter(uploader=int(user_id))
-        profile_gifs = profile_gifs.order_by('-pub_time')
-        gifs = []
-        for gif in profile_gifs:
-            gifs.append({
-                "id": gif.id,
-                "title": gif.title,
-                "width": gif.width,
-                "height": gif.height,
-                "category": gif.category,
-                "tags": gif.tags,
-                "duration": gif.duration,
-                "pub_time": gif.pub_time,
-                "like": gif.likes,
-            })
+        # 按 (pub_time, id) 游标分页, 默认返回最新的 MAX_LISTING_SIZE 个
+        try:
+            cursor, size, count = cursor_params(req.GET, config.MAX_LISTING_SIZE, config.MAX_LISTING_SIZE)
+            page = paginate_queryset(GifMetadata.objects.filter(uploader=int(user_id)), cursor, size, count=count)
+        except InvalidCursor as error:
+            return format_error(str(error))
+        gifs = serialize_gifs(page.items, PROFILE_CARD)
 
         is_followed = False
         if req.META.get("HTTP_AUTHORIZATION"):
@@ -476,7 +499,7 @@ def user_profile(req: HttpRequest, user_id: any):
             if not helpers.is_token_valid(token=encoded_token):
                 return unauthorized_error()
             current_user = UserInfo.objects.filter(id=token["id"]).first()
-            if str(user.id) in current_user.followings:
+            if helpers.is_following(current_user, user.id):
                 is_followed = True
 
         return_data = {
@@ -486,13 +509,16 @@ def user_profile(req: HttpRequest, user_id: any):
                 "signature": user.signature,
                 "mail": user.mail,
                 "avatar": user.avatar,
-                "followers": len(user.followers),
-                "following": len(user.followings),
+                "followers": user.follower_count,
+                "following": user.following_count,
                 "register_time": user.register_time,
                 "data": gifs,
+                "next_cursor": page.next_cursor,
                 "is_followed": is_followed
             }
         }
+        if page.page_count is not None:
+            return_data["data"]["page_count"] = page.page_count
         return request_success(return_data)
     return not_found_error()
 
@@ -527,15 +553,7 @@ def user_follow(req: HttpRequest, user_id: any):
             return request_failed(12, "USER_NOT_FOUND", data={"data": {}})
         if follow_user == user:
             return request_failed(13, "CANNOT_FOLLOW_SELF", data={"data": {}})
-        if str(follow_user.id) not in user.followings:
-            if not user.followings:
-                user.followings = {}
-            if not follow_user.followers:
-                follow_user.followers = {}
-            user.followings[str(follow_user.id)] = str(datetime.datetime.now())
-            user.save()
-            follow_user.followers[str(user.id)] = str(datetime.datetime.now())
-            follow_user.save()
+        if helpers.follow_user(user, follow_user):
             return request_success(data={"data": {}})
         else:
             return request_failed(14, "INVALID_FOLLOWS", data={"data": {}})
@@ -572,11 +590,7 @@ def user_unfollow(req: HttpRequest, user_id: any):
             return request_failed(12, "USER_NOT_FOUND", data={"data": {}})
         if follow_user == user:
             return request_failed(13, "CANNOT_FOLLOW_SELF", data={"data": {}})
-        if str(follow_user.id) in user.followings:
-            user.followings.pop(str(follow_user.id))
-            user.save()
-            follow_user.followers.pop(str(user.id))
-            follow_user.save()
+        if helpers.unfollow_user(user, follow_user):
             return request_success(data={"data": {}})
         else:
             return request_failed(14, "INVALID_FOLLOWS", data={"data": {}})
@@ -597,6 +611,11 @@ def user_get_followers(req: HttpRequest, user_id: any):
         user = UserInfo.objects.filter(id=int(user_id)).first()
         if not user:
             return request_failed(12, "USER_NOT_FOUND", data={"data": {}})
+        if "cursor" in req.GET:
+            try:
+                return request_success(data={"data": helpers.show_followers_cursor_page(user, req.GET)})
+            except InvalidCursor as error:
+                return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
         try:
             page = int(req.GET.get("page"))
         except (TypeError, ValueError) as error:
@@ -626,6 +645,11 @@ def user_get_followings(req: HttpRequest, user_id: any):
         user = UserInfo.objects.filter(id=int(user_id)).first()
         if not user:
             return request_failed(12, "USER_NOT_FOUND", data={"data": {}})
+        if "cursor" in req.GET:
+            try:
+                return request_success(data={"data": helpers.show_followings_cursor_page(user, req.GET)})
+            except InvalidCursor as error:
+                return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
         try:
             page = int(req.GET.get("page"))
         except (TypeError, ValueError) as error:
@@ -770,11 +794,13 @@ def user_read_message(req: HttpRequest, user_id: any):
             print(error)
             return unauthorized_error(str(error))
 
-        try:
-            page = int(req.GET.get("page"))
-        except (TypeError, ValueError) as error:
-            print(error)
-            return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
+        page = None
+        if "cursor" not in req.GET:
+            try:
+                page = int(req.GET.get("page"))
+            except (TypeError, ValueError) as error:
+                print(error)
+                return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
 
         user_name = token["user_name"]
         user = UserInfo.objects.filter(user_name=user_name).first()
@@ -790,11 +816,13 @@ def user_read_message(req: HttpRequest, user_id: any):
         if other_user == user:
             return request_failed(22, "CANNOT_MESSAGE_SELF", data={"data": {}})
 
-        messages = Message.objects.filter(sender=other_user, receiver=user)
-        for single_message in messages:
-            single_message.is_read = True
-            single_message.save()
+        Message.objects.filter(sender=other_user, receiver=user, is_read=False).update(is_read=True)
 
+        if page is None:
+            try:
+                return request_success({"data": helpers.show_message_cursor_page(user, other_user, req.GET)})
+            except InvalidCursor as error:
+                return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
         user_messages_list, pages = helpers.show_user_message_page(user, other_user, page - 1)
         return_data = {
             "data": {
@@ -830,7 +858,7 @@ def user_info(req: HttpRequest, user_id: any):
             if not helpers.is_token_valid(token=encoded_token):
                 return unauthorized_error()
             current_user = UserInfo.objects.filter(id=token["id"]).first()
-            if str(user.id) in current_user.followings:
+            if helpers.is_following(current_user, user.id):
                 is_followed = True
 
         return_data = {
@@ -888,6 +916,11 @@ def user_read_history(req: HttpRequest):
         return request_success(data={"data": {}})
 
     if req.method == "GET":
+        if "cursor" in req.GET:
+            try:
+                return request_success(data={"data": helpers.show_read_history_cursor_page(user, req.GET)})
+            except InvalidCursor as error:
+                return request_failed(6, "INVALID_PAGES", data={"data": {"error": str(error)}})
         try:
             page = int(req.GET.get("page"))
         except (TypeError, ValueError) as error:
@@ -971,34 +1004,42 @@ def user_personalize(req: HttpRequest):
         user = UserInfo.objects.filter(user_name=user_name).first()
         if not user:
             return unauthorized_error()
-        search_engine = config.SEARCH_ENGINE
-        tags = helpers.get_user_tags(user)
-        suggest_gif_list = search_engine.personalization_search(tags)
-        gifs = []
-        for gif_id in suggest_gif_list:
-            gif = GifMetadata.objects.filter(id=gif_id).first()
-            if gif:
-                gif_user = UserInfo.objects.filter(id=gif.uploader).first()
-                gifs.append({
-                    "id": gif.id,
-                    "title": gif.title,
-                    "width": gif.width,
-                    "height": gif.height,
-                    "category": gif.category,
-                    "tags": gif.tags,
-                    "duration": gif.duration,
-                    "pub_time": gif.pub_time,
-                    "like": gif.likes,
-                    "uploader_id": gif.uploader,
-                    "uploader": gif_user.user_name,
-                })
-            if len(gifs) >= 10:
-                break
-
+        gifs = feeds.hydrate_feed(feeds.get_feed(user), viewer=user)
         return_data = {"data": gifs}
         return request_success(return_data)
     return not_found_error()
 
+@csrf_exempt
+@handle_errors
+def image_related(req: HttpRequest, gif_id: any):
+    '''
+    request:
+        None
+    response:
+        {
+            "code": 0,
+            "info": "SUCCESS",
+            "data": [
+                {"id": 515, "title": "Wonderful Gif", "uploader": "AliceBurn", ...}
+            ]
+        }
+        gifs most often liked or read along with the gif, gifs
+        sharing its tags when it has no such neighbours yet
+    '''
+    if req.method == "GET":
+        if not isinstance(gif_id, str) or not gif_id.isdecimal():
+            return request_failed(9, "GIFS_NOT_FOUND", data={"data": {}})
+        gif = GifMetadata.objects.filter(id=gif_id).first()
+        if not gif:
+            return request_failed(9, "GIFS_NOT_FOUND", data={"data": {}})
+        related = config.RELATED_GIFS.related(gif.id, config.MAX_RELATED_GIFS)
+        if not related and gif.tags:
+            hits = config.SEARCH_ENGINE.personalization_search({tag: 1 for tag in gif.tags})
+            related = [int(hit) for hit in hits[:config.MAX_RELATED_GIFS + 1] if int(hit) != gif.id]
+        gifs = feeds.hydrate_feed(related, config.MAX_RELATED_GIFS)
+        return request_success({"data": gifs})
+    return not_found_error()
+
 @csrf_exempt
 @handle_errors
 def image_upload(req: HttpRequest):
@@ -1071,25 +1112,29 @@ def image_upload(req: HttpRequest):
             }
             return request_success(return_data)
 
-        gif = GifMetadata.objects.create(title=title, uploader=user.id, category=category, tags=tags)
-        gif_file = GifFile.objects.create(metadata=gif, file=req.FILES.get("file"))
-        gif_file.save()
-        fingerprint.gif_id = gif.id
-        fingerprint.save()
-
-        with Image.open(gif_file.file) as image:
-            durations = [image.info.get("duration")] * image.n_frames
-            if not durations[0]:
-                durations = [100] * image.n_frames
-            total_time = sum(durations) / 1000.0
-        width = gif_file.file.width
-        height = gif_file.file.height
-        path = gif_file.file.path
-        gif.duration = total_time
-        gif.width = width
-        gif.height = height
-        gif.name = name
-        gif.save()
+        # the gif and its outbox row commit together, a crash in between
+        # leaves neither
+        with transaction.atomic():
+            gif = GifMetadata.objects.create(title=title, uploader=user.id, category=category, tags=tags)
+            gif_file = GifFile.objects.create(metadata=gif, file=req.FILES.get("file"))
+            gif_file.save()
+            fingerprint.gif_id = gif.id
+            fingerprint.save()
+
+            with Image.open(gif_file.file) as image:
+                durations = [image.info.get("duration")] * image.n_frames
+                if not durations[0]:
+                    durations = [100] * image.n_frames
+                total_time = sum(durations) / 1000.0
+            width = gif_file.file.width
+            height = gif_file.file.height
+            path = gif_file.file.path
+            gif.duration = total_time
+            gif.width = width
+            gif.height = height
+            gif.name = name
+            gif.save()
+            helpers.post_search_metadata(gif)
 
         resize_path = path.rsplit("/", 1)[0] + "/resize_" + path.rsplit("/", 1)[1]
         max_size = min(width, height, 150)
@@ -1104,9 +1149,6 @@ def image_upload(req: HttpRequest):
                 frames.append(resized_frame)
             frames[0].save(resize_path, save_all=True, append_images=frames[1:], disposal=2)
 
-        if os.getenv('DEPLOY') is not None:
-            helpers.post_search_metadata(user, gif)
-
         if user.user_name != "spider":
             helpers.post_message_to_fans(user, gif.id)
 
@@ -1166,12 +1208,12 @@ def image_update_metadata(req, gif_id):
         if not gif:
             return request_failed(9, "GIFS_NOT_FOUND", data={"data": {}})
 
+        old_category = gif.category
         gif.category = category
         gif.tags = tags
-        gif.save()
-
-        if os.getenv('DEPLOY') is not None:
-            helpers.post_search_metadata(user, gif)
+        with transaction.atomic():
+            gif.save()
+            helpers.post_search_metadata(gif, old_category=old_category)
 
         return_data = {
             "data": {
@@ -1291,26 +1333,30 @@ def image_upload_resize_task(*, title: str, category: str, tags: list, user: int
             task.save()
             return return_data
 
-        gif = GifMetadata.objects.create(title=title, uploader=user, category=category, tags=tags)
-        gif_file = GifFile.objects.create(metadata=gif)
-        gif_file.file.save(name, File(output_file))
-        gif_file.save()
-        fingerprint.gif_id = gif.id
-        fingerprint.save()
-
-        with Image.open(gif_file.file) as image:
-            durations = [image.info.get("duration")] * image.n_frames
-            if not durations[0]:
-                durations = [100] * image.n_frames
-            total_time = sum(durations) / 1000.0
-        width = gif_file.file.width
-        height = gif_file.file.height
-        path = gif_file.file.path
-        gif.duration = total_time
-        gif.width = width
-        gif.height = height
-        gif.name = name
-        gif.save()
+        # the gif and its outbox row commit together, a crash in between
+        # leaves neither
+        with transaction.atomic():
+            gif = GifMetadata.objects.create(title=title, uploader=user, category=category, tags=tags)
+            gif_file = GifFile.objects.create(metadata=gif)
+            gif_file.file.save(name, File(output_file))
+            gif_file.save()
+            fingerprint.gif_id = gif.id
+            fingerprint.save()
+
+            with Image.open(gif_file.file) as image:
+                durations = [image.info.get("duration")] * image.n_frames
+                if not durations[0]:
+                    durations = [100] * image.n_frames
+                total_time = sum(durations) / 1000.0
+            width = gif_file.file.width
+            height = gif_file.file.height
+            path = gif_file.file.path
+            gif.duration = total_time
+            gif.width = width
+            gif.height = height
+            gif.name = name
+            gif.save()
+            helpers.post_search_metadata(gif)
 
         resize_path = path.rsplit("/", 1)[0] + "/resize_" + path.rsplit("/", 1)[1]
         max_size = min(width, height, 150)
@@ -1327,8 +1373,6 @@ def image_upload_resize_task(*, title: str, category: str, tags: list, user: int
 
         os.remove(name)
         upload_user = UserInfo.objects.filter(id=user).first()
-        if os.getenv('DEPLOY') is not None:
-            helpers.post_search_metadata(upload_user, gif)
 
         if upload_user.user_name != "spider":
             helpers.post_message_to_fans(upload_user, gif.id)
@@ -1401,10 +1445,10 @@ def image_detail(req: HttpRequest, gif_id: any):
         if not isinstance(gif_id, str) or not gif_id.isdecimal():
             return request_failed(9, "GIFS_NOT_FOUND", data={"data": {}})
 
-        gif = GifMetadata.objects.filter(id=gif_id).first()
-        if not gif:
+        # 同时到达的相同请求只查询一次, 共享 gif 和上传者信息
+        detail = config.SINGLE_FLIGHT.do(("detail", int(gif_id)), lambda: helpers.gif_detail(int(gif_id)))
+        if not detail:
             return request_failed(9, "GIFS_NOT_FOUND", data={"data": {}})
-        user = UserInfo.objects.filter(id=gif.uploader).first()
 
         is_liked = False
         is_followed = False
@@ -1414,37 +1458,15 @@ def image_detail(req: HttpRequest, gif_id: any):
             if not helpers.is_token_valid(token=encoded_token):
                 return unauthorized_error()
             current_user = UserInfo.objects.filter(id=token["id"]).first()
-            if str(gif.id) in current_user.favorites:
+            if liked_gif_ids(current_user, [detail["gif_data"]["id"]]):
                 is_liked = True
-            if str(user.id) in current_user.followings:
+            if helpers.is_following(current_user, detail["user_data"]["id"]):
                 is_followed = True
 
         return_data = {
             "data": {
-                "gif_data": {
-                    "id": gif.id,
-                    "title": gif.title,
-                    "uploader": user.user_name,
-                    "width": gif.width,
-                    "height": gif.height,
-                    "category": gif.category,
-                    "tags": gif.tags,
-                    "duration": gif.duration,
-                    "pub_time": gif.pub_time,
-                    "like": gif.likes,
-                    "is_liked": is_liked,
-                },
-                "user_data": {
-                    "id": user.id,
-                    "user_name": user.user_name,
-                    "signature": user.signature,
-                    "mail": user.mail,
-                    "avatar": user.avatar,
-                    "followers": len(user.followers),
-                    "following": len(user.followings),
-                    "register_time": user.register_time,
-                    "is_followed": is_followed
-                }
+                "gif_data": {**detail["gif_data"], "is_liked": is_liked},
+                "user_data": {**detail["user_data"], "is_followed": is_followed}
             }
         }
         return request_success(return_data)
@@ -1468,7 +1490,9 @@ def image_detail(req: HttpRequest, gif_id: any):
 
         helpers.delete_gif_fingerprint_from_list(gif_id)
         os.remove(gif.giffile.file.path)
-        gif.delete()
+        with transaction.atomic():
+            helpers.delete_search_metadata(gif)
+            gif.delete()
         return request_success(data={"data": {}})
     return not_found_error()
 
@@ -1715,13 +1739,9 @@ def image_like(req: HttpRequest, gif_id: any):
         user = UserInfo.objects.filter(id=token["id"]).first()
         if not user:
             return unauthorized_error()
-        if str(gif_id) not in user.favorites:
-            user.favorites[str(gif_id)] = str(datetime.datetime.now())
+        if helpers.like_gif(user, gif):
             tags = gif.tags
             helpers.update_user_tags(user, tags)
-            user.save()
-            gif.likes += 1
-            gif.save()
             return request_success(data={"data": {}})
         else:
             return request_failed(5, "INVALID_LIKES", data={"data": {}})
@@ -1757,11 +1777,7 @@ def image_cancel_like(req: HttpRequest, gif_id: any):
         user = UserInfo.objects.filter(id=token["id"]).first()
         if not user:
             return unauthorized_error()
-        if str(gif_id) in user.favorites:
-            user.favorites.pop(str(gif_id))
-            user.save()
-            gif.likes -= 1
-            gif.save()
+        if helpers.unlike_gif(user, gif):
             return request_success(data={"data": {}})
         else:
             return request_failed(5, "INVALID_LIKES", data={"data": {}})
@@ -1874,20 +1890,24 @@ def image_upload_video_task(*, title: str, category: str, tags: list, user: int,
                 frames.append(resized_frame)
             frames[0].save(new_path, save_all=True, append_images=frames[1:], disposal=2)
 
-        gif = GifMetadata.objects.create(title=title, uploader=user, category=category, tags=tags)
-        gif_file = GifFile.objects.create(metadata=gif, file=new_path)
-
-        with open(new_path, 'rb') as temp_gif:
-            gif_file.file.save(new_path, ContentFile(temp_gif.read()))
-        gif_file.save()
-
-        with Image.open(gif_file.file) as image:
-            duration = image.info['duration'] * image.n_frames
-        gif.duration = duration / 1000.0
-        gif.width = gif_file.file.width
-        gif.height = gif_file.file.height
-        gif.name = gif_file.file.name
-        gif.save()
+        # the gif and its outbox row commit together, a crash in between
+        # leaves neither
+        with transaction.atomic():
+            gif = GifMetadata.objects.create(title=title, uploader=user, category=category, tags=tags)
+            gif_file = GifFile.objects.create(metadata=gif, file=new_path)
+
+            with open(new_path, 'rb') as temp_gif:
+                gif_file.file.save(new_path, ContentFile(temp_gif.read()))
+            gif_file.save()
+
+            with Image.open(gif_file.file) as image:
+                duration = image.info['duration'] * image.n_frames
+            gif.duration = duration / 1000.0
+            gif.width = gif_file.file.width
+            gif.height = gif_file.file.height
+            gif.name = gif_file.file.name
+            gif.save()
+            helpers.post_search_metadata(gif)
         os.remove(hashed_name + ".mp4")
         os.remove(path)
         os.remove(new_path)
@@ -1907,8 +1927,6 @@ def image_upload_video_task(*, title: str, category: str, tags: list, user: int,
             frames[0].save(resize_path, save_all=True, append_images=frames[1:], disposal=2)
 
         upload_user = UserInfo.objects.filter(id=user).first()
-        if os.getenv('DEPLOY') is not None:
-            helpers.post_search_metadata(upload_user, gif)
 
         if upload_user.user_name != "spider":
             helpers.post_message_to_fans(upload_user, gif.id)
@@ -2230,40 +2248,22 @@ def image_comment(req: HttpRequest, gif_id: any):
                 return unauthorized_error()
             login = True
 
-        comments = gif.comments.all().filter(parent__isnull=True)
-        comments = comments.order_by('-pub_time')
+        # 同时到达的相同请求只查询一次评论树, 点赞状态按用户单独填写
+        shared = config.SINGLE_FLIGHT.do(("comments", gif.id), lambda: helpers.comment_tree(gif))
+        liked = set()
+        if login:
+            liked = liked_comment_ids(user, [
+                item["id"] for comment in shared for item in [comment] + comment["replies"]
+            ])
         comments_data = []
-        for comment in comments:
-            is_liked = False
-            if login and str(comment.id) in user.comment_favorites:
-                is_liked = True
-            comment_data = {
-                "id": comment.id,
-                "user": comment.user.user_name,
-                "avatar": comment.user.avatar,
-                "content": comment.content,
-                "pub_time": comment.pub_time,
-                "like": comment.likes,
-                "is_liked": is_liked
-            }
-            replies_data = []
-            replies = comment.replies.all().order_by('-pub_time')
-            for reply in replies:
-                is_liked = False
-                if login and str(reply.id) in user.comment_favorites:
-                    is_liked = True
-                reply_data = {
-                    "id": reply.id,
-                    "user": reply.user.user_name,
-                    "avatar": reply.user.avatar,
-                    "content": reply.content,
-                    "pub_time": reply.pub_time,
-                    "like": reply.likes,
-                    "is_liked": is_liked
-                }
-                replies_data.append(reply_data)
-            comment_data["replies"] = replies_data
-            comments_data.append(comment_data)
+        for comment in shared:
+            comments_data.append({
+                **comment,
+                "is_liked": comment["id"] in liked,
+                "replies": [
+                    {**reply, "is_liked": reply["id"] in liked} for reply in comment["replies"]
+                ]
+            })
         return_data = {
             "data": comments_data
         }
@@ -2346,13 +2346,7 @@ def image_comment_like(req: HttpRequest, comment_id: any):
         if not user:
             return unauthorized_error()
 
-        if not user.comment_favorites:
-            user.comment_favorites = []
-        if comment_id not in user.comment_favorites:
-            user.comment_favorites.append(comment_id)
-            user.save()
-            comment.likes += 1
-            comment.save()
+        if helpers.like_comment(user, comment):
             return request_success(data={"data": {}})
         else:
             return request_failed(5, "INVALID_LIKES", data={"data": {}})
@@ -2387,13 +2381,7 @@ def image_comment_cancel_like(req: HttpRequest, comment_id: any):
         if not user:
             return unauthorized_error()
 
-        if not user.comment_favorites:
-            user.comment_favorites = []
-        if comment_id in user.comment_favorites:
-            user.comment_favorites.remove(comment_id)
-            user.save()
-            comment.likes -= 1
-            comment.save()
+        if helpers.unlike_comment(user, comment):
             return request_success(data={"data": {}})
         else:
             return request_failed(5, "INVALID_LIKES", data={"data": {}})
@@ -2405,12 +2393,16 @@ def image_allgifs(req: HttpRequest):
     '''
     request:
         {
-            "category": "sports"
+            "category": "sports",
+            "cursor": "",       // optional, next_cursor of the previous page
+            "size": 200,        // optional, at most 200
+            "count": false      // optional, also return page_count
         }
     response:
         {
             "code": 0,
             "info": "SUCCESS",
+            "next_cursor": "WyIyMDIzLTAzLTIxVDE5OjAyOjE2LjMwNVoiLDUxOV0",
             "data": [
                 {
                     "id": 514,
@@ -2444,21 +2436,19 @@ def image_allgifs(req: HttpRequest):
         else:
             category = config.CATEGORY_LIST[""]
 
-        gifs = GifMetadata.objects.filter(category=category).order_by('-pub_time')[:200]
-        if not gifs:
+        # 按 (pub_time, id) 游标分页, 默认返回最新的 MAX_LISTING_SIZE 个
+        try:
+            cursor, size, count = cursor_params(body, config.MAX_LISTING_SIZE, config.MAX_LISTING_SIZE)
+            page = paginate_queryset(GifMetadata.objects.filter(category=category), cursor, size, count=count)
+        except InvalidCursor as error:
+            return format_error(str(error))
+        if not page.items and not cursor:
             return request_success(data={})
-        gifs_list = []
-        for gif in gifs:
-            user = UserInfo.objects.filter(id=gif.uploader).first()
-            gif_dict = {
-                "id": gif.id,
-                "title": gif.title,
-                "category": gif.category,
-                "uploader": user.user_name,
-                "pub_time": gif.pub_time
-            }
-            gifs_list.append(gif_dict)
-        return request_success({"data": gifs_list})
+        gifs_list = serialize_gifs(page.items, LIST_CARD)
+        return_data = {"data": gifs_list, "next_cursor": page.next_cursor}
+        if page.page_count is not None:
+            return_data["page_count"] = page.page_count
+        return request_success(return_data)
     return not_found_error()
 
 @csrf_exempt
@@ -2603,123 +2593,77 @@ def image_search(req: HttpRequest):
             #     print(error)
             #     return format_error()
 
+        # 本进程的索引由后台线程应用其他进程写入的改动
+        search_outbox.start()
         search_start_time = time.time()
+        viewer = None
         # 通过正则表达式搜索
         id_list = []
         if body["type"] == "regex":
-            query = Q()
-            if body["filter"]:
-                ranges = [filter["range"] for filter in body["filter"]]
-                # ranges = [
-                #     {"width": {"gte": 0, "lte": 100}},
-                #     {"height": {"gte": 0, "lte": 100}},
-                #     {"duration": {"gte": 0, "lte": 100}}
-                # ]
-                for each_range in ranges:
-                    if "width" in each_range:
-                        query &= Q(width__gte=each_range["width"]["gte"])
-                        query &= Q(width__lte=each_range["width"]["lte"])
-                    elif "height" in each_range:
-                        query &= Q(height__gte=each_range["height"]["gte"])
-                        query &= Q(height__lte=each_range["height"]["lte"])
-                    elif "duration" in each_range:
-                        query &= Q(duration__gte=each_range["duration"]["gte"])
-                        query &= Q(duration__lte=each_range["duration"]["lte"])
-            if body["category"]:
-                query &= Q(category=body["category"])
-            if body["tags"]:
-                # query &= Q(tags__in=(body["tags"]))
-                for tag in body["tags"]:
-                    query &= Q(tags__contains=tag)  # sqlite 不支持 contains
+            query = helpers.filter_query(body)
 
             repred_keyword = repr(body['keyword'])[1:-1]
-            if body["target"] == "uploader":
-                # 如果 keyword 为 "" ，那么没有本项限制。
-                if body["keyword"] == "":
-                    uploaader_id_list = list(UserInfo.objects.all().values_list('id', flat=True))
-                else:
-                    uploaader_id_list = list(UserInfo.objects.filter(user_name__regex=repred_keyword).values_list('id', flat=True))
-                # print(f'uploaader_id_list = {uploaader_id_list}')
-
-                id_list = list(GifMetadata.objects.filter(Q(uploader__in=uploaader_id_list) & query).values_list('id', flat=True))
-            elif body["target"] == "title":
-                # 如果 keyword 为 "" ，那么没有本项限制。
-                if body["keyword"] == "":
-                    id_list = list(GifMetadata.objects.all().values_list('id', flat=True))
-                else:
-                    id_list = list(GifMetadata.objects.filter(Q(title__regex=repred_keyword) & query).values_list('id', flat=True))
+            try:
+                re.compile(repred_keyword)
+            except re.error as error:
+                print(error)
+                return format_error(str(error))
+            # 由三元组索引筛出候选, 仅对候选做正则匹配; 如果 keyword 为 "" ，那么没有本项限制。
+            # 同时到达的相同请求只查询一次, 共享结果
+            regex_key = ("regex", body["target"], repred_keyword, helpers.generate_cache_body(body))
+            id_list = config.SINGLE_FLIGHT.do(
+                regex_key, lambda: trigram.regex_search(body["target"], repred_keyword, query)
+            )
 
         # 通过关键词搜索
         else:
-            # 连接搜索模块
-            if os.getenv('DEPLOY') is not None:
-                cache_body = helpers.generate_cache_body(body)
-                if cache_body in config.CACHE_HISTORY and (datetime.datetime.now().timestamp() - config.CACHE_HISTORY[cache_body][1] < config.CACHE_MAX_TIME) and (config.CACHE_HISTORY[cache_body][2] == body["tags"]):
-                    id_list = config.CACHE_HISTORY[cache_body][0]
-                    print("Cached!")
-
-                else:
-                    search_engine = config.SEARCH_ENGINE
-
-                    # 如果用户已登录，将本次搜索记录到用户的搜索历史中
-                    if req.META.get("HTTP_AUTHORIZATION"):
-                        encoded_token = str(req.META.get("HTTP_AUTHORIZATION"))
-                        token = helpers.decode_token(encoded_token)
-                        if not helpers.is_token_valid(token=encoded_token):
-                            return unauthorized_error()
-                        user = UserInfo.objects.filter(id=token["id"]).first()
-                        content = body["keyword"]
-                        if content:
-                            helpers.post_user_search_history(user=user, search_content=content)
-                            helpers.update_user_tags(user, [content])
-
-                    if body["type"] == "perfect":
-                        id_list = search_engine.search_perfect(request=body)
-                    elif body["type"] == "partial":
-                        id_list = search_engine.search_partial(request=body)
-                    elif body["type"] == "fuzzy":
-                        id_list = search_engine.search_fuzzy(request=body)
-                    elif body["type"] == "related":
-                        id_list = search_engine.search_related(request=body)
-                    else:
-                        return format_error()
-
-                    if os.getenv('DEPLOY') is not None:
-                        config.CACHE_HISTORY[cache_body] = (id_list, datetime.datetime.now().timestamp(), body["tags"])
-                        if len(config.CACHE_HISTORY) > config.MAX_CACHE_HISTORY:
-                            cache_history = list(config.CACHE_HISTORY.items())
-                            config.CACHE_HISTORY = dict(sorted(cache_history, key=lambda x: x[1], reverse=True)[: config.MAX_CACHE_HISTORY // 2])
-                        print("Not cached!")
-            else:
-                search_engine = config.SEARCH_ENGINE
-
-                # 如果用户已登录，将本次搜索记录到用户的搜索历史中
-                if req.META.get("HTTP_AUTHORIZATION"):
-                    encoded_token = str(req.META.get("HTTP_AUTHORIZATION"))
-                    token = helpers.decode_token(encoded_token)
-                    if not helpers.is_token_valid(token=encoded_token):
-                        return unauthorized_error()
-                    user = UserInfo.objects.filter(id=token["id"]).first()
-                    content = body["keyword"]
-                    if content:
-                        helpers.post_user_search_history(user=user, search_content=content)
-                        helpers.update_user_tags(user, [content])
-
-                if body["type"] == "perfect":
-                    id_list = search_engine.search_perfect(request=body)
-                elif body["type"] == "partial":
-                    id_list = search_engine.search_partial(request=body)
-                elif body["type"] == "fuzzy":
-                    id_list = search_engine.search_fuzzy(request=body)
-                elif body["type"] == "related":
-                    id_list = search_engine.search_related(request=body)
-                else:
-                    return format_error()
+            # 如果用户已登录，将本次搜索记录到用户的搜索历史中
+            if req.META.get("HTTP_AUTHORIZATION"):
+                encoded_token = str(req.META.get("HTTP_AUTHORIZATION"))
+                token = helpers.decode_token(encoded_token)
+                if not helpers.is_token_valid(token=encoded_token):
+                    return unauthorized_error()
+                user = UserInfo.objects.filter(id=token["id"]).first()
+                viewer = user
+                content = body["keyword"]
+                if content:
+                    helpers.post_user_search_history(user=user, search_content=content)
+                    helpers.update_user_tags(user, [content])
+
+            # 首页搜索计入热词, 翻页不重复计数
+            if body["keyword"] and body["page"] == 1:
+                config.HOT_WORDS.record(body["keyword"])
+
+            # 先查询搜索缓存, 缓存的是整个查询的有序结果, 按页切分
+            page = body["page"] - 1
+            cache_body = helpers.generate_cache_body(body)
+            hits = config.SEARCH_CACHE.get(cache_body, body["category"])
+            if hits is None:
+                # 预取结果集并固定在缓存中, 后续翻页不再访问搜索模块; 同时未命中的相同请求只查询一次
+                hits = config.SINGLE_FLIGHT.do(
+                    ("search", body["category"], cache_body),
+                    lambda: helpers.prefetch_search(body, cache_body, pin=page == 0)
+                )
+            id_list = hits.page(page, config.MAX_GIFS_PER_PAGE)
+            if id_list is None:
+                # 超出预取范围的深分页直接交给搜索模块
+                id_list = helpers.run_search(body, page, config.MAX_GIFS_PER_PAGE)
         search_finish_time = time.time()
 
-        gifs = GifMetadata.objects.filter(id__in=id_list)
-        id_list = [gif.id for gif in gifs]
-        gif_list, pages = helpers.show_search_page(id_list, body["page"] - 1)
+        if body["type"] == "regex":
+            gif_list, pages = config.SINGLE_FLIGHT.do(
+                regex_key + (body["page"],), lambda: helpers.show_search_page(id_list, body["page"] - 1)
+            )
+        else:
+            # id_list 已是当前页的结果
+            gif_list, pages = config.SINGLE_FLIGHT.do(
+                ("page", tuple(id_list), id_list.total), lambda: helpers.show_search_hits(id_list)
+            )
+
+        # 结果页为所有用户共享, 登录用户的点赞状态一次查询后单独填写
+        if viewer is not None:
+            liked = liked_gif_ids(viewer, [gif["id"] for gif in gif_list])
+            gif_list = [{**gif, "is_liked": gif["id"] in liked} for gif in gif_list]
 
         finish_time = time.time()
         return request_success(data=
@@ -2770,16 +2714,30 @@ def search_suggest(req: HttpRequest):
         if "correct" not in body:
             body["correct"] = True
 
+        # 本进程的索引由后台线程应用其他进程写入的改动
+        search_outbox.start()
         # 连接搜索模块
         search_engine = config.SEARCH_ENGINE
 
         if body["target"] == "title":
             # 如果 body["target"] == "title" 先获取补全建议
-            suggestion_list = search_engine.suggest_search(body["query"])
+            suggestion_list = config.TITLE_SUGGESTER.suggest(body["query"])
+            corrected_list = None
+            if suggestion_list is None:
+                # 补全索引尚未建好时由搜索模块给出，需要纠错时补全和纠错一次请求完成
+                if body["correct"]:
+                    suggestion_list, corrected_list = search_engine.suggest_and_correct(
+                        body["query"], body["target"]
+                    )
+                else:
+                    suggestion_list = search_engine.suggest_search(body["query"])
             # 如果建议结果较少且需要纠错
             if len(suggestion_list) < 4 and body["correct"]:
                 # 获取纠错建议
-                corrected_list = search_engine.correct_search(input=body["query"], target=body["target"])
+                if corrected_list is None:
+                    corrected_list = config.SPELLING_CORRECTOR.correct(body["query"], body["target"])
+                if corrected_list is None:
+                    corrected_list = search_engine.correct_search(input=body["query"], target=body["target"])
                 return request_success(data=
                     {
                         "data": {
@@ -2795,7 +2753,9 @@ def search_suggest(req: HttpRequest):
                     })
         else:
             # 如果 body["target"] == "uploader" ，直接纠错
-            corrected_list = search_engine.correct_search(input=body["query"], target=body["target"])
+            corrected_list = config.SPELLING_CORRECTOR.correct(body["query"], body["target"])
+            if corrected_list is None:
+                corrected_list = search_engine.correct_search(input=body["query"], target=body["target"])
             return request_success(data=
                 {
                     "data": {
@@ -2823,7 +2783,7 @@ def image_gifs_count(req: HttpRequest):
 def search_hotwords(req: HttpRequest):
     """
     request:
-        None
+        - window: hour / day / week, optional, default day
     response:
         {
             "code": 0,
@@ -2834,8 +2794,15 @@ def search_hotwords(req: HttpRequest):
         }
     """
     if req.method == "GET":
-        search_engine = config.SEARCH_ENGINE
-        hotwords_list = search_engine.hotwords_search()
+        # window 为 hour / day / week, 默认为 day
+        window = req.GET.get("window", DEFAULT_WINDOW)
+        if window not in HOTWORDS_WINDOWS:
+            return format_error()
+        hotwords_list = config.HOT_WORDS.top(MAX_HOTWORDS, window)
+        if not hotwords_list:
+            # 本进程尚无热词统计时由搜索模块给出
+            search_engine = config.SEARCH_ENGINE
+            hotwords_list = search_engine.hotwords_search()
         return request_success(data={
                 "data": hotwords_list
             })
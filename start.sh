@@ -12,10 +12,17 @@ python -c "import pycorrector; pycorrector.correct('少先队员因该为老人
 
 python3 manage.py makemigrations main
 python3 manage.py migrate
+# exits after one query once the legacy follow dicts are empty
+python3 manage.py migrate_follows
+# exits after one query once the legacy favorites are empty
+python3 manage.py migrate_likes
 
 # python3 manage.py runserver 80
 # celery -A GifExplorer worker -l info -n worker1@%h -D --logfile=celery.log & \
 celery -A GifExplorer worker -l info -n worker1@%h -c 4 & \
+python3 manage.py drain_search_outbox --forever & \
+python3 manage.py refresh_feeds --forever & \
+python3 manage.py backfill_uploaders --sleep 0.05 & \
 uwsgi --module=GifExplorer.wsgi:application \
     --env DJANGO_SETTINGS_MODULE=GifExplorer.settings \
     --master \
@@ -2,8 +2,10 @@
     This utils_request.py file contains tools to generate http response
 '''
 from django.http import JsonResponse
+from utils.utils_timing import timed
 
 
+@timed("serialize")
 def request_failed(code, info, status_code=400, data={}):
     '''
         Return a http failure response
@@ -19,6 +21,7 @@ def request_failed(code, info, status_code=400, data={}):
     )
 
 
+@timed("serialize")
 def request_success(data={}):
     '''
         Return a http success response
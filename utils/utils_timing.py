@@ -0,0 +1,66 @@
+'''
+    This utils_timing.py file contains the per-phase timers of a request,
+    main/metrics.py starts them for every request and records the result
+'''
+import time
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+# timings of the request being served, None outside of a request
+TIMINGS = contextvars.ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    '''
+        Seconds spent in each phase of one request and its query count.
+        Phases may nest, db covers the queries run inside every other
+        phase, so the phases do not add up to the total.
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.queries = 0
+
+    def add(self, name, seconds):
+        '''
+            Count seconds spent in a phase
+        '''
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self, total):
+        '''
+            Server-Timing header value, durations in milliseconds
+        '''
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def phase(name):
+    '''
+        Time the enclosed block as a phase of the current request,
+        does nothing outside of a request
+    '''
+    timings = TIMINGS.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def timed(name):
+    '''
+        Decorator timing every call of a function as a phase
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator